@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+  bench_copy -- compare ways of streaming large response bodies to disk
+
+  Serves one large fake image from a local HTTP server and downloads it
+  repeatedly with
+  - copyfileobj: shutil.copyfileobj, as before the body was hashed
+  - read+hash:   urllib3 read() of fresh bytes chunks, hashed and written
+  - readinto:    readinto() a reused buffer, as the loader does, but unhashed
+  - copy_hashed: the loader's copy_hashed(), i.e. readinto plus hashing
+
+  Note that the CPU times include the server thread.
+
+  Usage: python benchmarks/bench_copy.py [-n ROUNDS] [--size BYTES] [--chunk-size BYTES]
+"""
+from __future__ import division, print_function, absolute_import
+
+import argparse
+import hashlib
+import shutil
+import tempfile
+import threading
+import time
+from functools import partial
+from http.server import ThreadingHTTPServer
+
+import urllib3
+
+from bench_engines import make_handler
+from image_loader import loader
+
+
+def copy_read_hash(response, out_file, chunk_size):
+    digest = hashlib.sha256()
+    for chunk in iter(partial(response.read, chunk_size), b''):
+        digest.update(chunk)
+        out_file.write(chunk)
+    return digest.hexdigest()
+
+
+def copy_readinto(response, out_file, chunk_size):
+    buf = loader.get_buffer(chunk_size)
+    readinto = loader.body_reader(response)
+    for count in iter(partial(readinto, buf), 0):
+        out_file.write(buf[:count])
+
+
+def run_method(name, copy, pool, url, rounds):
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    for _ in range(rounds):
+        response = pool.request('GET', url, preload_content=False)
+        with tempfile.TemporaryFile() as out_file:
+            copy(response, out_file)
+        response.release_conn()
+    wall, cpu = time.perf_counter() - start_wall, time.process_time() - start_cpu
+    size = int(response.headers['Content-Length']) * rounds
+    print("{:12} {:8.1f} MB/s wall, {:8.1f} MB/s cpu".format(name, size / wall / 2**20, size / cpu / 2**20))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark body copying")
+    parser.add_argument('-n', dest="rounds", type=int, default=20)
+    parser.add_argument('--size', type=int, default=32 * 2**20, help="image size in bytes")
+    parser.add_argument('--chunk-size', dest="chunk_size", type=int, default=loader.CopyBufferSize)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(b'\0' * args.size, 0))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:{}/img/big.png".format(server.server_address[1])
+    pool = urllib3.PoolManager()
+    try:
+        run_method('copyfileobj', lambda r, f: shutil.copyfileobj(r, f, args.chunk_size), pool, url, args.rounds)
+        run_method('read+hash', lambda r, f: copy_read_hash(r, f, args.chunk_size), pool, url, args.rounds)
+        run_method('readinto', lambda r, f: copy_readinto(r, f, args.chunk_size), pool, url, args.rounds)
+        run_method('copy_hashed', lambda r, f: loader.copy_hashed(r, f, args.chunk_size), pool, url, args.rounds)
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+  bench_engines -- compare URLs/sec of the threaded and the asyncio engine
+
+  Starts a local HTTP server that serves a fixed fake image after a
+  configurable delay, and runs both engines against the same URL file.
+
+  Usage: python benchmarks/bench_engines.py [-n URLS] [--latency SECS] [--size BYTES]
+"""
+from __future__ import division, print_function, absolute_import
+
+import argparse
+import os
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from imageserver import PNG_SIGNATURE
+from image_loader import loader, aioloader
+
+
+def make_handler(body, latency):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            time.sleep(latency)
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/png')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+    return Handler
+
+
+def run_engine(name, load, urlfile, max_pending):
+    with tempfile.TemporaryDirectory() as outdir:
+        start = time.perf_counter()
+        summary = load(urlfile, outdir, True, max_pending)
+        elapsed = time.perf_counter() - start
+    count = sum(summary.values())
+    print("{:8} {:6d} urls in {:7.2f}s = {:8.1f} urls/sec ({})".format(
+        name, count, elapsed, count / elapsed, loader.format_summary(summary)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the download engines")
+    parser.add_argument('-n', dest="count", type=int, default=2000)
+    parser.add_argument('--latency', type=float, default=0.05, help="server delay per request")
+    parser.add_argument('--size', type=int, default=16 * 1024, help="image size in bytes")
+    parser.add_argument('--max-pending', dest="max_pending", type=int, default=500,
+                        help="in-flight limit for the asyncio engine")
+    args = parser.parse_args()
+
+    ThreadingHTTPServer.request_queue_size = 1024  # the default backlog of 5 resets bursts of connects
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(PNG_SIGNATURE + bytes(args.size - len(PNG_SIGNATURE)), args.latency))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = "http://127.0.0.1:{}".format(server.server_address[1])
+    with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as f:
+        f.write("".join("{}/img/{}.png\n".format(base, i) for i in range(args.count)))
+    try:
+        run_engine('threads', loader.load, f.name, loader.MaxPendingURLs)
+        run_engine('asyncio', aioloader.load, f.name, args.max_pending)
+    finally:
+        os.unlink(f.name)
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
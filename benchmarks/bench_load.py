@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+  bench_load -- end-to-end benchmark of load() against synthetic image hosts
+
+  Starts the hosts of :mod:`imageserver` in this process, and runs the
+  loader in a forked child process per round, so its peak RSS and CPU time
+  can be measured in isolation (server threads excluded). Reports URLs/sec,
+  MB/sec, peak RSS and CPU seconds as the median over the rounds.
+
+  The loader runtime params that load() takes as arguments can be
+  overridden with --param, e.g. --param MaxThreads=20 --param
+  MaxPendingURLs=80; others are bound at import and rejected. --adaptive
+  lets the loader tune its concurrency itself, up to that. Results can be saved
+  with --save and compared to a saved baseline with --baseline; the exit
+  code is 1 if any metric is worse than the baseline by more than the
+  tolerance.
+
+  Usage: python benchmarks/bench_load.py [-n URLS] [--hosts N] [--sizes SPEC]
+             [--latency SECS] [--not-modified RATIO] [--error-rate RATIO]
+             [--engine threads|asyncio] [--adaptive] [--rounds N] [--param NAME=VALUE]
+             [--save FILE] [--baseline FILE] [--tolerance RATIO]
+"""
+from __future__ import division, print_function, absolute_import
+
+import argparse
+import json
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+from imageserver import Behavior, ImageServer
+from image_loader import loader
+
+# metric -> True if higher is better
+Metrics = {'urls_per_sec': True, 'mb_per_sec': True, 'peak_rss_mb': False, 'cpu_secs': False}
+# loader runtime param -> argument of load() to pass its value as
+Params = {'MaxThreads': 'threads', 'MaxPendingURLs': 'max_pending', 'CopyBufferSize': 'chunk_size'}
+
+
+def param_spec(s):
+    "Parse NAME=VALUE for a loader runtime param of :data:`Params`"
+    name, _, value = s.partition('=')
+    if name not in Params or not value:
+        raise argparse.ArgumentTypeError("expected NAME=VALUE, NAME one of {}: {}".format(", ".join(Params), s))
+    return name, type(getattr(loader, name))(value)
+
+
+def run_child(args, urlfile, outdir):
+    "Run load() in the child process, and report its summary through a pipe"
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        status = 1
+        try:
+            logging.disable(logging.ERROR)  # failed urls are expected, with --error-rate
+            if args.engine == 'asyncio':
+                from image_loader import aioloader
+                load, max_pending = aioloader.load, aioloader.MaxPendingTasks
+            else:
+                load, max_pending = loader.load, loader.MaxPendingURLs
+            options = dict(max_pending=max_pending, retries=0, threads=loader.MaxThreads, adaptive=args.adaptive)
+            options.update((Params[name], value) for name, value in args.params)  # defaults are bound at import
+            if args.max_pending:
+                options['max_pending'] = args.max_pending
+            summary = load(urlfile, outdir, False, **options)
+            with os.fdopen(write_fd, 'w') as pipe:
+                json.dump(summary, pipe)
+            status = 0
+        finally:
+            os._exit(status)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as pipe:
+        output = pipe.read()
+    _, status, usage = os.wait4(pid, 0)
+    if status:
+        sys.exit("Loader run failed")
+    return json.loads(output), usage
+
+
+def run_round(args, server, urlfile):
+    server.behavior.reset()
+    with tempfile.TemporaryDirectory() as outdir:
+        start = time.perf_counter()
+        summary, usage = run_child(args, urlfile, outdir)
+        elapsed = time.perf_counter() - start
+    urls = sum(summary.values())
+    rss_scale = 1024 * 1024 if sys.platform == 'darwin' else 1024  # ru_maxrss is in bytes on macOS, else KiB
+    result = {
+        'urls_per_sec': urls / elapsed,
+        'mb_per_sec': server.behavior.bytes_sent / elapsed / 1e6,
+        'peak_rss_mb': usage.ru_maxrss * rss_scale / 1e6,
+        'cpu_secs': usage.ru_utime + usage.ru_stime,
+    }
+    print("  {:.2f}s, {}: {}".format(elapsed, loader.format_summary(summary), format_result(result)))
+    return result
+
+
+def format_result(result):
+    return "{urls_per_sec:8.1f} urls/s {mb_per_sec:7.2f} MB/s {peak_rss_mb:7.1f} MB RSS {cpu_secs:6.2f} CPU secs".format(
+        **result)
+
+
+def compare(result, baseline, tolerance):
+    "Print the change against baseline per metric; return True if none is worse than tolerance"
+    if baseline['config'] != result['config']:
+        print("Warning: the baseline was measured with a different configuration: {}".format(baseline['config']))
+    ok = True
+    for metric, higher_is_better in Metrics.items():
+        old, new = baseline['result'][metric], result['result'][metric]
+        change = (new - old) / old if old else 0
+        worse = -change if higher_is_better else change
+        verdict = "REGRESSION" if worse > tolerance else ""
+        ok = ok and not verdict
+        print("  {:14} {:10.2f} -> {:10.2f} {:+7.1%} {}".format(metric, old, new, change, verdict))
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark load() against synthetic image hosts")
+    parser.add_argument('-n', dest="count", type=int, default=5000, help="number of urls")
+    parser.add_argument('--hosts', type=int, default=4, help="number of hosts (Linux: 127.0.0.1 and up)")
+    parser.add_argument('--sizes', default='lognormal:24k:1', help="image size distribution")
+    parser.add_argument('--latency', type=float, default=0.02, help="server delay per request, in secs")
+    parser.add_argument('--not-modified', dest="not_modified", type=float, default=0.0,
+                        help="share of conditional requests answered with 304")
+    parser.add_argument('--error-rate', dest="error_rate", type=float, default=0.0,
+                        help="share of urls answered with 500")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--engine', choices=['threads', 'asyncio'], default='threads')
+    parser.add_argument('--max-pending', dest="max_pending", type=int)
+    parser.add_argument('--adaptive', action='store_true', help="let the loader adapt its concurrency")
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--param', dest="params", type=param_spec, action='append', default=[],
+                        metavar="NAME=VALUE",
+                        help="override a runtime param of image_loader.loader: {}".format(", ".join(Params)))
+    parser.add_argument('--save', metavar="FILE", help="save the result as a baseline")
+    parser.add_argument('--baseline', metavar="FILE", help="compare the result to a saved baseline")
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help="relative change of a metric that counts as a regression")
+    args = parser.parse_args()
+
+    config = {name: getattr(args, name) for name in
+              ('count', 'hosts', 'sizes', 'latency', 'not_modified', 'error_rate', 'seed', 'engine', 'max_pending',
+               'adaptive')}
+    config['params'] = dict(args.params)
+    behavior = Behavior(args.sizes, args.latency, args.not_modified, args.error_rate, args.seed)
+    with ImageServer(args.hosts, behavior) as server, \
+            tempfile.NamedTemporaryFile('w', suffix='.txt') as urlfile:
+        urlfile.write("".join(url + "\n" for url in server.urls(args.count)))
+        urlfile.flush()
+        print("{} rounds of {}".format(args.rounds, config))
+        rounds = [run_round(args, server, urlfile.name) for _ in range(args.rounds)]
+    result = {metric: statistics.median(r[metric] for r in rounds) for metric in Metrics}
+    print("median: {}".format(format_result(result)))
+    result = {'config': config, 'result': result, 'python': sys.version.split()[0]}
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print("compared to {}:".format(args.baseline))
+        if not compare(result, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
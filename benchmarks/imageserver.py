@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+  imageserver -- local stand-in for the image hosts, for benchmarks
+
+  Serves synthetic PNG images from one or more hosts (127.0.0.1, 127.0.0.2,
+  ... on Linux, where all of 127/8 is loopback). What a url gets is
+  derived from a hash of its path and the seed, so runs are reproducible:
+
+  - the body size, drawn from a size distribution,
+  - with probability <error_rate> a 500 answer instead of an image,
+  - with probability <not_modified> a 304 answer to a conditional request.
+
+  Every answer is delayed by <latency> seconds.
+
+  Size distributions are given as 'fixed:SIZE', 'uniform:MIN:MAX' or
+  'lognormal:MEDIAN:SIGMA', with sizes in bytes or with a k/m suffix.
+"""
+from __future__ import division, print_function, absolute_import
+
+import hashlib
+import math
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+MaxBodySize = 16 * 1024 * 1024
+
+
+def parse_size(s):
+    "Parse a size like 512, 16k or 2m"
+    units = {'k': 1024, 'm': 1024 * 1024}
+    s = s.strip().lower()
+    return int(float(s[:-1]) * units[s[-1]]) if s[-1] in units else int(s)
+
+
+def size_distribution(spec):
+    "Return a function mapping a random.Random to a body size, for spec; see the module docs"
+    kind, _, params = spec.partition(':')
+    params = params.split(':') if params else []
+    if kind == 'fixed' and len(params) == 1:
+        size = parse_size(params[0])
+        return lambda rng: size
+    elif kind == 'uniform' and len(params) == 2:
+        low, high = parse_size(params[0]), parse_size(params[1])
+        return lambda rng: rng.randint(low, high)
+    elif kind == 'lognormal' and len(params) == 2:
+        mu, sigma = math.log(parse_size(params[0])), float(params[1])
+        return lambda rng: int(rng.lognormvariate(mu, sigma))
+    raise ValueError("Invalid size distribution: {}".format(spec))
+
+
+class Behavior(object):
+    "What the hosts answer; shared by all of them"
+
+    def __init__(self, sizes='fixed:16k', latency=0.0, not_modified=0.0, error_rate=0.0, seed=0):
+        self.size_of = size_distribution(sizes)
+        self.latency = latency
+        self.not_modified = not_modified
+        self.error_rate = error_rate
+        self.seed = seed
+        self.body = memoryview(PNG_SIGNATURE + bytes(MaxBodySize - len(PNG_SIGNATURE)))
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.bytes_sent = 0
+
+    def answer(self, path, conditional):
+        "Return (status, body length) for a request of path"
+        rng = random.Random(hashlib.sha1('{}{}'.format(self.seed, path).encode('utf-8')).digest())
+        if rng.random() < self.error_rate:
+            return 500, 0
+        if conditional and rng.random() < self.not_modified:
+            return 304, 0
+        return 200, min(MaxBodySize, max(len(PNG_SIGNATURE), self.size_of(rng)))
+
+    def count(self, length):
+        with self.lock:
+            self.requests += 1
+            self.bytes_sent += length
+
+    def reset(self):
+        with self.lock:
+            self.requests = self.bytes_sent = 0
+
+
+def make_handler(behavior):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            if behavior.latency:
+                time.sleep(behavior.latency)
+            conditional = 'If-Modified-Since' in self.headers or 'If-None-Match' in self.headers
+            status, length = behavior.answer(self.path, conditional)
+            self.send_response(status)
+            if status == 200:
+                self.send_header('Content-Type', 'image/png')
+                self.send_header('ETag', '"{}"'.format(length))
+            self.send_header('Content-Length', str(length))
+            self.end_headers()
+            self.wfile.write(behavior.body[:length])
+            behavior.count(length)
+
+        def log_message(self, *args):
+            pass
+    return Handler
+
+
+class ImageServer(object):
+    """Synthetic image hosts, serving in background threads
+
+    Args:
+      hosts (int): number of hosts, on the loopback addresses 127.0.0.1 and up
+      behavior (:obj:`Behavior`): what they answer
+    """
+
+    def __init__(self, hosts=1, behavior=None):
+        self.behavior = behavior or Behavior()
+        ThreadingHTTPServer.request_queue_size = 1024  # the default backlog of 5 resets bursts of connects
+        self.servers = [ThreadingHTTPServer(('127.0.0.{}'.format(i + 1), 0), make_handler(self.behavior))
+                        for i in range(hosts)]
+        for server in self.servers:
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def bases(self):
+        return ["http://{}:{}".format(*server.server_address) for server in self.servers]
+
+    def urls(self, count):
+        "Return count urls, spread round-robin over the hosts"
+        bases = self.bases
+        return ["{}/img/{}.png".format(bases[i % len(bases)], i) for i in range(count)]
+
+    def close(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
@@ -15,6 +15,7 @@ from setuptools import setup
 entry_points = """
 [console_scripts]
 loader = image_loader.loader:run
+migrate-layout = image_loader.layout:run
 """
 
 
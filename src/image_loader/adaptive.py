@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+  adaptive -- concurrency that adapts to the servers during a run
+
+  An AIMD controller, as in TCP congestion control: after each window of
+  about <limit> finished requests, the number of requests in flight grows
+  by one, unless the window shows congestion, in which case it shrinks by
+  a factor. Congestion is a share of failed or throttled requests above a
+  threshold, or request latency well above the lowest latency seen so far;
+  by Little's law, once the servers or the network are saturated, more
+  concurrency only adds queueing delay, not throughput. The limit stays
+  within the bounds the operator sets.
+"""
+from __future__ import division, print_function, absolute_import
+
+import logging
+import threading
+import time
+
+from image_loader.metrics import NoRequestOutcomes
+
+# - runtime params -------------------------------------------------------------
+MinConcurrency = 2        # default lower bound of requests in flight
+MinWindow = 10            # fewest samples to adjust the limit on
+ErrorThreshold = 0.1      # share of failed or throttled requests that counts as congestion
+LatencyTolerance = 2.0    # latency over the baseline that counts as congestion
+DecreaseFactor = 0.75     # multiplicative decrease on congestion
+BaselineDrift = 1.05      # the latency baseline rises by this factor per window, to follow slow changes
+# - params end -----------------------------------------------------------------
+
+_logger = logging.getLogger(__name__)
+
+CongestionOutcomes = ('failed', 'throttled')
+
+
+class AdaptiveLimit(object):
+    """Limit of requests in flight between min_limit and max_limit, adapted
+       to the observed latency and error rate; safe to share between threads
+
+    Args:
+      initial (int): limit to start with; default min_limit
+    """
+
+    def __init__(self, min_limit, max_limit, initial=None):
+        assert 0 < min_limit <= max_limit, "Invalid concurrency bounds: {} to {}".format(min_limit, max_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = min(max_limit, max(min_limit, initial or min_limit))
+        self.lock = threading.Lock()
+        self.baseline = None  # lowest window latency seen, drifting up slowly
+        self.reset_window()
+
+    def reset_window(self):
+        self.samples = 0
+        self.congested = 0
+        self.latency = 0.0
+
+    def observe(self, secs, outcome):
+        "Account for a finished request, and adapt the limit after a full window"
+        if outcome in NoRequestOutcomes or not getattr(outcome, 'requested', True):  # no request made
+            return
+        with self.lock:
+            self.samples += 1
+            self.latency += secs
+            self.congested += outcome in CongestionOutcomes
+            if self.samples >= max(MinWindow, self.limit):
+                self.adapt()
+
+    def adapt(self):
+        latency = self.latency / self.samples
+        error_rate = self.congested / self.samples
+        if self.baseline is None:
+            self.baseline = latency
+        else:
+            self.baseline = min(self.baseline * BaselineDrift, latency)
+        old = self.limit
+        if error_rate > ErrorThreshold or latency > LatencyTolerance * self.baseline:
+            self.limit = max(self.min_limit, int(self.limit * DecreaseFactor))
+        else:
+            self.limit = min(self.max_limit, self.limit + 1)
+        if self.limit != old:
+            _logger.debug("Concurrency {} -> {}: latency {:.3f}s (baseline {:.3f}s), {:.0%} failed".format(
+                old, self.limit, latency, self.baseline, error_rate))
+        self.reset_window()
+
+    def measure(self, func, url):
+        "Call func(url), observing its latency and outcome"
+        start, outcome = time.perf_counter(), 'failed'
+        try:
+            outcome = func(url)
+            return outcome
+        finally:
+            self.observe(time.perf_counter() - start, outcome)
+
+    async def measure_async(self, func, url):
+        "Await func(url), observing its latency and outcome"
+        start, outcome = time.perf_counter(), 'failed'
+        try:
+            outcome = await func(url)
+            return outcome
+        finally:
+            self.observe(time.perf_counter() - start, outcome)
+
+
+def pending_limit(max_pending, limiter=None):
+    "Return the number of requests that may be in flight now"
+    return max_pending if limiter is None else min(max_pending, limiter.limit)
@@ -0,0 +1,511 @@
+# -*- coding: utf-8 -*-
+"""
+  aioloader -- asyncio download engine for the image loader
+
+  Keeps thousands of downloads in flight on a single event loop, instead of
+  one blocking thread per download. Requires the optional ``aiohttp`` package
+  (``pip install image_loader[async]``).
+"""
+from __future__ import division, print_function, absolute_import
+
+import asyncio
+import hashlib
+import itertools
+import logging
+import os
+import socket
+from collections import Counter
+from contextlib import asynccontextmanager
+from functools import partial
+
+from image_loader.adaptive import MinConcurrency, pending_limit
+from image_loader.health import MaxRetries, BreakerThreshold, RetryStatuses, backoff_delay, retry_after_secs
+from image_loader.loader import (CopyBufferSize, ConnectTimeoutSecs, ReadTimeoutSecs, ThrottleStatuses, assert_destdir,
+                                 body_span, check_length, close_journal, close_postprocessor, close_stream,
+                                 format_summary, get_out_file, get_url_iter, hash_prefix, identity_encoded, is_image,
+                                 is_real_string, open_health, open_index, open_journal, open_limiter, open_metrics,
+                                 open_postprocessor, open_store, open_unique, record_download, record_fresh,
+                                 record_partial, request_headers, resume_validator, skip_fresh, submit_postprocess,
+                                 tally, url_lines, url_server)
+from image_loader.ingest import detect_format, url_hints
+from image_loader.ledger import RunActive
+from image_loader.layout import make_dirs
+from image_loader.metrics import Result, mark, note
+from image_loader.resolve import Resolver, look_ahead
+from image_loader.scheduler import LookaheadFactor
+from image_loader.storage import open_output, commit_output, discard_output, keep_output, drop_resume
+from image_loader.validate import ValidationError, SniffBytes, check_head, check_size
+
+try:
+    import aiohttp
+except ImportError:  # optional dependency, checked in load()
+    aiohttp = None
+
+# - runtime params -------------------------------------------------------------
+MaxPendingTasks = 1000  # downloads in flight on the event loop
+# - params end -----------------------------------------------------------------
+
+_logger = logging.getLogger(__name__)
+
+
+async def read_head(response, size):
+    "Read at least <size> bytes of the body, unless it is shorter"
+    head = b''
+    while len(head) < size:
+        chunk = await response.content.read(size - len(head))
+        if not chunk:
+            break
+        head += chunk
+    return head
+
+
+async def copy_hashed(response, out_file, chunk_size=CopyBufferSize, head=b'', max_size=None, digest=None,
+                      offset=0):
+    """Copy the response body to out_file; return its length and sha256 hex digest
+
+    Args:
+      head (bytes): body bytes already read from the response
+      max_size (int): raise :class:`ValidationError` once the body exceeds this
+      digest: sha256 digest object of the first <offset> bytes of the file,
+        when resuming a partial download
+      offset (int): bytes of the file written before the body
+    """
+    digest = digest or hashlib.sha256()
+    digest.update(head)
+    out_file.write(head)
+    length = offset + len(head)
+    async for chunk in response.content.iter_chunked(chunk_size):
+        length += len(chunk)
+        check_size(length, max_size, str(response.url))
+        digest.update(chunk)
+        out_file.write(chunk)  # local disk writes are not worth an executor round trip
+    return length, digest.hexdigest()
+
+
+async def process_incoming(response, outdir, store=None, chunk_size=CopyBufferSize, max_size=None, fanout=0,
+                           name=None):
+    """Process data from web request; see :func:`image_loader.loader.process_incoming`
+
+    Returns:
+      (int, str): length and sha256 hex digest of the written image, or
+      None if nothing has been written
+    """
+    if not is_image(response.headers.get('Content-Type')):
+        _logger.error("Apparently not an image file, skipping: %s", response.url, extra={'url': str(response.url)})
+        note(error="Not an image: Content-Type {}".format(response.headers.get('Content-Type')))
+        return None
+    else:
+        file_name = get_out_file(str(response.url), outdir, fanout, name)
+        try:
+            offset, length = body_span(response.status, response.headers, str(response.url))
+            check_size(length, max_size, str(response.url))
+            head = b''
+            if not offset:  # the kept part of a resumed download has been checked before
+                head = await read_head(response, SniffBytes)
+                check_head(head, str(response.url))
+        except ValidationError as e:
+            _logger.error("%s, skipping", e, extra={'url': str(response.url)})
+            note(error=str(e))
+            drop_resume(file_name)
+            response.close()  # rather than reading the rest of the body
+            return None
+        if fanout:
+            make_dirs(os.path.dirname(file_name))
+        out_file = open_output(file_name, length, store, offset, max_size)
+        if out_file is None:
+            return None
+        if out_file.tell() != offset:
+            _logger.error("Partial download to resume is gone, skipping: %s", response.url,
+                          extra={'url': str(response.url)})
+            discard_output(out_file)
+            response.close()
+            return None
+        _logger.info("Downloading image: %s%s", response.url, " from byte {}".format(offset) if offset else "",
+                     extra={'url': str(response.url)})
+        try:
+            digest = hash_prefix(out_file, offset, chunk_size) if offset else None
+            written = await copy_hashed(response, out_file, chunk_size, head, max_size, digest, offset)
+            check_length(written[0], length if identity_encoded(response.headers) else None, str(response.url))
+            mark('transfer')
+        except ValidationError as e:
+            _logger.error("%s, skipping", e, extra={'url': str(response.url)})
+            note(error=str(e))
+            discard_output(out_file)
+            response.close()
+            return None
+        except BaseException:
+            if store is None:
+                keep_output(out_file, file_name, resume_validator(response.headers))
+            else:
+                discard_output(out_file)
+            raise
+        commit_output(out_file, file_name, written[1], store)
+        mark('commit')
+        note(length=written[0], path=file_name, digest=written[1])
+        return written
+
+
+async def fetch_response(session, url, headers, health=None, retries=0):
+    """Request url, retrying transient failures; see :func:`image_loader.loader.fetch_response`
+
+    Returns:
+      :obj:`aiohttp.ClientResponse`: the final response, with the body not
+      read yet, or None if health reports the host as down
+    """
+    host = url_server(url)
+    for attempt in itertools.count():
+        if health is not None and not health.allow(host):
+            return None
+        response = retry_after = None
+        try:
+            response = await session.get(url, headers=headers, allow_redirects=True)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            failure = e
+        else:
+            if response.status not in RetryStatuses:
+                if health is not None:
+                    health.success(host)
+                return response
+            failure, retry_after = response.status, retry_after_secs(response.headers.get('Retry-After'))
+        if health is not None:
+            health.failure(host)
+        delay = backoff_delay(attempt, retry_after) if attempt < retries else None
+        if delay is None:
+            if response is None:
+                raise failure
+            return response
+        if response is not None:
+            response.release()
+        _logger.info("Retrying url in %.1fs: %s - error: %r", delay, url, failure, extra={'url': url})
+        await asyncio.sleep(delay)
+
+
+async def download_url(session, url, outdir, force, index=None, store=None, chunk_size=CopyBufferSize,
+                       max_size=None, fanout=0, health=None, retries=0, min_ttl=0):
+    """Make the web request; same semantics as :func:`image_loader.loader.download_url`
+
+    Returns:
+      str: outcome of the request, one of 'downloaded', 'fresh', 'skipped',
+      'throttled' or 'failed', or 'deferred' while the host is down; None for
+      empty url lines
+    """
+    name, etag = url_hints(url)
+    url = url.strip()
+    if not is_real_string(url):
+        return None
+    else:
+        headers = request_headers(url, outdir, force, index, fanout, store is None, name, etag)
+        if headers is None:
+            return skip_fresh(url, outdir, fanout, name)
+        response = await fetch_response(session, url, headers, health, retries)
+        if response is not None and response.status == 416 and 'Range' in headers:
+            _logger.info("Cannot resume, downloading anew: %s", url, extra={'url': url})
+            response.release()
+            drop_resume(get_out_file(url, outdir, fanout, name))
+            response = await fetch_response(session, url,
+                                            request_headers(url, outdir, force, index, fanout, name=name) or {},
+                                            health, retries)
+        mark('request')
+        if response is None:
+            return health.blocked_outcome(url)
+        note(status=response.status)
+        async with response:
+            if response.status in (200, 206):
+                try:
+                    written = await process_incoming(response, outdir, store, chunk_size, max_size, fanout, name)
+                except BaseException:
+                    if store is None:
+                        record_partial(index, url, get_out_file(url, outdir, fanout, name))
+                    raise
+                record_download(index, url, response, written, min_ttl)
+                return 'downloaded' if written else 'skipped'
+            elif response.status == 304:
+                _logger.info("Local copy of url is fresh: %s", url, extra={'url': url})
+                note(path=get_out_file(url, outdir, fanout, name))
+                record_fresh(index, url, response, min_ttl)
+                return 'fresh'
+            elif response.status in ThrottleStatuses:
+                _logger.error("Server asks to slow down, skipping url: %s - error: %s - %s", url, response.status,
+                              response.reason, extra={'url': url})
+                note(error="{} {}".format(response.status, response.reason))
+                return 'throttled'
+            else:
+                _logger.error("Unable to download url: %s - error: %s - %s", url, response.status, response.reason,
+                              extra={'url': url})
+                note(error="{} {}".format(response.status, response.reason))
+                return 'failed'
+
+
+async def get_outcome(url, coro):
+    "Await a download, logging failures instead of propagating them"
+    try:
+        return await coro
+    except Exception as e:
+        _logger.error("Unable to download url: %s - error: %r", url.strip(), e, extra={'url': url.strip()})
+        return Result('failed', url, error=repr(e))
+
+
+class CachedResolver(object):
+    "An aiohttp resolver taking the addresses of hosts from an :class:`image_loader.resolve.Resolver`"
+
+    def __init__(self, resolver):
+        self.resolver = resolver
+
+    async def resolve(self, host, port=0, family=socket.AF_INET):
+        addresses = self.resolver.cached(host)
+        if addresses is None:  # not resolved ahead, or still under way
+            addresses = await asyncio.get_running_loop().run_in_executor(None, self.resolver.lookup, host)
+        return [dict(hostname=host, host=address, port=port, family=address_family, proto=proto,
+                     flags=socket.AI_NUMERICHOST | socket.AI_NUMERICSERV)
+                for address_family, proto, address in addresses if family in (socket.AF_UNSPEC, address_family)]
+
+    async def close(self):
+        pass
+
+
+async def iter_async(urls):
+    "Yield the non-empty urls of urls, an iterable or an async iterable"
+    if hasattr(urls, '__aiter__'):
+        async for url in urls:
+            if is_real_string(url):
+                yield url
+    else:
+        for url in urls:
+            if is_real_string(url):
+                yield url
+
+
+@asynccontextmanager
+async def aclosing(agen):
+    "Close the async generator agen when done, like contextlib.aclosing of Python 3.10"
+    try:
+        yield agen
+    finally:
+        await agen.aclose()
+
+
+async def cancel_pending(pending):
+    "Cancel the tasks of a submit function closed early, and wait for them to clean up"
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+
+
+async def submit_bounded(start, urls, max_pending, limiter=None):
+    """Start a task with start(url) for each of the async iterable urls, with
+       at most <max_pending> unfinished tasks, or fewer as limiter allows.
+       Yields (url, outcome) pairs in order of completion."""
+    pending = {}
+    try:
+        async for url in urls:
+            while len(pending) >= pending_limit(max_pending, limiter):
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield pending.pop(task), task.result()
+            pending[start(url)] = url
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield pending.pop(task), task.result()
+    finally:
+        await cancel_pending(pending)
+
+
+async def submit_scheduled(scheduler, start, urls, max_pending, limiter=None):
+    """Like submit_bounded, but start urls in host batches and within the host
+       limits of scheduler; see :meth:`image_loader.scheduler.HostScheduler.submit`"""
+    lookahead = scheduler.lookahead or LookaheadFactor * max_pending
+    exhausted = False
+    pending = {}
+    try:
+        while True:
+            while not exhausted and len(scheduler) < lookahead:
+                try:
+                    scheduler.put(await urls.__anext__())
+                except StopAsyncIteration:
+                    exhausted = True
+            delay = None
+            while len(pending) < pending_limit(max_pending, limiter):
+                url, delay = scheduler.get()
+                if url is None:
+                    break
+                pending[start(url)] = url
+            if not pending:
+                if delay is None:
+                    return
+                await asyncio.sleep(delay)
+                continue
+            done, _ = await asyncio.wait(pending, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                url = pending.pop(task)
+                scheduler.task_done(url, task.result())
+                yield url, task.result()
+    finally:
+        await cancel_pending(pending)
+        scheduler.abandon(pending.values())
+
+
+async def stream(urls, destdir, force=False, max_pending=MaxPendingTasks, scheduler=None, use_index=False,
+                 dedup=None, chunk_size=CopyBufferSize, max_size=None, fanout=0, retries=MaxRetries,
+                 breaker=BreakerThreshold, metrics_json=None, metrics_prom=None, hooks=None, threads=None,
+                 connections=None, pools=None, adaptive=False, min_concurrency=MinConcurrency, min_ttl=0,
+                 verify=None, resize=None, convert=None, post_workers=None, shard=None, resolve_ahead=0,
+                 prewarm=False, progress=0):
+    """Download the images of urls into destdir, yielding a
+       :class:`image_loader.metrics.Result` per url in order of completion;
+       the asyncio version of :func:`image_loader.loader.stream`
+
+    urls can be an iterable or an async iterable, e.g. a message queue
+    consumer. Closing the generator with aclose(), or cancelling the task
+    iterating over it, cancels the downloads in flight; their partial files
+    are dealt with as if the connection broke off. The remaining arguments
+    are those of :func:`load`. Post-processing jobs are handed over from a
+    thread, since that blocks while too many of them are pending. Hosts are
+    resolved ahead only for urls of a plain iterable.
+    """
+    if aiohttp is None:
+        raise RuntimeError("The asyncio engine requires aiohttp: pip install image_loader[async]")
+    assert max_pending > 0, "Need at least one pending slot: {}".format(max_pending)
+    assert_destdir(destdir)
+    processor = open_postprocessor(verify, resize, convert, post_workers)
+    index = open_index(destdir, use_index)
+    health = open_health(breaker)
+    limiter = open_limiter(adaptive, min_concurrency, max_pending)
+    metrics = open_metrics(metrics_json, metrics_prom, hooks, shard, progress)
+    resolver = Resolver(family=socket.AF_UNSPEC) if resolve_ahead else None
+    if resolver is not None and not hasattr(urls, '__aiter__'):
+        urls = look_ahead(filter(is_real_string, urls), resolve_ahead, resolver=resolver)
+    loop = asyncio.get_running_loop()
+
+    async def post(result):
+        if processor is not None and result == 'downloaded':
+            await loop.run_in_executor(None, submit_postprocess, processor, result, destdir, index)
+    try:
+        connector = aiohttp.TCPConnector(limit=max_pending, limit_per_host=connections or 0,
+                                         resolver=resolver and CachedResolver(resolver),
+                                         use_dns_cache=resolver is None)
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=ConnectTimeoutSecs, sock_read=ReadTimeoutSecs)
+        # ask for bodies as is, like urllib3 does; those encoded anyway are decoded by aiohttp
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout,
+                                         headers={'Accept-Encoding': 'identity'}) as session:
+            fetch = partial(download_url, session, outdir=destdir, force=force, index=index,
+                            store=open_store(destdir, dedup), chunk_size=chunk_size, max_size=max_size,
+                            fanout=fanout, health=health, retries=retries, min_ttl=min_ttl)
+            fetch = partial(metrics.measure_async, fetch)
+            if limiter is not None:
+                fetch = partial(limiter.measure_async, fetch)
+
+            def start(url):
+                return asyncio.ensure_future(get_outcome(url, fetch(url)))
+            def submit(urls):
+                if scheduler is not None:  # an empty one is falsy
+                    return aclosing(submit_scheduled(scheduler, start, iter_async(urls), max_pending, limiter))
+                else:
+                    return aclosing(submit_bounded(start, iter_async(urls), max_pending, limiter))
+            deferred = []
+            async with submit(urls) as done:
+                async for url, result in done:
+                    if result == 'deferred':
+                        deferred.append(url)
+                    else:
+                        await post(result)
+                        yield result
+            if deferred:
+                _logger.info("Requesting {} deferred urls of hosts that were down".format(len(deferred)))
+                health.final_pass()
+                async with submit(deferred) as done:
+                    async for url, result in done:
+                        await post(result)
+                        yield result
+    finally:
+        if resolver is not None:
+            resolver.close()
+        close_postprocessor(processor)
+        close_stream(index, metrics)
+
+
+def load(urlfile, destdir, force, max_pending=MaxPendingTasks, shard=None, scheduler=None, use_index=False,
+         dedup=None, chunk_size=CopyBufferSize, max_size=None, resume=False, retry_failed=False,
+         unique_urls=None, fanout=0, retries=MaxRetries, breaker=BreakerThreshold, metrics_json=None,
+         metrics_prom=None, hooks=None, threads=None, connections=None, pools=None, adaptive=False,
+         min_concurrency=MinConcurrency, min_ttl=0, verify=None, resize=None, convert=None, post_workers=None,
+         input_format=None, resolve_ahead=0, prewarm=False, overlap=None, progress=0):
+    """Download images with URLs from file into destdir, using the asyncio engine; see :func:`stream`
+
+    Args:
+      shard ((int, int)): only download urls of shard (index, count)
+      scheduler (:obj:`image_loader.scheduler.HostScheduler`): start urls
+        grouped by host and within per-host limits, instead of in file order
+      use_index (bool): check freshness against the metadata index in destdir,
+        instead of the mtime of local files
+      dedup (str): 'hardlink' or 'symlink' to store each distinct image once
+        and link it into destdir; None to write plain files
+      chunk_size (int): bytes per read from the network
+      max_size (int): skip images larger than this many bytes; None for no limit
+      resume (bool): keep a progress journal in destdir, and skip the urls an
+        interrupted earlier run has finished according to it
+      retry_failed (bool): when resuming, request urls that failed again
+      unique_urls (str): 'exact' or 'bloom' to normalize urls and skip
+        duplicates, see :mod:`image_loader.unique`; None to take urls as they are
+      fanout (int): store images in this many levels of subdirectories of
+        destdir, see :mod:`image_loader.layout`; 0 to store them flat
+      retries (int): retries of a url after transient failures
+      breaker (int): consecutive failures after which a host is considered
+        down, and its remaining urls are deferred; 0 to keep trying all urls
+      metrics_json (str): file to write run metrics to as JSON
+      metrics_prom (str): file to write run metrics to in Prometheus text format
+      hooks ([callable]): called with the :class:`image_loader.metrics.Probe`
+        of every finished url
+      threads, pools: ignored; there are no threads or per-host pools here
+      connections (int): connections per host; None for no limit
+      adaptive (bool): adapt the number of concurrent downloads between
+        min_concurrency and max_pending to the servers' latency and error
+        rate, see :mod:`image_loader.adaptive`
+      min_ttl (int): with use_index, do not request a downloaded url again for
+        this many secs, or as long as its Cache-Control or Expires header
+        allows if that is longer
+      verify, resize, convert, post_workers: post-processing of downloaded
+        images in worker processes, see :func:`image_loader.loader.load`
+      input_format (str): 'lines', 'jsonl' or 'csv'; None to tell by the
+        file name extension
+      resolve_ahead (int): resolve the hosts of this many urls ahead of the
+        downloads, and cache their addresses, instead of aiohttp's DNS cache
+      prewarm: ignored; aiohttp opens connections as tasks need them
+      overlap (str): 'exit' or 'share' the url file when another run over it
+        is active, see :func:`image_loader.loader.load`
+      progress (float): log the counts of outcomes so far every this many secs;
+        0 for only at the end
+
+    Returns:
+      :obj:`collections.Counter`: number of urls per outcome
+    """
+    if aiohttp is None:
+        raise RuntimeError("The asyncio engine requires aiohttp: pip install image_loader[async]")
+    assert_destdir(destdir)
+    try:
+        journal = open_journal(destdir, urlfile, shard, resume, overlap)
+    except RunActive as e:
+        _logger.warning("{}, exiting".format(e))
+        return Counter()
+    unique = open_unique(unique_urls)
+    summary = Counter()
+
+    async def run(urls):
+        async for result in stream(urls, destdir, force, max_pending, scheduler, use_index, dedup, chunk_size,
+                                   max_size, fanout, retries, breaker, metrics_json, metrics_prom, hooks, threads,
+                                   connections, pools, adaptive, min_concurrency, min_ttl, verify, resize, convert,
+                                   post_workers, shard, resolve_ahead, prewarm, progress):
+            tally(summary, journal, result.url, result.outcome)
+    try:
+        with get_url_iter(urlfile) as url_file:
+            asyncio.run(run(url_lines(url_file, shard, journal, retry_failed, unique,
+                                      detect_format(urlfile, input_format))))
+    except BaseException:
+        close_journal(journal, complete=False)
+        raise
+    else:
+        close_journal(journal, complete=True)
+    if unique is not None:
+        summary.update(unique.counts)
+    _logger.info("Finished: {}".format(format_summary(summary)))
+    return summary
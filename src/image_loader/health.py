@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+  health -- retries and circuit breaking per host
+
+  Transient failures (connection errors, timeouts, 429 and 5xx answers) are
+  retried after an exponentially growing, jittered delay, or after the delay
+  a Retry-After header asks for. A host failing <threshold> times in a row
+  is considered down: its circuit opens, and the rest of its urls are
+  deferred to the end of the run without tying up a worker. Once the circuit
+  has been open for a while, a single probe request may pass; if it
+  succeeds, the circuit closes again. The deferred urls are requested in a
+  final pass; if their host fails once more, they fail fast.
+"""
+from __future__ import division, print_function, absolute_import
+
+import email.utils
+import logging
+import random
+import threading
+import time
+from collections import Counter
+
+# - runtime params -------------------------------------------------------------
+MaxRetries = 2            # retries per url after a transient failure
+BackoffBaseSecs = 1       # delay before the first retry; doubles with every retry
+BackoffMaxSecs = 30       # longest delay to wait for a retry, incl. Retry-After
+BreakerThreshold = 5      # consecutive failures after which a host counts as down
+BreakerOpenSecs = 60      # time before a host that is down gets probed again
+RetryStatuses = (429, 500, 502, 503, 504)
+# - params end -----------------------------------------------------------------
+
+_logger = logging.getLogger(__name__)
+
+
+def retry_after_secs(value, now=None):
+    "Return the seconds a Retry-After header value (secs or HTTP date) asks to wait, or None"
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0, date.timestamp() - (time.time() if now is None else now))
+
+
+def backoff_delay(attempt, retry_after=None):
+    """Return the seconds to wait before retry number attempt (0-based), or
+       None if the server asks to wait longer than :data:`BackoffMaxSecs`"""
+    if retry_after is not None:
+        return retry_after if retry_after <= BackoffMaxSecs else None
+    delay = min(BackoffMaxSecs, BackoffBaseSecs * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)  # jitter, so retries of many urls do not line up
+
+
+class HostHealth(object):
+    """Circuit breakers for all hosts of a run, safe to share between threads
+
+    Args:
+      threshold (int): consecutive failures after which a host is down
+      open_secs (float): time until a host that is down gets probed again
+    """
+
+    def __init__(self, threshold=BreakerThreshold, open_secs=BreakerOpenSecs, clock=time.monotonic):
+        assert threshold > 0, "Need at least one failure to open a circuit: {}".format(threshold)
+        self.threshold = threshold
+        self.open_secs = open_secs
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.failures = Counter()  # host -> consecutive failures
+        self.opened = {}           # host -> time its circuit opened, or was last probed
+        self.deferring = True      # False in the final pass
+
+    def allow(self, host):
+        "Return True if a request to host may go out now"
+        with self.lock:
+            if host not in self.opened:
+                return True
+            if self.clock() - self.opened[host] >= self.open_secs:
+                self.opened[host] = self.clock()  # one probe, then wait again
+                _logger.info("Probing host that was down: {}".format(host))
+                return True
+            return False
+
+    def blocked_outcome(self, url):
+        "Return the outcome of a url whose host is down: 'deferred', or 'failed' in the final pass"
+        if self.deferring:
+            _logger.debug("Host is down, deferring url: %s", url, extra={'url': url})
+            return 'deferred'
+        _logger.error("Host is down, skipping url: %s", url, extra={'url': url})
+        return 'failed'
+
+    def success(self, host):
+        with self.lock:
+            self.failures.pop(host, None)
+            if self.opened.pop(host, None) is not None:
+                _logger.info("Host is up again: {}".format(host))
+
+    def failure(self, host):
+        with self.lock:
+            self.failures[host] += 1
+            if self.failures[host] >= self.threshold:
+                if host not in self.opened:
+                    _logger.error("Host failed {} times in a row, considering it down: {}".format(
+                        self.failures[host], host))
+                self.opened[host] = self.clock()
+
+    def final_pass(self):
+        """Give hosts that are down another chance, for the deferred urls: one more
+           failure takes them down again, and their urls fail fast from then on"""
+        with self.lock:
+            for host in self.opened:
+                self.failures[host] = self.threshold - 1
+            self.opened.clear()
+            self.deferring = False
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+  index -- persistent metadata of downloaded images
+
+  Records the validators the server sent for each url (ETag, Last-Modified)
+  together with size and content hash of the local copy, in an sqlite
+  database in the output directory. Freshness checks then neither stat the
+  local files nor trust their mtime.
+
+  The index also records until when a local copy is fresh, from the
+  Cache-Control max-age or Expires header of the response, but for at least
+  a given minimum TTL. Until then, the url is not requested at all; a 304
+  answer extends the lifetime again.
+
+  When a download breaks off and its partial file is kept to resume, the
+  entry of its url says so, so only those urls have their partial files
+  looked for.
+"""
+from __future__ import division, print_function, absolute_import
+
+import email.utils
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+# - runtime params -------------------------------------------------------------
+IndexFileName = '.image_loader.db'
+FlushEvery = 1000  # buffered entries per write transaction
+# - params end -----------------------------------------------------------------
+
+_logger = logging.getLogger(__name__)
+
+Entry = namedtuple('Entry', 'etag last_modified length digest expires partial')
+# expires: epoch secs until which the local copy is fresh; partial: a partial download is kept to resume
+Entry.__new__.__defaults__ = (None, False)
+
+
+def index_path(destdir):
+    "Return the path of the index for output directory destdir"
+    return os.path.join(destdir, IndexFileName)
+
+
+class MetadataIndex(object):
+    """Url metadata store, safe to share between threads. Writes are
+       buffered and committed in batches of <flush_every> entries."""
+
+    def __init__(self, path, flush_every=FlushEvery):
+        self.path = path
+        self.flush_every = flush_every
+        self.lock = threading.Lock()
+        self.buffer = {}
+        # several processes (--workers, overlapping runs) may share the file
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS entries ("
+                        "url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, length INTEGER, digest TEXT, "
+                        "expires REAL, partial INTEGER)")
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(entries)")]
+        for column, kind in (('expires', 'REAL'), ('partial', 'INTEGER')):
+            if column not in columns:  # index of an older version
+                self.db.execute("ALTER TABLE entries ADD COLUMN {} {}".format(column, kind))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get(self, url):
+        "Return the :obj:`Entry` for url, or None"
+        with self.lock:
+            if url in self.buffer:
+                return self.buffer[url]
+            row = self.db.execute("SELECT etag, last_modified, length, digest, expires, partial FROM entries "
+                                  "WHERE url = ?", (url,)).fetchone()
+        return Entry(*row[:5], partial=bool(row[5])) if row else None
+
+    def put(self, url, entry):
+        with self.lock:
+            self.buffer[url] = entry
+            if len(self.buffer) >= self.flush_every:
+                self.flush_locked()
+
+    def forget(self, url):
+        "Drop the entry for url, e.g. when its local copy turned out to be corrupt"
+        self.put(url, None)
+
+    def flush(self):
+        with self.lock:
+            self.flush_locked()
+
+    def flush_locked(self):
+        if self.buffer:
+            with self.db:  # one transaction per batch
+                self.db.execute("BEGIN")
+                self.db.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                    ((url,) + tuple(entry) for url, entry in self.buffer.items() if entry))
+                self.db.executemany("DELETE FROM entries WHERE url = ?",
+                                    ((url,) for url, entry in self.buffer.items() if entry is None))
+            self.buffer.clear()
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+
+def http_date(value):
+    "Return the epoch secs of an HTTP date header value, or None if it is missing or invalid"
+    try:
+        return email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def freshness_lifetime(headers):
+    """Return the secs a response stays fresh from now on, by its Cache-Control
+       max-age, or else its Expires relative to its Date; None if it does not say.
+       no-store and no-cache, as well as an invalid Expires, count as 0."""
+    directives = {}
+    for directive in (headers.get('Cache-Control') or '').split(','):
+        name, _, value = directive.partition('=')
+        directives[name.strip().lower()] = value.strip().strip('"')
+    if 'no-store' in directives or 'no-cache' in directives:
+        return 0
+    if 'max-age' in directives:
+        try:
+            lifetime = int(directives['max-age'])
+        except ValueError:
+            return 0
+    elif headers.get('Expires') is not None:
+        expires = http_date(headers.get('Expires'))
+        if expires is None:
+            return 0  # e.g. 'Expires: 0' means expired already
+        lifetime = expires - (http_date(headers.get('Date')) or time.time())
+    else:
+        return None
+    try:
+        lifetime -= int(headers.get('Age') or 0)  # time spent in caches on the way
+    except ValueError:
+        pass
+    return max(0, lifetime)
+
+
+def expiry(headers, min_ttl=0, now=None):
+    """Return the epoch secs until which a response is fresh, see
+       :func:`freshness_lifetime`, but for at least min_ttl secs; None if not at all"""
+    lifetime = max(freshness_lifetime(headers) or 0, min_ttl or 0)
+    return (time.time() if now is None else now) + lifetime if lifetime else None
+
+
+def is_fresh(entry, now=None):
+    "Check if the local copy of an entry is fresh still, so its url need not be requested"
+    return entry.expires is not None and (time.time() if now is None else now) < entry.expires
+
+
+def make_entry(headers, length, digest, min_ttl=0):
+    """Build an :obj:`Entry` from response headers and the written content.
+       Without Last-Modified, the server's Date is the best guess for If-Modified-Since."""
+    return Entry(headers.get('ETag'), headers.get('Last-Modified') or headers.get('Date'), length, digest,
+                 expiry(headers, min_ttl))
+
+
+def conditional_headers(entry):
+    "Return the validating request headers for a known entry"
+    headers = {}
+    if entry.etag:
+        headers['If-None-Match'] = entry.etag
+    if entry.last_modified:
+        headers['If-Modified-Since'] = entry.last_modified
+    return headers
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+  ingest -- reading url files
+
+  Url files may be plain files, gzip (.gz) or zstd (.zst) compressed files,
+  which are decompressed while they are read, or '-' for standard input.
+  Plain files are memory-mapped and scanned for newlines, without a copy
+  into a read buffer. Only when their byte offsets are needed, for the
+  journal or watch mode, are lines wrapped in :class:`UrlLine`; creating
+  those objects costs several times more than scanning itself.
+
+  Besides one url per line, url files may be in JSON lines (.jsonl,
+  .ndjson) or CSV (.csv) format, which carry per-url hints:
+
+    {"url": "http://example.com/a.jpg?id=1", "name": "a1.jpg", "etag": "\"x\""}
+    http://example.com/a.jpg?id=1,a1.jpg
+
+  name is the local file name, instead of the last path segment of the url;
+  etag is the ETag the image is known to have, so it is not requested again
+  if the metadata index has that ETag for the url already. CSV columns are
+  url, name and etag in this order; a first line starting with 'url' is
+  taken as header. CSV records cannot span lines.
+"""
+from __future__ import division, print_function, absolute_import
+
+import csv
+import gzip
+import io
+import json
+import logging
+import mmap
+import os
+import sys
+
+try:
+    import zstandard
+except ImportError:  # optional dependency, checked in open_url_file()
+    zstandard = None
+
+# - runtime params -------------------------------------------------------------
+ReadBufferSize = 1024 * 1024  # bytes per read from a decompressor
+# - params end -----------------------------------------------------------------
+
+Formats = {'.jsonl': 'jsonl', '.ndjson': 'jsonl', '.csv': 'csv'}  # by file name extension
+Compressions = ('.gz', '.zst')
+
+_logger = logging.getLogger(__name__)
+
+
+class UrlLine(str):
+    "A line of the url file, knowing its byte <offset> and the <end> offset of the line"
+
+    def __new__(cls, line, offset, end):
+        self = str.__new__(cls, line)
+        self.offset = offset
+        self.end = end
+        return self
+
+    def relabel(self, text):
+        "Return a copy of this line with text instead, keeping offsets and hints"
+        line = str.__new__(type(self), text)
+        line.__dict__.update(self.__dict__)
+        return line
+
+
+class UrlRecord(UrlLine):
+    "A url of a JSON lines or CSV url file, with its hints <name> and <etag>, which may be None"
+
+    def __new__(cls, url, offset=None, end=None, name=None, etag=None):
+        self = UrlLine.__new__(cls, url, offset, end)
+        self.name = name
+        self.etag = etag
+        return self
+
+
+def url_hints(url):
+    "Return (name, etag) hints of a url, which are None unless it is a :class:`UrlRecord`"
+    return getattr(url, 'name', None), getattr(url, 'etag', None)
+
+
+def is_stdin(fpath):
+    return fpath == '-'
+
+
+def is_compressed(fpath):
+    return fpath.endswith(Compressions)
+
+
+def open_url_file(fpath):
+    "Open the url file at fpath for binary reading; see the module docs"
+    if is_stdin(fpath):
+        return open(sys.stdin.fileno(), 'rb', closefd=False)
+    if fpath.endswith('.gz'):
+        return gzip.open(fpath, 'rb')
+    if fpath.endswith('.zst'):
+        if zstandard is None:
+            raise RuntimeError("Reading .zst url files requires zstandard: pip install image_loader[zstd]")
+        reader = zstandard.ZstdDecompressor().stream_reader(open(fpath, 'rb'), closefd=True)
+        return io.BufferedReader(reader, ReadBufferSize)
+    return open(fpath, 'rb')
+
+
+def detect_format(fpath, name=None):
+    "Return the format of the url file at fpath, 'lines', 'jsonl' or 'csv': name, if given, else by extension"
+    if name:
+        return name
+    for compression in Compressions:
+        if fpath.endswith(compression):
+            fpath = fpath[:-len(compression)]
+    return Formats.get(os.path.splitext(fpath)[1].lower(), 'lines')
+
+
+def map_file(url_file):
+    "Return a read-only memory map of binary url_file if it is a plain file on disk, else None"
+    if not isinstance(getattr(url_file, 'raw', None), io.FileIO):
+        return None  # e.g. a decompressor, whose fileno() may be that of the compressed file
+    try:
+        return mmap.mmap(url_file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):  # a pipe, or an empty file
+        return None
+
+
+def raw_lines(url_file, start=0):
+    """Yield the lines of binary url_file from byte offset start on, as bytes,
+       from a memory map if possible"""
+    mapped = map_file(url_file)
+    if mapped is None:
+        if start:
+            url_file.seek(start)
+        yield from url_file
+        return
+    with mapped:
+        mapped.seek(start)
+        yield from iter(mapped.readline, b'')
+
+
+def iter_url_lines(url_file, start=0):
+    "Yield the lines of binary url_file from byte offset start on, as :class:`UrlLine`"
+    offset = start
+    for line in raw_lines(url_file, start):
+        end = offset + len(line)
+        yield UrlLine(line.decode('utf-8', 'replace'), offset, end)
+        offset = end
+
+
+def read_lines(url_file):
+    "Yield the lines of binary url_file as str, when their offsets are not needed"
+    for line in raw_lines(url_file):
+        yield line.decode('utf-8', 'replace')
+
+
+def check_name(name):
+    "Return a hinted file name, or raise ValueError unless it is a plain file name"
+    if name is not None and (not isinstance(name, str) or os.path.basename(name) != name or
+                             name in ('', '.', '..')):
+        raise ValueError("name must be a plain file name: {!r}".format(name))
+    return name
+
+
+def parse_json(line):
+    "Return (url, name, etag) of a JSON lines record"
+    record = json.loads(line)
+    if not isinstance(record, dict) or not isinstance(record.get('url'), str):
+        raise ValueError("expected an object with a url")
+    etag = record.get('etag')
+    if etag is not None and not isinstance(etag, str):
+        raise ValueError("etag must be a string: {!r}".format(etag))
+    return record['url'], check_name(record.get('name')), etag
+
+
+def parse_csv(line):
+    "Return (url, name, etag) of a CSV record; url is None for a header"
+    row = next(csv.reader([line]))
+    url, name, etag = (row + [None, None])[:3]
+    if url.strip().lower() == 'url':
+        return None, None, None
+    return url, check_name(name or None), etag or None
+
+
+def parse_records(lines, input_format):
+    """Turn the lines of a JSON lines or CSV url file into :class:`UrlRecord`,
+       keeping their offsets, if any; malformed lines are logged and skipped"""
+    parse = {'jsonl': parse_json, 'csv': parse_csv}[input_format]
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            url, name, etag = parse(line)
+        except (ValueError, csv.Error) as e:
+            _logger.error("Skipping malformed url record: {!r} - {}".format(line.strip()[:200], e))
+            continue
+        if url is not None:
+            yield UrlRecord(url, getattr(line, 'offset', None), getattr(line, 'end', None), name, etag)
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+  journal -- crash-safe progress of a run, for resuming it
+
+  The journal is an append-only text file in the output directory with one
+  line per finished url line of the input file:
+
+    R <offset> <end> <outcome> <epoch secs>
+
+  and, with every batch, a checkpoint line
+
+    C <offset>
+
+  stating that all url lines before <offset> are finished. A resumed run
+  seeks to the last checkpoint and skips the lines recorded as finished
+  after it. Lines are written in batches and flushed to the OS right away,
+  so the journal survives the process being killed; at most the last batch
+  is lost, and its urls are requested once more. A torn last line is
+  ignored. When a run completes, its journal is removed.
+"""
+from __future__ import division, print_function, absolute_import
+
+import logging
+import os
+import time
+import zlib
+
+from image_loader.ingest import UrlLine, iter_url_lines
+
+# - runtime params -------------------------------------------------------------
+FlushEvery = 100  # records per write
+# - params end -----------------------------------------------------------------
+
+_logger = logging.getLogger(__name__)
+
+
+def journal_path(destdir, urlfile, shard=None, kind='journal'):
+    "Return the journal path, or that of another <kind> of run file, for a run over urlfile into destdir"
+    name = '.image_loader.{}-{:08x}'.format(kind, zlib.crc32(os.path.abspath(urlfile).encode('utf-8')))
+    if shard is not None:
+        name += '-{}of{}'.format(*shard)
+    return os.path.join(destdir, name)
+
+
+def read_journal(path):
+    """Read a journal
+
+    Returns:
+      (int, set, set): the last checkpoint, the offsets of lines finished
+      after it and the offsets of lines that failed last time they were tried
+    """
+    checkpoint, done, failed = 0, set(), set()
+    if not os.path.exists(path):
+        return checkpoint, done, failed
+    with open(path, 'r') as journal:
+        for line in journal:
+            fields = line.split()
+            try:
+                if not line.endswith('\n'):
+                    raise ValueError("torn line")
+                if fields[0] == 'C' and len(fields) == 2:
+                    checkpoint = int(fields[1])
+                    done = {offset for offset in done if offset >= checkpoint}
+                elif fields[0] == 'R' and len(fields) == 5:
+                    offset, outcome = int(fields[1]), fields[3]
+                    if outcome == 'failed':
+                        failed.add(offset)
+                    else:
+                        failed.discard(offset)
+                    if offset >= checkpoint:
+                        done.add(offset)
+            except (IndexError, ValueError):
+                _logger.debug("Ignoring torn journal line: {!r}".format(line))
+    return checkpoint, done, failed
+
+
+class Journal(object):
+    "Progress journal of one run; see the module docs"
+
+    def __init__(self, path, flush_every=FlushEvery):
+        self.path = path
+        self.flush_every = flush_every
+        self.checkpoint, self.done, self.failed = read_journal(path)
+        self.journal = open(path, 'a')
+        self.buffer = []
+        self.inflight = set()  # offsets of lines handed out, but not finished
+        self.base = self.read_pos = self.checkpoint
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        self.close(complete=exc_type is None)
+
+    def resume_lines(self, url_file, retry_failed=False):
+        """Yield the url lines of binary file url_file that are still to do: with
+           retry_failed, first those that failed before, then all from the last
+           checkpoint on which have not finished yet"""
+        if self.checkpoint or self.done:
+            _logger.info("Resuming at byte offset {} of the url file".format(self.checkpoint))
+        if retry_failed:
+            for offset in sorted(self.failed):
+                url_file.seek(offset)
+                line = url_file.readline()
+                yield UrlLine(line.decode('utf-8', 'replace'), offset, offset + len(line))
+        for line in iter_url_lines(url_file, self.checkpoint):
+            if line.offset not in self.done:
+                yield line
+
+    def track(self, lines):
+        "Pass the url lines through, noting them as in flight"
+        for line in lines:
+            self.inflight.add(line.offset)
+            self.read_pos = max(self.read_pos, line.end)
+            yield line
+
+    def record(self, line, outcome):
+        "Note the outcome of a finished url line"
+        self.inflight.discard(line.offset)
+        self.buffer.append("R {} {} {} {}\n".format(line.offset, line.end, outcome, int(time.time())))
+        if len(self.buffer) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        # retried lines before the resumed checkpoint must not move it back
+        checkpoint = min((offset for offset in self.inflight if offset >= self.base), default=self.read_pos)
+        self.buffer.append("C {}\n".format(checkpoint))
+        self.journal.write("".join(self.buffer))  # one write per batch
+        self.journal.flush()
+        self.buffer = []
+
+    def close(self, complete=False):
+        "Close the journal; a complete run has nothing to resume, so its journal is removed"
+        if complete:
+            self.journal.close()
+            os.unlink(self.path)
+        else:
+            self.flush()
+            self.journal.close()
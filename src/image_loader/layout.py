@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+  layout -- where images go below the output directory
+
+  By default, images are stored flat in the output directory, named after
+  the last path segment of their url. With millions of files, a flat
+  directory makes lookups slow for the loader and the web server alike.
+  The fan-out layout spreads the images over <levels> levels of
+  subdirectories named by the hex digits of the MD5 hash of the file name:
+
+    md5(name) = 3fa9c0...  ->  3f/a9/name  (2 levels)
+
+  The mapping only depends on the file name, so a web tier can compute it
+  from the requested name (:func:`fanout_dir` is all it takes). Run
+  ``migrate-layout`` once to move an existing flat directory into the
+  fan-out layout, while no loader is writing into it. The post-processing
+  stamps and variants of the images move along with them.
+"""
+from __future__ import division, print_function, absolute_import
+
+import argparse
+import hashlib
+import logging
+import os
+import sys
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+from image_loader import __version__
+
+# - runtime params -------------------------------------------------------------
+FanOutWidth = 2        # hex digits per directory level, i.e. 256 subdirectories
+MaxFanOutLevels = 4
+MigrateThreads = 16    # renames in flight when migrating
+# - params end -----------------------------------------------------------------
+
+_logger = logging.getLogger(__name__)
+
+
+def fanout_dir(name, levels):
+    "Return the relative directory for file name in a layout with <levels> levels, e.g. '3f/a9'"
+    digest = hashlib.md5(name.encode('utf-8')).hexdigest()
+    return '/'.join(digest[i * FanOutWidth:(i + 1) * FanOutWidth] for i in range(levels))
+
+
+def fanout_path(outdir, name, levels=0):
+    "Return the path of file name below outdir; 0 levels for the flat layout"
+    if not levels:
+        return os.path.join(outdir, name)
+    return os.path.join(outdir, fanout_dir(name, levels), name)
+
+
+@lru_cache(maxsize=1 << 17)
+def make_dirs(dirpath):
+    "Create dirpath if needed; remembers the directories it has seen to save the stat calls"
+    os.makedirs(dirpath, mode=0o750, exist_ok=True)
+
+
+def is_image_file(entry):
+    "Check if a directory entry of a flat output directory is an image, rather than loader state"
+    return not entry.name.startswith('.') and (entry.is_file(follow_symlinks=False) or entry.is_symlink())
+
+
+def move_file(outdir, name, levels):
+    """Move file name from the top of outdir to its fan-out path, together with
+       its post-processing state. Relative symbolic links (of --dedup symlink)
+       are re-created to point to the same target.
+
+    Returns:
+      str: 'moved', or 'skipped' if the destination exists already
+    """
+    source, target = os.path.join(outdir, name), fanout_path(outdir, name, levels)
+    make_dirs(os.path.dirname(target))
+    if os.path.lexists(target):
+        _logger.error("File exists in the fan-out layout already, skipping: {}".format(source))
+        return 'skipped'
+    if os.path.islink(source) and not os.path.isabs(os.readlink(source)):
+        link = os.path.normpath(os.path.join(outdir, os.readlink(source)))
+        os.symlink(os.path.relpath(link, os.path.dirname(target)), target)
+        os.unlink(source)
+    else:
+        os.rename(source, target)
+    from image_loader.postprocess import move_processed  # postprocess imports loader, which imports this module
+    move_processed(source, target, outdir)
+    return 'moved'
+
+
+def migrate(outdir, levels, threads=MigrateThreads):
+    """Move the images of flat directory outdir into the fan-out layout with
+       <levels> levels, with <threads> renames in flight
+
+    Returns:
+      :obj:`collections.Counter`: number of files per outcome
+    """
+    from image_loader.loader import format_summary, submit_bounded  # loader imports this module
+    assert 0 < levels <= MaxFanOutLevels, "Fan-out levels out of range: {}".format(levels)
+    summary = Counter()
+    with ThreadPoolExecutor(threads) as thread_pool, os.scandir(outdir) as entries:
+        names = (entry.name for entry in entries if is_image_file(entry))
+        move = lambda name: move_file(outdir, name, levels)
+        for name, future in submit_bounded(thread_pool, move, names, 4 * threads):
+            try:
+                summary[future.result()] += 1
+            except OSError as e:
+                _logger.error("Unable to move file: {} - error: {!r}".format(name, e))
+                summary['failed'] += 1
+    _logger.info("Migrated {}: {}".format(outdir, format_summary(summary)))
+    return summary
+
+
+def fanout_levels(s):
+    "Parse a number of fan-out levels for argparse"
+    levels = int(s)
+    if not 0 <= levels <= MaxFanOutLevels:
+        raise argparse.ArgumentTypeError("expected 0 to {} levels: {}".format(MaxFanOutLevels, s))
+    return levels
+
+
+def parse_args(args):
+    """Parse command line parameters of the migration command
+
+    Args:
+      args ([str]): command line parameters as list of strings
+
+    Returns:
+      :obj:`argparse.Namespace`: command line parameters namespace
+    """
+    parser = argparse.ArgumentParser(
+        description="Move the images of a flat output directory into the fan-out layout")
+    parser.add_argument(
+        '--version',
+        action='version',
+        version='image_loader {ver}'.format(ver=__version__))
+    parser.add_argument(
+        dest="outdir",
+        help="output directory of earlier loader runs",
+        type=str,
+        metavar="DIRECTORY")
+    parser.add_argument(
+        '--fanout',
+        dest="fanout",
+        help="directory levels of the layout (default: 2)",
+        type=fanout_levels,
+        default=2,
+        metavar="LEVELS")
+    parser.add_argument(
+        '--threads',
+        dest="threads",
+        help="renames in parallel (default: {})".format(MigrateThreads),
+        type=int,
+        default=MigrateThreads,
+        metavar="N")
+    parser.add_argument(
+        '-v',
+        '--verbose',
+        dest="loglevel",
+        help="set loglevel to INFO",
+        action='store_const',
+        const=logging.INFO)
+    return parser.parse_args(args)
+
+
+def main(args):
+    """Main entry point of the migration command
+
+    Args:
+      args ([str]): command line parameter list
+    """
+    from image_loader.loader import setup_logging
+    args = parse_args(args)
+    setup_logging(args.loglevel)
+    if args.fanout:
+        migrate(args.outdir, args.fanout, args.threads)
+
+
+def run():
+    """Entry point for console_scripts
+    """
+    main(sys.argv[1:])
+
+
+if __name__ == "__main__":
+    run()
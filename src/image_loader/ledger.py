@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""
+  ledger -- sharing a url file between overlapping runs
+
+  When cron starts a run while the previous one over the same url file is
+  still going, locking the partial files only keeps both from writing the
+  same image; the second run still requests every url once more. With
+  overlap, runs coordinate through two files in the output directory:
+
+  The lease file tells if a run over the url file is active: every run holds
+  a shared flock on it while it runs, and the kernel drops that when the
+  process ends, however it ends. A run finding no lease held takes it
+  exclusively for a moment, writes a fresh ledger, and records its pid in the
+  lease file for the log of later runs. flock turns an exclusive lock into a
+  shared one by dropping it first, so starting runs take turns on a third
+  file, the init file, while they look at the lease and write the ledger.
+  With overlap 'exit', a run finding the lease held leaves right away,
+  raising :class:`RunActive`.
+
+  The ledger splits the url file into chunks of ChunkBytes, by the byte offset
+  of their lines, with one state byte per chunk after a header. A run claims
+  a chunk by locking its state byte (lockf, no blocking) and marks it done
+  once all of its urls are finished. With overlap 'share', a second run claims
+  the chunks the first has not got to yet, so both finish the url file sooner
+  together. The lock of a chunk ends with the process holding it too; a chunk
+  left unfinished by a run that died is claimed again by the next run looking
+  for work. Shards (--workers) coordinate shard by shard, so overlapping runs
+  have to shard the url file alike.
+
+  A :class:`Ledger` is used like a :class:`image_loader.journal.Journal`,
+  which it replaces; the two do not combine.
+"""
+from __future__ import division, print_function, absolute_import
+
+import errno
+import fcntl
+import itertools
+import json
+import logging
+import os
+from collections import Counter
+
+from image_loader.ingest import iter_url_lines
+from image_loader.journal import journal_path
+
+# - runtime params -------------------------------------------------------------
+ChunkBytes = 256 * 1024  # of the url file per claim, a few thousand urls
+# - params end -----------------------------------------------------------------
+
+HeaderBytes = 256  # JSON header of the ledger, padded; the state bytes follow
+Todo, Done = b'.', b'D'
+
+_logger = logging.getLogger(__name__)
+
+
+class RunActive(Exception):
+    "Raised when another run over the url file is active, and this one should not take part"
+
+
+def file_identity(path):
+    "Return what tells the url file at path from a modified or replaced one"
+    st = os.stat(path)
+    return [st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns]
+
+
+def write_ledger(path, identity, chunk_bytes):
+    "Write a fresh ledger for a url file of identity at path, atomically"
+    count = -(-identity[2] // chunk_bytes)
+    header = json.dumps({'identity': identity, 'chunk_bytes': chunk_bytes}).encode('ascii')
+    with open(path + '.new', 'wb') as f:
+        f.write(header.ljust(HeaderBytes - 1) + b'\n' + Todo * count)
+    os.replace(path + '.new', path)
+
+
+def read_holder(lease):
+    "Return what the active run recorded in the lease file"
+    lease.seek(0)
+    return lease.read().strip() or "unknown"
+
+
+def open_ledger(destdir, urlfile, shard=None, overlap='share', chunk_bytes=None):
+    """Take part in the runs over urlfile into destdir, and return the
+       :class:`Ledger` to claim chunks of it from; see the module docs
+
+    Raises:
+      RunActive: with overlap 'exit', or when the active runs work on an
+        older version of the url file, or are done with it already
+    """
+    lease = open(journal_path(destdir, urlfile, shard, 'lease'), 'a+')
+    ledger = journal_path(destdir, urlfile, shard, 'ledger')
+    try:
+        with open(journal_path(destdir, urlfile, shard, 'init'), 'a') as init:
+            fcntl.flock(init, fcntl.LOCK_EX)  # only one run starting at a time; dropped on closing
+            try:
+                fcntl.flock(lease, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                holder = read_holder(lease)
+                if overlap == 'exit':
+                    raise RunActive("Another run over the url file is active ({}): {}".format(holder, urlfile))
+                fcntl.flock(lease, fcntl.LOCK_SH)
+                _logger.info("Sharing the url file with an active run ({}): {}".format(holder, urlfile))
+            else:
+                write_ledger(ledger, file_identity(urlfile), chunk_bytes or ChunkBytes)
+                lease.truncate(0)
+                lease.write("pid {}".format(os.getpid()))
+                lease.flush()
+                fcntl.flock(lease, fcntl.LOCK_SH)  # not atomic, but nobody else takes the lease meanwhile
+        try:
+            result = Ledger(ledger, lease)
+        except FileNotFoundError:  # removed by the last run finishing it
+            raise RunActive("The active runs are done with the url file: {}".format(urlfile))
+        if result.identity != file_identity(urlfile):
+            result.lease = None  # closed below
+            result.close()
+            raise RunActive("The active runs work on an older version of the url file: {}".format(urlfile))
+        return result
+    except BaseException:
+        lease.close()
+        raise
+
+
+class Ledger(object):
+    """Chunks of the url file shared between overlapping runs, held with
+       the lease file of the run; see the module docs"""
+
+    def __init__(self, path, lease):
+        self.path = path
+        self.lease = lease
+        self.ledger = open(path, 'r+b')
+        header = json.loads(self.ledger.read(HeaderBytes).decode('ascii'))
+        self.identity, self.chunk_bytes = header['identity'], header['chunk_bytes']
+        self.count = -(-self.identity[2] // self.chunk_bytes)
+        self.next = 0  # chunk to look at first for the next claim
+        self.held = set()  # chunks claimed and not done
+        self.read = set()  # held chunks all lines of which are handed out
+        self.inflight = Counter()  # per held chunk, its lines handed out and not finished
+        self.counts = Counter()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        self.close(complete=exc_type is None)
+
+    def states(self):
+        return os.pread(self.ledger.fileno(), self.count, HeaderBytes)
+
+    def lock(self, index, cmd):
+        fcntl.lockf(self.ledger, cmd, 1, HeaderBytes + index, os.SEEK_SET)
+
+    def claim(self):
+        "Claim the next chunk that is neither done nor claimed by a live run; return its index or None"
+        states = self.states()
+        # from the last claim on, then from the start again, for chunks left by runs that died
+        for index in itertools.chain(range(self.next, self.count), range(self.next)):
+            if states[index:index + 1] != Todo or index in self.held:
+                continue
+            try:
+                self.lock(index, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError as e:
+                if e.errno in (errno.EACCES, errno.EAGAIN):
+                    continue
+                raise
+            if os.pread(self.ledger.fileno(), 1, HeaderBytes + index) != Todo:  # done just before the lock
+                self.lock(index, fcntl.LOCK_UN)
+                continue
+            self.next = index + 1
+            self.held.add(index)
+            return index
+        return None
+
+    def finish(self, index):
+        "Mark the held chunk as done, once all of its lines are handed out and finished"
+        if index in self.read and not self.inflight[index]:
+            os.pwrite(self.ledger.fileno(), Done, HeaderBytes + index)
+            self.lock(index, fcntl.LOCK_UN)
+            self.held.discard(index)
+            self.read.discard(index)
+            del self.inflight[index]
+            self.counts['done'] += 1
+
+    def chunk_lines(self, url_file, index):
+        "Yield the url lines of binary url_file starting in chunk index, as :class:`image_loader.ingest.UrlLine`"
+        start, end = index * self.chunk_bytes, min((index + 1) * self.chunk_bytes, self.identity[2])
+        if start:
+            url_file.seek(start - 1)
+            url_file.readline()  # the rest of the line starting in the chunk before
+            start = url_file.tell()
+        if start >= end:
+            return
+        for line in iter_url_lines(url_file, start):
+            if line.offset >= end:
+                break
+            yield line
+
+    def resume_lines(self, url_file, retry_failed=False):
+        """Yield the url lines of binary url_file in the chunks this run claims,
+           as :class:`image_loader.ingest.UrlLine`, until there are none left;
+           retry_failed does not apply"""
+        while True:
+            index = self.claim()
+            if index is None:
+                return
+            yield from self.chunk_lines(url_file, index)
+            self.read.add(index)  # every line read is handed out or filtered out by now
+            self.finish(index)
+
+    def track(self, lines):
+        "Pass the url lines through, noting them as in flight"
+        for line in lines:
+            self.inflight[line.offset // self.chunk_bytes] += 1
+            yield line
+
+    def record(self, line, outcome):
+        "Note a finished url line"
+        index = line.offset // self.chunk_bytes
+        self.inflight[index] -= 1
+        self.finish(index)
+
+    def close(self, complete=False):
+        """Close the ledger, giving up the chunks not done, and end the lease; a complete
+           run finding all chunks done, by itself or others, removes the ledger"""
+        if complete and self.states() == Done * self.count:
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:  # another run was done at the same time
+                pass
+        self.ledger.close()  # drops the locks of the chunks still held
+        if self.lease is not None:
+            self.lease.close()
+        if self.counts:
+            _logger.info("Finished {} of {} chunks of the url file".format(self.counts['done'], self.count))
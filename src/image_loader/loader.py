@@ -9,25 +9,50 @@ import argparse
 import sys
 import logging
 import os
-import errno
-import fcntl
 import time
-import shutil
-from functools import reduce
-from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import itertools
+import re
+import threading
+import zlib
+from collections import Counter
+from contextlib import closing
+from functools import reduce, partial
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 from pymaybe import maybe
 import urllib3
 
 from image_loader import __version__
+from image_loader.adaptive import AdaptiveLimit, MinConcurrency, pending_limit
+from image_loader.health import HostHealth, MaxRetries, BreakerThreshold, RetryStatuses, backoff_delay, retry_after_secs
+from image_loader.layout import fanout_levels, fanout_path, make_dirs
+from image_loader.metrics import Metrics, NullMetrics, Result, mark, note, shard_path
+from image_loader.ingest import (detect_format, is_compressed, is_stdin, open_url_file, parse_records, read_lines,
+                                 url_hints)
+from image_loader.journal import Journal, journal_path
+from image_loader.logs import Formats, make_handler
+from image_loader.ledger import RunActive, open_ledger
+from image_loader.index import Entry, MetadataIndex, index_path, make_entry, conditional_headers, expiry, is_fresh
+from image_loader.resolve import MaxPools, Resolver, ResolvingPoolManager, look_ahead
+from image_loader.storage import (ContentStore, open_output, commit_output, discard_output, keep_output, read_resume,
+                                  drop_resume)
+from image_loader.unique import UniqueUrls
+from image_loader.validate import ValidationError, SniffBytes, check_head, check_size
 
 # - runtime params -------------------------------------------------------------
-RequestTimeoutSecs = 10
-MaxNumPools = 10 # this is the default; increase this with very heterogenous urls in the input, to trade space for speed
-MaxThreads = 10
-MaxHTTPConnections = MaxThreads # having more threads than connections in a pool might result in (harmless) warnings
+ConnectTimeoutSecs = 5 # fail fast on hosts that are down
+ReadTimeoutSecs = 10 # max. silence while waiting for response data
+MaxNumPools = 10 # hosts to keep connections to at first; grown with the hosts in flight unless --pools is given
+MaxThreads = 10 # default of --threads; also the connections kept per host, unless --connections is given
+MaxPendingURLs = 4 * MaxThreads # upper bound for submitted, but unfinished downloads; keeps memory flat with huge URL files
+CopyBufferSize = 256 * 1024 # bytes per read when writing a response body to disk; one such buffer per thread
 # - params end -----------------------------------------------------------------
 
+ThrottleStatuses = (429, 503)  # server responses asking us to slow down
+RequestTimeout = urllib3.Timeout(connect=ConnectTimeoutSecs, read=ReadTimeoutSecs)
+NoRetries = urllib3.Retry(connect=0, read=0, other=0, status=0, respect_retry_after_header=False)  # fetch_response retries; redirects are followed
+
 _logger = logging.getLogger(__name__)
 
 
@@ -62,64 +87,424 @@ def format_date(epocsecs):
     return s
 
 
-def get_out_file(url, outdir):
-    "Construct output file path from url"
-    return os.path.join(outdir, os.path.basename(url))
+def get_out_file(url, outdir, fanout=0, name=None):
+    """Construct output file path from url, or the file name hinted for it, in a fan-out layout of
+       <fanout> levels; see :mod:`image_loader.layout`"""
+    return fanout_path(outdir, name or os.path.basename(url), fanout)
+
+
+def is_image(content_type):
+    "Check if a Content-Type header value denotes an image"
+    return maybe(content_type).or_else("").startswith('image/')
+
+
+class IncompleteBody(IOError):
+    "Raised when the connection breaks off before the whole body is in"
+
 
+def identity_encoded(headers):
+    "Check if a response body comes as is, so lengths and ranges address the image bytes"
+    return maybe(headers.get('Content-Encoding')).or_else('identity') == 'identity'
 
-def process_incoming(response, outdir):
-    "Process data from web request"
-    if not maybe(response.info().get('Content-Type')).or_else("").startswith('image/'):
-        _logger.error("Apparently not an image file, skipping: {}".format(response.geturl()))
+
+_buffers = threading.local()
+
+
+def get_buffer(size):
+    "Return the calling thread's reusable read buffer of <size> bytes"
+    view = getattr(_buffers, 'view', None)
+    if view is None or len(view) != size:
+        view = _buffers.view = memoryview(bytearray(size))
+    return view
+
+
+def body_reader(response):
+    """Return a readinto function for the response body. Bodies without a
+       Content-Encoding are read directly from the underlying http.client
+       response, which fills the buffer without creating bytes objects."""
+    fp = getattr(response, '_fp', None)
+    if identity_encoded(response.headers) and hasattr(fp, 'readinto'):
+        return fp.readinto
     else:
-        file_name = get_out_file(response.geturl(), outdir)
-        with open(file_name, 'wb') as out_file:
-            # try locking the out_file, to allow for overlapping runs of the script
-            # or a local Web server opening the file for reading (provided it uses locking too)
-            try:
-                fcntl.lockf(out_file, fcntl.LOCK_EX | fcntl.LOCK_NB)  # POSIX locking should be enough for Debian deployments
-            except OSError as e:
-                if e.errno in (errno.EACCESS, errno.EAGAIN):
-                    _logger.error("Cannot obtain lock for localfile, skipping: {}".format(file_name))
-                else:
-                    raise
-            else:
-                _logger.info("Downloading image: {}".format(response.geturl()))
-                shutil.copyfileobj(response, out_file) # let exceptions like OSError propagate
+        return response.readinto  # urllib3 decodes the content
 
 
-def download_url(pool, url, outdir, force):
-    "Make the web request"
-    url = url.strip()
-    if not is_real_string(url):
-        return
+def read_head(readinto, buf, size):
+    "Read at least <size> bytes into buf, unless the body is shorter; return the count"
+    count = 0
+    while count < size:
+        read = readinto(buf[count:])
+        if not read:
+            break
+        count += read
+    return count
+
+
+def hash_prefix(out_file, length, chunk_size=CopyBufferSize):
+    """Return the sha256 digest object of the first <length> bytes of out_file,
+       which is left positioned right after them"""
+    buf = get_buffer(chunk_size)
+    digest = hashlib.sha256()
+    out_file.seek(0)
+    while length:
+        count = out_file.readinto(buf[:min(length, chunk_size)])
+        if not count:
+            raise ValidationError("Partial download is shorter than recorded: {}".format(out_file.name))
+        digest.update(buf[:count])
+        length -= count
+    return digest
+
+
+def copy_hashed(response, out_file, chunk_size=CopyBufferSize, head=0, max_size=None, digest=None, offset=0):
+    """Copy the response body to out_file; return its length and sha256 hex digest
+
+    Args:
+      head (int): number of body bytes already read into the thread's buffer
+      max_size (int): raise :class:`ValidationError` once the body exceeds this
+      digest: sha256 digest object of the first <offset> bytes of the file,
+        when resuming a partial download
+      offset (int): bytes of the file written before the body
+    """
+    buf = get_buffer(chunk_size)
+    readinto = body_reader(response)
+    digest = digest or hashlib.sha256()
+    length = offset
+    count = head or readinto(buf)
+    while count:
+        length += count
+        check_size(length, max_size, response.geturl())
+        chunk = buf[:count]
+        digest.update(chunk)
+        out_file.write(chunk)
+        count = readinto(buf)
+    return length, digest.hexdigest()
+
+
+def content_length(headers):
+    "Return the Content-Length header value as int, or None"
+    try:
+        return int(headers.get('Content-Length'))
+    except (TypeError, ValueError):
+        return None
+
+
+def content_range(value):
+    "Return (first byte, total length) of a Content-Range header value; total is None if unknown"
+    match = re.match(r'bytes\s+(\d+)-\d+/(\d+|\*)$', maybe(value).or_else('').strip())
+    if match is None:
+        return None
+    return int(match.group(1)), None if match.group(2) == '*' else int(match.group(2))
+
+
+def body_span(status, headers, url):
+    """Return (offset, total length) of a response body within the image:
+       (0, Content-Length) for a full body, the Content-Range for the 206 answer
+       to a resumed download. Raise :class:`ValidationError` if the latter is unusable."""
+    if status != 206:
+        return 0, content_length(headers)
+    span = content_range(headers.get('Content-Range'))
+    if span is None or not identity_encoded(headers):
+        raise ValidationError("Cannot resume from partial content: {} - Content-Range {!r}".format(
+            url, headers.get('Content-Range')))
+    return span
+
+
+def resume_validator(headers):
+    """Return the validator to resume the download of a response with, via If-Range: its
+       strong ETag, else its Last-Modified; None if the body cannot be resumed"""
+    if not identity_encoded(headers):
+        return None  # ranges would address the encoded body
+    etag = headers.get('ETag')
+    return etag if etag and not etag.startswith('W/') else headers.get('Last-Modified')
+
+
+def process_incoming(response, outdir, store=None, chunk_size=CopyBufferSize, max_size=None, fanout=0, name=None,
+                     url=None):
+    """Process data from web request. A 206 answer continues the kept partial
+       download of the image; if the body breaks off, the partial file is kept
+       to be resumed later, see :mod:`image_loader.storage`.
+
+    Args:
+      store (:obj:`image_loader.storage.ContentStore`): store the image there
+        and link it into outdir, instead of writing it to outdir directly
+      chunk_size (int): bytes per read from the network
+      max_size (int): maximum image size in bytes; None for no limit
+      fanout (int): directory levels of the output layout
+      name (str): local file name, instead of the one in the url
+      url (str): the url requested, for the log; urllib3 has only its path
+
+    Returns:
+      (int, str): length and sha256 hex digest of the written image, or
+      None if nothing has been written
+    """
+    extra = {'url': url or response.geturl()}
+    if not is_image(response.info().get('Content-Type')):
+        _logger.error("Apparently not an image file, skipping: %s", response.geturl(), extra=extra)
+        note(error="Not an image: Content-Type {}".format(response.headers.get('Content-Type')))
+        return None
     else:
-        headers = {}
-        if not force:
-            headers.update({'If-Modified-Since' : pipeline(get_out_file(url, outdir)
+        file_name = get_out_file(response.geturl(), outdir, fanout, name)
+        try:
+            offset, length = body_span(response.status, response.headers, response.geturl())
+            check_size(length, max_size, response.geturl())
+            head = 0
+            if not offset:  # the kept part of a resumed download has been checked before
+                head = read_head(body_reader(response), get_buffer(chunk_size), min(SniffBytes, chunk_size))
+                check_head(get_buffer(chunk_size)[:head], response.geturl())
+        except ValidationError as e:
+            _logger.error("%s, skipping", e, extra=extra)
+            note(error=str(e))
+            drop_resume(file_name)
+            response.close()  # rather than reading the rest of the body
+            return None
+        if fanout:
+            make_dirs(os.path.dirname(file_name))
+        out_file = open_output(file_name, length, store, offset, max_size)
+        if out_file is None:
+            return None
+        if out_file.tell() != offset:
+            _logger.error("Partial download to resume is gone, skipping: %s", response.geturl(), extra=extra)
+            discard_output(out_file)
+            response.close()
+            return None
+        _logger.info("Downloading image: %s%s", response.geturl(), " from byte {}".format(offset) if offset else "",
+                     extra=extra)
+        try:
+            digest = hash_prefix(out_file, offset, chunk_size) if offset else None
+            written = copy_hashed(response, out_file, chunk_size, head, max_size, digest, offset) # let exceptions like OSError propagate
+            check_length(written[0], length if identity_encoded(response.headers) else None, response.geturl())
+            mark('transfer')
+        except ValidationError as e:
+            _logger.error("%s, skipping", e, extra=extra)
+            note(error=str(e))
+            discard_output(out_file)
+            response.close()
+            return None
+        except BaseException:
+            if store is None:
+                keep_output(out_file, file_name, resume_validator(response.headers))
+            else:
+                discard_output(out_file)
+            raise
+        commit_output(out_file, file_name, written[1], store)
+        mark('commit')
+        note(length=written[0], path=file_name, digest=written[1])
+        return written
+
+
+def check_length(length, expected, url):
+    """Raise :class:`IncompleteBody` if fewer than the expected bytes were written, which
+       http.client does not notice by itself when the connection breaks off"""
+    if expected is not None and length < expected:
+        raise IncompleteBody("Image has {} of {} bytes: {}".format(length, expected, url))
+
+
+def request_headers(url, outdir, force, index=None, fanout=0, resume=False, name=None, etag=None):
+    """Construct the request headers for url, checking freshness of a local copy unless forced.
+       Validators come from the metadata index if it knows url, else from the local file's mtime.
+       With resume set, a kept partial download is continued instead, if there is one; with an
+       index, it is only looked for if the index records one, sparing the file system lookups.
+       Return None if the index has the local copy as fresh still, or with the etag the url is
+       known to have, so url need not be requested. name is the local file name, if hinted."""
+    known = index.get(url) if index is not None else None
+    entry = known if not force else None
+    if entry and (is_fresh(entry) or (etag is not None and entry.etag == etag)):
+        return None
+    kept = None
+    if resume and (index is None or (known is not None and known.partial)):
+        kept = read_resume(get_out_file(url, outdir, fanout, name))
+    if kept:
+        offset, validator = kept
+        return {'Range': 'bytes={}-'.format(offset), 'If-Range': validator, 'Accept-Encoding': 'identity'}
+    headers = {}
+    if not force:
+        if entry:
+            headers.update(conditional_headers(entry))
+        else:
+            headers.update({'If-Modified-Since' : pipeline(get_out_file(url, outdir, fanout, name)
                                                            , file_mtime
                                                            , format_date)
                           })
-        response = pool.request('GET'
-                        , url
-                        , timeout = RequestTimeoutSecs
-                        , preload_content = False
-                        , headers = headers
-                    )
-        if response and response.status == 200:
-            process_incoming(response, outdir)
+    return headers
+
+
+def record_download(index, url, response, written, min_ttl=0):
+    "Store the metadata of a written download in the index, if there is one"
+    if written and index is not None:
+        index.put(url, make_entry(response.headers, *written, min_ttl=min_ttl))
+
+
+def record_partial(index, url, file_name):
+    "Note in the index, if there is one, that a partial download of url is kept to resume"
+    if index is not None and read_resume(file_name):
+        index.put(url, (index.get(url) or Entry(None, None, None, None))._replace(partial=True))
+
+
+def record_fresh(index, url, response, min_ttl=0):
+    "Renew the freshness lifetime of the indexed local copy of url after a 304 response"
+    entry = index.get(url) if index is not None else None
+    if entry:
+        index.put(url, entry._replace(expires=expiry(response.headers, min_ttl)))
+
+
+def skip_fresh(url, outdir, fanout=0, name=None):
+    "Account for a url whose local copy is fresh still, without requesting it"
+    _logger.info("Local copy of url is fresh still, not requesting it: %s", url, extra={'url': url})
+    note(path=get_out_file(url, outdir, fanout, name), requested=False)
+    return 'fresh'
+
+
+def fetch_response(pool, url, headers, health=None, retries=0):
+    """Request url, retrying transient failures up to <retries> times after
+       a backoff delay; see :mod:`image_loader.health`
+
+    Returns:
+      :obj:`urllib3.response.HTTPResponse`: the final response, with the body
+      not read yet, or None if health reports the host as down
+    """
+    host = url_server(url)
+    for attempt in itertools.count():
+        if health is not None and not health.allow(host):
+            return None
+        response = retry_after = None
+        try:
+            response = pool.request('GET'
+                            , url
+                            , timeout = RequestTimeout
+                            , retries = NoRetries
+                            , preload_content = False
+                            , headers = headers
+                        )
+        except urllib3.exceptions.HTTPError as e:
+            failure = e
+        else:
+            if response.status not in RetryStatuses:
+                if health is not None:
+                    health.success(host)
+                return response
+            failure, retry_after = response.status, retry_after_secs(response.headers.get('Retry-After'))
+        if health is not None:
+            health.failure(host)
+        delay = backoff_delay(attempt, retry_after) if attempt < retries else None
+        if delay is None:
+            if response is None:
+                raise failure
+            return response
+        if response is not None:
+            response.drain_conn()
+            response.release_conn()
+        _logger.info("Retrying url in %.1fs: %s - error: %r", delay, url, failure, extra={'url': url})
+        time.sleep(delay)
+
+
+def download_url(pool, url, outdir, force, index=None, store=None, chunk_size=CopyBufferSize, max_size=None,
+                 fanout=0, health=None, retries=0, min_ttl=0):
+    """Make the web request
+
+    Args:
+      index (:obj:`image_loader.index.MetadataIndex`): metadata of earlier
+        downloads, for freshness checks; updated with new downloads
+      store (:obj:`image_loader.storage.ContentStore`): content-addressed
+        storage for the images, if any
+      chunk_size (int): bytes per read from the network
+      max_size (int): maximum image size in bytes; None for no limit
+      fanout (int): directory levels of the output layout
+      health (:obj:`image_loader.health.HostHealth`): circuit breakers of the
+        hosts, if any
+      retries (int): retries after transient failures
+      min_ttl (int): secs a download stays fresh in the index at least, without
+        being requested again
+
+    Returns:
+      str: outcome of the request, one of 'downloaded', 'fresh', 'skipped',
+      'throttled' or 'failed', or 'deferred' while the host is down; None for
+      empty url lines
+    """
+    name, etag = url_hints(url)
+    url = url.strip()
+    if not is_real_string(url):
+        return None
+    else:
+        headers = request_headers(url, outdir, force, index, fanout, store is None, name, etag)
+        if headers is None:
+            return skip_fresh(url, outdir, fanout, name)
+        response = fetch_response(pool, url, headers, health, retries)
+        if response is not None and response.status == 416 and 'Range' in headers:
+            _logger.info("Cannot resume, downloading anew: %s", url, extra={'url': url})
+            response.drain_conn()
+            response.release_conn()
+            drop_resume(get_out_file(url, outdir, fanout, name))
+            response = fetch_response(pool, url, request_headers(url, outdir, force, index, fanout, name=name) or {},
+                                      health, retries)
+        mark('request')
+        if response is None:
+            return health.blocked_outcome(url)
+        note(status=response.status)
+        if response and response.status in (200, 206):
+            try:
+                written = process_incoming(response, outdir, store, chunk_size, max_size, fanout, name, url)
+            except BaseException:
+                if store is None:
+                    record_partial(index, url, get_out_file(url, outdir, fanout, name))
+                raise
+            record_download(index, url, response, written, min_ttl)
+            outcome = 'downloaded' if written else 'skipped'
         elif response and response.status == 304:
-            _logger.info("Local copy of url is fresh: {}".format(url))
+            _logger.info("Local copy of url is fresh: %s", url, extra={'url': url})
+            note(path=get_out_file(url, outdir, fanout, name))
+            record_fresh(index, url, response, min_ttl)
+            outcome = 'fresh'
+        elif response and response.status in ThrottleStatuses:
+            _logger.error("Server asks to slow down, skipping url: %s - error: %s - %s", url, response.status,
+                          response.msg, extra={'url': url})
+            note(error="{} {}".format(response.status, response.reason))
+            outcome = 'throttled'
         else:
-            _logger.error("Unable to download url: {} - error: {} - {}".format(
-                url, response.status, response.msg))
+            _logger.error("Unable to download url: %s - error: %s - %s", url, response.status, response.msg,
+                          extra={'url': url})
+            note(error="{} {}".format(response.status, response.reason))
+            outcome = 'failed'
         response.release_conn()
+        return outcome
 
 
 def get_url_iter(fpath):
-    "Open the file with the urls"
+    "Open the file with the urls for binary reading; see :func:`image_loader.ingest.open_url_file`"
     assert is_real_string(fpath), "Empty file path: {}".format(fpath)
-    return open(fpath, 'r')
+    return open_url_file(fpath)
+
+
+def url_host(url):
+    "Return the host part of url, lower-cased; '' if there is none"
+    try:
+        return maybe(urllib3.util.parse_url(url.strip()).host).or_else('').lower()
+    except urllib3.exceptions.LocationParseError:
+        return ''
+
+
+def url_server(url):
+    "Return host and port of url as in the url, lower-cased, to tell servers apart; '' if there is none"
+    try:
+        return maybe(urllib3.util.parse_url(url.strip()).netloc).or_else('').lower()
+    except urllib3.exceptions.LocationParseError:
+        return ''
+
+
+def shard_of(url, count):
+    """Deterministically map url to one of <count> shards. Hashing the host keeps
+       all urls of a server in one shard, so keep-alive connections get reused."""
+    return zlib.crc32(url_host(url).encode('utf-8')) % count
+
+
+def select_urls(urls, shard=None):
+    """Filter the url lines to download: skip empty lines and, with shard
+       given as (index, count), urls belonging to other shards"""
+    urls = filter(is_real_string, urls)
+    if shard is None:
+        return urls
+    else:
+        index, count = shard
+        return (url for url in urls if shard_of(url, count) == index)
 
 
 def assert_destdir(dirpath):
@@ -132,14 +517,375 @@ def assert_destdir(dirpath):
                "Output dir is either not a directory or not writeable: {}".format(dirpath)
 
 
-def load(urlfile, destdir, force):
-    "Download images with URLs from file into destdir"
+def submit_bounded(executor, func, items, max_pending, limiter=None):
+    """Submit func(item) to executor for each of items, with at most
+       <max_pending> unfinished futures at any time, or fewer as an
+       :class:`image_loader.adaptive.AdaptiveLimit` limiter allows. <items>
+       is consumed lazily, as slots free up. Yields (item, future) pairs in
+       order of completion."""
+    assert max_pending > 0, "Need at least one pending slot: {}".format(max_pending)
+    pending = {}
+    try:
+        for item in items:
+            while len(pending) >= pending_limit(max_pending, limiter):
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield pending.pop(future), future
+            pending[executor.submit(func, item)] = item
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future
+    finally:
+        for future in pending:  # when closed early
+            future.cancel()
+
+
+def get_outcome(url, future):
+    "Return the outcome of a finished download, logging failures"
+    try:
+        return future.result()
+    except Exception as e:
+        _logger.error("Unable to download url: %s - error: %r", url.strip(), e, extra={'url': url.strip()})
+        return Result('failed', url, error=repr(e))
+
+
+def format_summary(summary):
+    "Render an outcome counter for the log"
+    return ", ".join("{} {}".format(count, outcome) for outcome, count in sorted(summary.items()))
+
+
+def make_pool(threads=MaxThreads, connections=None, pools=None, resolve_ahead=0):
+    """Return an HTTP connection pool for <threads> download threads, keeping <connections> per host
+       to <pools> hosts, or MaxNumPools at first if None; with resolve_ahead, connections take host
+       addresses from an :class:`image_loader.resolve.Resolver`"""
+    options = dict(maxsize=connections or threads, num_pools=pools or MaxNumPools, timeout=RequestTimeout)
+    if resolve_ahead:
+        return ResolvingPoolManager(Resolver(), **options)
+    return urllib3.PoolManager(**options)
+
+
+def open_index(destdir, use_index):
+    "Open the metadata index of destdir if use_index is set, else return None"
+    return MetadataIndex(index_path(destdir)) if use_index else None
+
+
+def open_store(destdir, dedup):
+    "Open the content store of destdir if dedup is 'hardlink' or 'symlink', else return None"
+    return ContentStore(destdir, symlink=(dedup == 'symlink')) if dedup else None
+
+
+def open_journal(destdir, urlfile, shard, resume, overlap=None):
+    """Open the progress journal of the run if resume is set, or with overlap the
+       :class:`image_loader.ledger.Ledger` shared with overlapping runs, which is
+       used alike; else return None. Raises :class:`image_loader.ledger.RunActive`
+       if the run should leave it to an active one."""
+    if overlap:
+        return open_ledger(destdir, urlfile, shard, overlap)
+    return Journal(journal_path(destdir, urlfile, shard)) if resume else None
+
+
+def url_lines(url_file, shard=None, journal=None, retry_failed=False, unique=None, input_format='lines'):
+    """Return the url lines to download from binary url_file; see :func:`select_urls`.
+       With a journal, lines finished by an earlier run are skipped, or with a
+       ledger those of other runs, and
+       the lines handed out are tracked, as :class:`image_loader.ingest.UrlLine`.
+       With a :class:`UniqueUrls` filter, urls are normalized and duplicates
+       skipped. Records of input_format 'jsonl' or 'csv' are parsed into
+       :class:`image_loader.ingest.UrlRecord`."""
+    if journal is None:
+        lines = read_lines(url_file)
+    else:
+        lines = journal.resume_lines(url_file, retry_failed)
+    if input_format != 'lines':
+        lines = parse_records(lines, input_format)
+    lines = select_urls(lines, shard)
+    if unique is not None:
+        lines = unique.filter(lines)
+    return lines if journal is None else journal.track(lines)
+
+
+def open_health(breaker):
+    "Return the circuit breakers for a run, opening after <breaker> consecutive failures, or None for 0"
+    return HostHealth(breaker) if breaker else None
+
+
+def tally(summary, journal, url, outcome):
+    "Count the outcome of a finished url line, and journal it"
+    summary[outcome] += 1
+    if journal is not None:
+        journal.record(url, outcome)
+
+
+def open_unique(unique_urls):
+    "Return a :class:`UniqueUrls` filter of mode unique_urls, or None"
+    return UniqueUrls(unique_urls) if unique_urls else None
+
+
+def open_metrics(metrics_json, metrics_prom, hooks, shard, progress=0):
+    """Return the instrumentation of a run, writing metrics to the given files, if any, calling hooks,
+       and logging progress every <progress> secs; a :class:`image_loader.metrics.NullMetrics` if none of these"""
+    if not (metrics_json or metrics_prom or hooks or progress):
+        return NullMetrics()
+    return Metrics(hooks or (), shard_path(metrics_json, shard), shard_path(metrics_prom, shard),
+                   {'shard': '{}of{}'.format(*shard)} if shard else None, progress)
+
+
+def open_postprocessor(verify=None, resize=None, convert=None, workers=None):
+    """Return the :class:`image_loader.postprocess.PostProcessor` for the given
+       steps, or None if there are none"""
+    if not (verify or resize or convert):
+        return None
+    from image_loader.postprocess import PostProcessor  # postprocess imports this module
+    return PostProcessor(verify, resize, convert, workers)
+
+
+def submit_postprocess(processor, result, destdir, index=None):
+    """Hand the image of a downloaded result to the post-processor, if any. Urls
+       of images rejected as corrupt are dropped from the index, to be downloaded again."""
+    if processor is not None and result == 'downloaded' and result.path:
+        processor.submit(result, destdir, index.forget if index is not None else None)
+
+
+def open_limiter(adaptive, min_concurrency, max_concurrency):
+    "Return the adaptive concurrency limit of a run if adaptive is set, else None"
+    return AdaptiveLimit(min(min_concurrency, max_concurrency), max_concurrency) if adaptive else None
+
+
+def instrument(metrics, fetch, limiter=None):
+    """Wrap the download function fetch in the probes of metrics, so it returns results,
+       and in the observations of limiter, if any"""
+    fetch = partial(metrics.measure, fetch)
+    if limiter is not None:
+        fetch = partial(limiter.measure, fetch)
+    return fetch
+
+
+def close_stream(index, metrics):
+    "Close the index of a stream of downloads, and write its metrics"
+    if index is not None:
+        index.close()
+    metrics.write()
+
+
+def close_postprocessor(processor, shared=False):
+    "Wait for the post-processing jobs of a stream, if any, and stop its worker processes unless shared"
+    if processor is not None:
+        if shared:
+            processor.wait()
+        else:
+            processor.close()
+
+
+def close_pool(connection_pool, shared=False):
+    "Close the connections of a stream's connection pool and stop its resolver threads, if any, unless shared"
+    if connection_pool is None or shared:
+        return
+    resolver = getattr(connection_pool, 'resolver', None)
+    if resolver is not None:
+        resolver.close()
+    connection_pool.clear()
+
+
+def close_journal(journal, complete):
+    "Close the journal of a run, if any"
+    if journal is not None:
+        journal.close(complete)
+
+
+def stream(urls, destdir, force=False, max_pending=MaxPendingURLs, scheduler=None, use_index=False, dedup=None,
+           chunk_size=CopyBufferSize, max_size=None, fanout=0, retries=MaxRetries, breaker=BreakerThreshold,
+           metrics_json=None, metrics_prom=None, hooks=None, threads=MaxThreads, connections=None, pools=None,
+           adaptive=False, min_concurrency=MinConcurrency, min_ttl=0, verify=None, resize=None, convert=None,
+           post_workers=None, shard=None, connection_pool=None, postprocessor=None, resolve_ahead=0,
+           prewarm=False, progress=0):
+    """Download the images of urls into destdir, yielding a
+       :class:`image_loader.metrics.Result` per url in order of completion
+
+    urls can be any iterable, e.g. a database cursor; it is consumed lazily,
+    at most <max_pending> (plus <resolve_ahead>) urls ahead of the results
+    taken. Closing the generator, e.g. by breaking out of a loop over it,
+    cancels the urls not started yet and waits for those in flight. The
+    remaining arguments are
+    those of :func:`load`; shard only labels the metrics here. Pass a
+    connection_pool from :func:`make_pool` to keep connections open across
+    streams, and a postprocessor from :func:`open_postprocessor` to keep its
+    worker processes; the stream waits for its post-processing jobs at the end.
+    """
     assert_destdir(destdir)
-    connection_pool = urllib3.PoolManager(maxsize=MaxHTTPConnections, num_pools=MaxNumPools)
-    thread_pool = ThreadPoolExecutor(MaxThreads)
-    with get_url_iter(urlfile) as urls:
-        for url in urls:
-            thread_pool.submit(download_url, connection_pool, url, destdir, force)
+    shared_pool = connection_pool is not None
+    if not shared_pool:
+        connection_pool = make_pool(threads, connections, pools, resolve_ahead)
+    processor = postprocessor or open_postprocessor(verify, resize, convert, post_workers)
+    index = open_index(destdir, use_index)
+    health = open_health(breaker)
+    limiter = open_limiter(adaptive, min_concurrency, threads)
+    metrics = open_metrics(metrics_json, metrics_prom, hooks, shard, progress)
+    fetch = partial(download_url, connection_pool, outdir=destdir, force=force, index=index,
+                    store=open_store(destdir, dedup), chunk_size=chunk_size, max_size=max_size, fanout=fanout,
+                    health=health, retries=retries, min_ttl=min_ttl)
+    fetch = instrument(metrics, fetch, limiter)
+    submit = scheduler.submit if scheduler is not None else submit_bounded
+    urls = filter(is_real_string, urls)
+    resolver = getattr(connection_pool, 'resolver', None)
+    if resolver is not None or pools is None:
+        urls = look_ahead(urls, resolve_ahead, connection_pool, resolver, prewarm, MaxPools if pools is None else 0,
+                          span=resolve_ahead + max_pending)  # the urls ahead and in flight
+    thread_pool = ThreadPoolExecutor(threads)
+    try:
+        deferred = []
+        with closing(submit(thread_pool, fetch, urls, max_pending, limiter)) as done:
+            for url, future in done:
+                result = get_outcome(url, future)
+                if result == 'deferred':
+                    deferred.append(url)
+                else:
+                    submit_postprocess(processor, result, destdir, index)
+                    yield result
+        if deferred:
+            _logger.info("Requesting {} deferred urls of hosts that were down".format(len(deferred)))
+            health.final_pass()
+            with closing(submit(thread_pool, fetch, deferred, max_pending, limiter)) as done:
+                for url, future in done:
+                    result = get_outcome(url, future)
+                    submit_postprocess(processor, result, destdir, index)
+                    yield result
+    finally:
+        thread_pool.shutdown()
+        close_pool(connection_pool, shared_pool)
+        close_postprocessor(processor, shared=postprocessor is not None)
+        close_stream(index, metrics)
+
+
+def load(urlfile, destdir, force, max_pending=MaxPendingURLs, shard=None, scheduler=None, use_index=False,
+         dedup=None, chunk_size=CopyBufferSize, max_size=None, resume=False, retry_failed=False,
+         unique_urls=None, fanout=0, retries=MaxRetries, breaker=BreakerThreshold, metrics_json=None,
+         metrics_prom=None, hooks=None, threads=MaxThreads, connections=None, pools=None, adaptive=False,
+         min_concurrency=MinConcurrency, min_ttl=0, verify=None, resize=None, convert=None, post_workers=None,
+         input_format=None, resolve_ahead=0, prewarm=False, overlap=None, progress=0):
+    """Download images with URLs from file into destdir; see :func:`stream`
+
+    urlfile may be compressed (.gz, .zst), or '-' for standard input, and in
+    JSON lines or CSV format with per-url hints; see :mod:`image_loader.ingest`.
+
+    Args:
+      shard ((int, int)): only download urls of shard (index, count)
+      scheduler (:obj:`image_loader.scheduler.HostScheduler`): dispatch urls
+        grouped by host and within per-host limits, instead of in file order
+      use_index (bool): check freshness against the metadata index in destdir,
+        instead of the mtime of local files
+      dedup (str): 'hardlink' or 'symlink' to store each distinct image once
+        and link it into destdir; None to write plain files
+      chunk_size (int): bytes per read from the network
+      max_size (int): skip images larger than this many bytes; None for no limit
+      resume (bool): keep a progress journal in destdir, and skip the urls an
+        interrupted earlier run has finished according to it
+      retry_failed (bool): when resuming, request urls that failed again
+      unique_urls (str): 'exact' or 'bloom' to normalize urls and skip
+        duplicates, see :mod:`image_loader.unique`; None to take urls as they are
+      fanout (int): store images in this many levels of subdirectories of
+        destdir, see :mod:`image_loader.layout`; 0 to store them flat
+      retries (int): retries of a url after transient failures
+      breaker (int): consecutive failures after which a host is considered
+        down, and its remaining urls are deferred; 0 to keep trying all urls
+      metrics_json (str): file to write run metrics to as JSON
+      metrics_prom (str): file to write run metrics to in Prometheus text format
+      hooks ([callable]): called with the :class:`image_loader.metrics.Probe`
+        of every finished url
+      threads (int): download threads
+      connections (int): connections kept per host; default one per thread
+      pools (int): hosts to keep connections to; None to grow their number with
+        the distinct hosts among the urls in flight and ahead, see :mod:`image_loader.resolve`
+      adaptive (bool): adapt the number of concurrent downloads between
+        min_concurrency and threads to the servers' latency and error rate,
+        see :mod:`image_loader.adaptive`
+      min_ttl (int): with use_index, do not request a downloaded url again for
+        this many secs, or as long as its Cache-Control or Expires header
+        allows if that is longer; force requests it anyway
+      verify (str): decode each downloaded image in a worker process, and
+        'quarantine' or 'delete' it if it is corrupt; see :mod:`image_loader.postprocess`
+      resize ([(int, int)]): write thumbnails of each downloaded image, fitting
+        into these (width, height), in worker processes
+      convert (str): write each downloaded image, and its thumbnails, as 'webp',
+        'png' or 'jpeg', in worker processes
+      post_workers (int): worker processes for verify, resize and convert;
+        default one per CPU
+      input_format (str): 'lines', 'jsonl' or 'csv'; None to tell by the
+        file name extension
+      resolve_ahead (int): resolve the hosts of this many urls ahead of the
+        downloads, and cache their addresses; 0 to resolve them on connecting
+      prewarm (bool): with resolve_ahead, also open a connection to each host
+        ahead of its downloads
+      overlap (str): when another run over urlfile into destdir is active,
+        'exit' right away, or 'share' the url file with it; None to run anyway,
+        see :mod:`image_loader.ledger`
+      progress (float): log the counts of outcomes so far every this many secs;
+        0 for only at the end
+
+    Returns:
+      :obj:`collections.Counter`: number of urls per outcome
+    """
+    assert_destdir(destdir)
+    try:
+        journal = open_journal(destdir, urlfile, shard, resume, overlap)
+    except RunActive as e:
+        _logger.warning("{}, exiting".format(e))
+        return Counter()
+    unique = open_unique(unique_urls)
+    summary = Counter()
+    try:
+        with get_url_iter(urlfile) as url_file:
+            lines = url_lines(url_file, shard, journal, retry_failed, unique, detect_format(urlfile, input_format))
+            for result in stream(lines, destdir, force,
+                                 max_pending, scheduler, use_index, dedup, chunk_size, max_size, fanout, retries,
+                                 breaker, metrics_json, metrics_prom, hooks, threads, connections, pools, adaptive,
+                                 min_concurrency, min_ttl, verify, resize, convert, post_workers, shard,
+                                 resolve_ahead=resolve_ahead, prewarm=prewarm, progress=progress):
+                tally(summary, journal, result.url, result.outcome)
+    except BaseException:
+        close_journal(journal, complete=False)
+        raise
+    else:
+        close_journal(journal, complete=True)
+    if unique is not None:
+        summary.update(unique.counts)
+    _logger.info("Finished: {}".format(format_summary(summary)))
+    return summary
+
+
+def supervise(load_func, workers, urlfile, destdir, force, max_pending, **options):
+    """Run load_func in <workers> processes, each on its own shard of urlfile,
+       and merge their summaries. <options> are passed on to load_func."""
+    assert_destdir(destdir)  # once, instead of letting the workers race for it
+    with ProcessPoolExecutor(workers) as process_pool:
+        futures = [process_pool.submit(load_func, urlfile, destdir, force, max_pending,
+                                       shard=(index, workers), **options)
+                   for index in range(workers)]
+        summary = sum((future.result() for future in futures), Counter())
+    _logger.info("Finished all {} shards: {}".format(workers, format_summary(summary)))
+    return summary
+
+
+def shard_spec(s):
+    "Parse a shard spec like '2/8' (0-based index / count) for argparse"
+    try:
+        index, count = (int(part) for part in s.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected INDEX/COUNT, e.g. 0/4: {}".format(s))
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError("shard index must be in [0, {}): {}".format(count, s))
+    return index, count
+
+
+def size_spec(s):
+    "Parse a size like '200x150' (width x height) for argparse"
+    try:
+        width, height = (int(part) for part in s.lower().split('x'))
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected WIDTHxHEIGHT, e.g. 200x200: {}".format(s))
+    if width <= 0 or height <= 0:
+        raise argparse.ArgumentTypeError("width and height must be positive: {}".format(s))
+    return width, height
 
 
 def parse_args(args):
@@ -151,15 +897,20 @@ def parse_args(args):
     Returns:
       :obj:`argparse.Namespace`: command line parameters namespace
     """
+    from image_loader.scheduler import MaxPerHost  # scheduler imports this module
+    from image_loader.watch import PollSecs, RevalidateSecs  # watch imports this module
     parser = argparse.ArgumentParser(
-        description="Download images listed in a file")
+        description="Download images listed in a file",
+        epilog="Options can also be read from files given as @FILE, one per line.",
+        fromfile_prefix_chars='@')
     parser.add_argument(
         '--version',
         action='version',
         version='image_loader {ver}'.format(ver=__version__))
     parser.add_argument(
         dest="fpath",
-        help="file path with image URLs, one per line",
+        help="file path with image URLs, one per line, or in JSON lines (.jsonl) or CSV (.csv) "
+             "format with per-url hints; .gz and .zst files are decompressed; - reads standard input",
         type=str,
         metavar="URLFILE")
     parser.add_argument(
@@ -169,6 +920,12 @@ def parse_args(args):
         help="local output directory",
         type=str,
         metavar="DIRECTORY")
+    parser.add_argument(
+        '--input-format',
+        dest="input_format",
+        help="format of URLFILE: one url per line, or JSON lines or CSV records of url, name "
+             "(local file name) and etag (known ETag) (default: by file name extension)",
+        choices=['lines', 'jsonl', 'csv'])
     parser.add_argument(
         '-f',
         '--force',
@@ -176,6 +933,243 @@ def parse_args(args):
         help="force download even if local cache is up-to-date (default; false)",
         action='store_true',
     )
+    parser.add_argument(
+        '--index',
+        dest="use_index",
+        help="keep server validators (ETag, Last-Modified) of downloads in an index "
+             "in DIRECTORY and check freshness against it, instead of local file times; "
+             "urls are not requested again while their Cache-Control max-age or Expires allows",
+        action='store_true')
+    parser.add_argument(
+        '--min-ttl',
+        dest="min_ttl",
+        help="with --index, do not request a downloaded url again for SECS seconds, even "
+             "if the server allows less (default: 0)",
+        type=float,
+        default=0,
+        metavar="SECS")
+    parser.add_argument(
+        '--dedup',
+        dest="dedup",
+        help="store each distinct image once, in DIRECTORY/.blobs, and expose it under "
+             "its url's file name as a hard or symbolic link",
+        choices=['hardlink', 'symlink'])
+    parser.add_argument(
+        '--chunk-size',
+        dest="chunk_size",
+        help="bytes per read when streaming images to disk (default: {})".format(CopyBufferSize),
+        type=int,
+        default=CopyBufferSize,
+        metavar="BYTES")
+    parser.add_argument(
+        '--max-size',
+        dest="max_size",
+        help="skip images larger than BYTES, by Content-Length or while streaming (default: no limit)",
+        type=int,
+        metavar="BYTES")
+    parser.add_argument(
+        '--resume',
+        dest="resume",
+        help="journal the progress of the run in DIRECTORY, and continue where an "
+             "interrupted run with the same URLFILE left off",
+        action='store_true')
+    parser.add_argument(
+        '--retry-failed',
+        dest="retry_failed",
+        help="with --resume, also request the urls again that failed in the interrupted run",
+        action='store_true')
+    parser.add_argument(
+        '--fanout',
+        dest="fanout",
+        help="store images in LEVELS levels of subdirectories of DIRECTORY, named by "
+             "the MD5 hash of the file name, e.g. 3f/a9/NAME (default: 0, flat); "
+             "migrate-layout moves an existing flat DIRECTORY",
+        type=fanout_levels,
+        default=0,
+        metavar="LEVELS")
+    parser.add_argument(
+        '--unique-urls',
+        dest="unique_urls",
+        help="normalize urls and request each one only once; 'exact' also skips urls "
+             "whose file name an earlier url has taken, 'bloom' uses constant memory "
+             "but may skip a few urls wrongly",
+        choices=['exact', 'bloom'])
+    parser.add_argument(
+        '--retries',
+        dest="retries",
+        help="retry a url up to N times after connection errors, timeouts, 429 or 5xx "
+             "answers, with exponential backoff or as Retry-After asks (default: {})".format(MaxRetries),
+        type=int,
+        default=MaxRetries,
+        metavar="N")
+    parser.add_argument(
+        '--breaker',
+        dest="breaker",
+        help="consider a host down after N consecutive failures, and defer its remaining "
+             "urls to the end of the run; 0 to disable (default: {})".format(BreakerThreshold),
+        type=int,
+        default=BreakerThreshold,
+        metavar="N")
+    parser.add_argument(
+        '--metrics-json',
+        dest="metrics_json",
+        help="write run metrics (throughput, latency percentiles per host, counts per "
+             "outcome and status, time per download phase) to FILE as JSON",
+        type=str,
+        metavar="FILE")
+    parser.add_argument(
+        '--metrics-prom',
+        dest="metrics_prom",
+        help="write run metrics to FILE in Prometheus text format, e.g. for the "
+             "textfile collector of node_exporter",
+        type=str,
+        metavar="FILE")
+    parser.add_argument(
+        '--max-pending',
+        dest="max_pending",
+        help="maximum number of urls in flight at any time "
+             "(default: {} for threads, 1000 for asyncio)".format(MaxPendingURLs),
+        type=int,
+        metavar="N")
+    parser.add_argument(
+        '--threads',
+        dest="threads",
+        help="download threads, i.e. concurrent downloads of the threads engine "
+             "(default: {})".format(MaxThreads),
+        type=int,
+        default=MaxThreads,
+        metavar="N")
+    parser.add_argument(
+        '--connections',
+        dest="connections",
+        help="connections to keep open per host (default: one per thread; "
+             "no limit for asyncio)",
+        type=int,
+        metavar="N")
+    parser.add_argument(
+        '--pools',
+        dest="pools",
+        help="hosts to keep connections to, for the threads engine (default: {} at first, "
+             "grown to the distinct hosts among the urls in flight and ahead, up to {})".format(MaxNumPools, MaxPools),
+        type=int,
+        metavar="N")
+    parser.add_argument(
+        '--overlap',
+        dest="overlap",
+        help="when a run over the same URLFILE into OUTDIR is still active, detected by a "
+             "lease file there, 'exit' right away, or 'share' the rest of the url file with "
+             "it, in chunks claimed from a ledger file (default: run anyway; only files "
+             "being written by the other run are skipped)",
+        choices=['exit', 'share'])
+    parser.add_argument(
+        '--resolve-ahead',
+        dest="resolve_ahead",
+        help="resolve the host names of the next N urls ahead of their downloads, in a few "
+             "threads, and cache their addresses (default: 0, resolve them on connecting)",
+        type=int,
+        default=0,
+        metavar="N")
+    parser.add_argument(
+        '--prewarm',
+        dest="prewarm",
+        help="with --resolve-ahead, also open a connection to each host ahead of its "
+             "downloads, for the threads engine",
+        action='store_true')
+    parser.add_argument(
+        '--adaptive',
+        dest="adaptive",
+        help="adapt the number of concurrent downloads to the servers, growing it while "
+             "latency and error rate stay low, up to --threads (or --max-pending for asyncio)",
+        action='store_true')
+    parser.add_argument(
+        '--min-concurrency',
+        dest="min_concurrency",
+        help="with --adaptive, the fewest concurrent downloads (default: {})".format(MinConcurrency),
+        type=int,
+        default=MinConcurrency,
+        metavar="N")
+    parser.add_argument(
+        '--verify',
+        dest="verify",
+        help="decode each downloaded image completely, in worker processes, and move "
+             "corrupt ones to DIRECTORY/.quarantine or delete them; requires Pillow",
+        choices=['quarantine', 'delete'])
+    parser.add_argument(
+        '--resize',
+        dest="resize",
+        help="write a thumbnail fitting into WxH of each downloaded image to "
+             "DIRECTORY/.variants/WxH, in worker processes; repeatable; requires Pillow",
+        type=size_spec,
+        action='append',
+        metavar="WxH")
+    parser.add_argument(
+        '--convert',
+        dest="convert",
+        help="write each downloaded image, and its thumbnails, in FORMAT too, to "
+             "DIRECTORY/.variants/FORMAT; requires Pillow",
+        choices=['webp', 'png', 'jpeg'])
+    parser.add_argument(
+        '--post-workers',
+        dest="post_workers",
+        help="worker processes for --verify, --resize and --convert (default: one per CPU)",
+        type=int,
+        metavar="N")
+    parser.add_argument(
+        '--engine',
+        dest="engine",
+        help="download engine (default: threads); asyncio requires aiohttp",
+        choices=['threads', 'asyncio'],
+        default='threads')
+    parser.add_argument(
+        '--shard',
+        dest="shard",
+        help="only download the urls of shard INDEX (0-based) out of COUNT, "
+             "e.g. to spread a url file over several machines",
+        type=shard_spec,
+        metavar="INDEX/COUNT")
+    parser.add_argument(
+        '--workers',
+        dest="workers",
+        help="split the url file into N shards and download them in N worker processes "
+             "(default: 1)",
+        type=int,
+        default=1,
+        metavar="N")
+    parser.add_argument(
+        '--per-host',
+        dest="per_host",
+        help="schedule urls grouped by host, with at most N concurrent requests per host "
+             "(default with --host-rate: {})".format(MaxPerHost),
+        type=int,
+        metavar="N")
+    parser.add_argument(
+        '--host-rate',
+        dest="host_rate",
+        help="schedule urls grouped by host, with at most R requests per second per host, "
+             "and at most --per-host concurrent ones",
+        type=float,
+        metavar="R")
+    parser.add_argument(
+        '--watch',
+        dest="watch",
+        help="keep running: download all urls, then the lines appended to URLFILE as they come, "
+             "over warm connections; SIGHUP reloads the options and requests all urls again",
+        action='store_true')
+    parser.add_argument(
+        '--poll',
+        dest="poll",
+        help="with --watch, look for new lines every SECS seconds (default: {})".format(PollSecs),
+        type=float,
+        default=PollSecs,
+        metavar="SECS")
+    parser.add_argument(
+        '--revalidate',
+        dest="revalidate",
+        help="with --watch, request all urls again every SECS seconds, 0 for only on SIGHUP "
+             "(default: {})".format(RevalidateSecs),
+        type=float,
+        default=RevalidateSecs,
+        metavar="SECS")
     parser.add_argument(
         '-v',
         '--verbose',
@@ -190,18 +1184,93 @@ def parse_args(args):
         help="set loglevel to DEBUG",
         action='store_const',
         const=logging.DEBUG)
-    return parser.parse_args(args)
+    parser.add_argument(
+        '--log-format',
+        dest="log_format",
+        help="write log lines as 'text' or as 'json' lines, from a background thread "
+             "(default: text)",
+        choices=Formats,
+        default='text')
+    parser.add_argument(
+        '--log-sample',
+        dest="log_sample",
+        help="log only this fraction of the per-url info lines, e.g. 0.01; warnings and errors "
+             "are all logged",
+        type=float,
+        metavar="FRACTION")
+    parser.add_argument(
+        '--log-rate',
+        dest="log_rate",
+        help="log at most N per-url info lines per second",
+        type=float,
+        metavar="N")
+    parser.add_argument(
+        '--progress',
+        dest="progress",
+        help="log the number of urls per outcome every SECS seconds (default: only at the end)",
+        type=float,
+        default=0,
+        metavar="SECS")
+    args = parser.parse_args(args)
+    if args.workers > 1 and args.shard:
+        parser.error("--workers and --shard are mutually exclusive")
+    if args.chunk_size <= 0:
+        parser.error("--chunk-size must be positive")
+    for option, value in (('--threads', args.threads), ('--max-pending', args.max_pending),
+                          ('--connections', args.connections), ('--pools', args.pools),
+                          ('--min-concurrency', args.min_concurrency)):
+        if value is not None and value <= 0:
+            parser.error("{} must be positive".format(option))
+    if is_stdin(args.fpath) and (args.resume or args.watch or args.workers > 1):
+        parser.error("standard input can be read only once, not with --resume, --watch or --workers")
+    if args.fpath.endswith('.zst') and args.resume:
+        parser.error("--resume needs to seek in URLFILE, which .zst files do not support")
+    if is_compressed(args.fpath) and args.watch:
+        parser.error("--watch needs an uncompressed URLFILE to follow")
+    if args.min_ttl and not args.use_index:
+        parser.error("--min-ttl needs --index, which records the lifetimes")
+    if args.overlap and (args.resume or args.watch or is_stdin(args.fpath) or is_compressed(args.fpath)):
+        parser.error("--overlap splits a plain URLFILE into chunks by byte offset, and does not combine "
+                     "with --resume or --watch")
+    if args.log_sample is not None and not 0 <= args.log_sample <= 1:
+        parser.error("--log-sample must be a fraction between 0 and 1")
+    if args.log_rate is not None and args.log_rate <= 0:
+        parser.error("--log-rate must be positive")
+    if args.prewarm and not args.resolve_ahead:
+        parser.error("--prewarm needs --resolve-ahead, which reads the urls ahead")
+    if args.watch and (args.workers > 1 or args.engine != 'threads' or args.resume):
+        parser.error("--watch runs the threads engine in one process, and does not combine with --resume")
+    return args
 
 
-def setup_logging(loglevel):
-    """Setup basic logging
+def setup_logging(loglevel, log_format='text', sample=None, rate=None):
+    """Setup basic logging, written to stdout by a background thread; see :mod:`image_loader.logs`
 
     Args:
       loglevel (int): minimum loglevel for emitting messages
+      log_format (str): 'text' or 'json' lines
+      sample (float): fraction of the per-url info lines to log; None for all
+      rate (float): per-url info lines to log per second at most; None for no limit
     """
-    logformat = "[%(asctime)s] %(levelname)s:%(name)s:%(message)s"
-    logging.basicConfig(level=loglevel, stream=sys.stdout,
-                        format=logformat, datefmt="%Y-%m-%d %H:%M:%S")
+    logging.basicConfig(level=loglevel, handlers=[make_handler(log_format, sample, rate)])
+
+
+def stream_options(args):
+    "Return the keyword arguments of :func:`stream` given by the parsed command line args"
+    scheduler = None
+    if args.per_host or args.host_rate:
+        from image_loader.scheduler import HostScheduler, MaxPerHost
+        if not args.per_host:
+            _logger.info("Scheduling urls by host, with at most %d concurrent requests per host (--per-host)",
+                         MaxPerHost)
+        scheduler = HostScheduler(args.per_host or MaxPerHost, args.host_rate)
+    return dict(scheduler=scheduler, use_index=args.use_index, dedup=args.dedup, chunk_size=args.chunk_size,
+                max_size=args.max_size, fanout=args.fanout, retries=args.retries, breaker=args.breaker,
+                metrics_json=args.metrics_json, metrics_prom=args.metrics_prom, threads=args.threads,
+                connections=args.connections, pools=args.pools, adaptive=args.adaptive,
+                min_concurrency=args.min_concurrency, min_ttl=args.min_ttl, verify=args.verify, resize=args.resize,
+                convert=args.convert, post_workers=args.post_workers, resolve_ahead=args.resolve_ahead,
+                prewarm=args.prewarm, progress=args.progress)
 
 
 def main(args):
@@ -210,10 +1279,24 @@ def main(args):
     Args:
       args ([str]): command line parameter list
     """
-    args = parse_args(args)
-    setup_logging(args.loglevel)
+    args_list, args = args, parse_args(args)
+    setup_logging(args.loglevel, args.log_format, args.log_sample, args.log_rate)
     _logger.debug("Starting downloading images...")
-    load(args.fpath, args.outdir, args.force)
+    if args.engine == 'asyncio':
+        from image_loader import aioloader
+        load_func, max_pending = aioloader.load, args.max_pending or aioloader.MaxPendingTasks
+    else:
+        load_func, max_pending = load, args.max_pending or 4 * args.threads
+    if args.watch:
+        from image_loader.watch import Watcher
+        Watcher(partial(parse_args, args_list)).run()
+        return
+    options = dict(stream_options(args), resume=args.resume, retry_failed=args.retry_failed,
+                   unique_urls=args.unique_urls, input_format=args.input_format, overlap=args.overlap)
+    if args.workers > 1:
+        supervise(load_func, args.workers, args.fpath, args.outdir, args.force, max_pending, **options)
+    else:
+        load_func(args.fpath, args.outdir, args.force, max_pending, shard=args.shard, **options)
 
 
 def run():
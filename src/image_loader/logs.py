@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+  logs -- logging off the download threads
+
+  With -v, every url makes at least one log line. Written synchronously,
+  those lines have the download threads take turns on the handler lock and
+  wait for stdout. Instead, a :class:`LogQueueHandler` only puts the records
+  on a queue; a listener thread formats and writes them, as text or as JSON
+  lines. Each process starts its own listener on first use, so the worker
+  processes of --workers get theirs, and stops it on exit.
+
+  Per-url info lines, those logged with ``extra={'url': url}``, may be
+  sampled (``--log-sample``) or rate-limited (``--log-rate``) by a
+  :class:`UrlLogFilter`, before they are even queued; warnings and errors
+  always pass. The progress lines of :class:`image_loader.metrics.Metrics`
+  (``--progress``) then tell how many urls went which way.
+"""
+from __future__ import division, print_function, absolute_import
+
+import json
+import logging
+import multiprocessing.util
+import os
+import queue
+import random
+import sys
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+Formats = ('text', 'json')  # for --log-format
+TextFormat = "[%(asctime)s] %(levelname)s:%(name)s:%(message)s"
+DateFormat = "%Y-%m-%d %H:%M:%S"
+
+
+class JsonFormatter(logging.Formatter):
+    "Formats log records as JSON lines, with the url of per-url records as a field of its own"
+
+    def format(self, record):
+        entry = {
+            'time': '{}.{:03d}Z'.format(time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)),
+                                        int(record.msecs)),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if hasattr(record, 'url'):
+            entry['url'] = record.url
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+def make_formatter(log_format='text'):
+    "Return the formatter for log_format, 'text' or 'json'"
+    return JsonFormatter() if log_format == 'json' else logging.Formatter(TextFormat, DateFormat)
+
+
+class UrlLogFilter(logging.Filter):
+    """Lets through a <sample> fraction of the per-url info lines, and at most
+       <rate> of them per second; other records all pass. Safe to share between threads."""
+
+    def __init__(self, sample=None, rate=None):
+        super(UrlLogFilter, self).__init__()
+        self.sample = sample
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.allowance = rate or 0  # token bucket of lines, refilled at <rate> per second
+        self.last = time.monotonic()
+
+    def filter(self, record):
+        if record.levelno > logging.INFO or not hasattr(record, 'url'):
+            return True
+        if self.sample is not None and random.random() >= self.sample:
+            return False
+        if self.rate is not None:
+            with self.lock:
+                now = time.monotonic()
+                self.allowance = min(self.rate, self.allowance + (now - self.last) * self.rate)
+                self.last = now
+                if self.allowance < 1:
+                    return False
+                self.allowance -= 1
+        return True
+
+
+class LogQueueHandler(QueueHandler):
+    """Queues log records for a listener thread, which passes them to handlers;
+       see the module docs
+
+    Args:
+      handlers ([logging.Handler]): write the records, in the listener thread
+    """
+
+    def __init__(self, handlers):
+        super(LogQueueHandler, self).__init__(queue.SimpleQueue())
+        self.handlers = handlers
+        self.listener = None
+        self.finalizer = None  # stops the listener, once
+        self.pid = None
+
+    def prepare(self, record):
+        return record  # formatted by the listener, not by the thread logging it
+
+    def emit(self, record):
+        if self.pid != os.getpid():  # first use in this process; called with the handler lock held
+            self.start()
+        super(LogQueueHandler, self).emit(record)
+
+    def start(self):
+        "Start the listener thread of this process"
+        self.queue = queue.SimpleQueue()  # not the one of the parent process
+        self.listener = QueueListener(self.queue, *self.handlers, respect_handler_level=True)
+        self.listener.start()
+        self.pid = os.getpid()
+        # run at exit of the main process, and of worker processes, which skip atexit
+        self.finalizer = multiprocessing.util.Finalize(None, self.listener.stop, exitpriority=0)
+
+    def stop(self):
+        "Write the records queued so far, and stop the listener thread of this process"
+        if self.pid == os.getpid():
+            self.finalizer()
+            self.pid = self.listener = self.finalizer = None
+
+
+def make_handler(log_format='text', sample=None, rate=None):
+    """Return a :class:`LogQueueHandler` writing to stdout in log_format 'text' or
+       'json', letting through only a sample and at most rate per second of the
+       per-url info lines; see :class:`UrlLogFilter`"""
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(make_formatter(log_format))
+    queue_handler = LogQueueHandler([handler])
+    if sample is not None or rate is not None:
+        queue_handler.addFilter(UrlLogFilter(sample, rate))
+    return queue_handler
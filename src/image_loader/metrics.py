@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+"""
+  metrics -- timings of downloads and run statistics
+
+  Each download is wrapped in a :class:`Probe` that records when its phases
+  end:
+
+    request   until the response headers are in: DNS, connect, TLS, time to
+              first byte, and retries
+    transfer  streaming the body to disk
+    commit    moving the file into place, or linking it to the content store
+
+  together with status, local path, bytes written, content hash, outcome
+  and error. Urls that were not requested, e.g. as their local copy is
+  fresh still, count by outcome only, not into latencies and statuses.
+  Finished probes are passed to the hooks of embedding callers, returned as
+  a :class:`Result`, and aggregated into a run summary with throughput and
+  per-host latency percentiles, written as JSON and in the Prometheus text
+  format (for node_exporter's textfile collector), and with progress
+  logged every few seconds while the run goes on. The current probe is
+  found through a context variable, so the download code only pays for a
+  lookup per phase outside of a measured download. Runs that ask for no
+  metrics, hooks or progress get a :class:`NullMetrics`, whose probes are
+  timed for their :class:`Result`, but neither resolve a host nor aggregate.
+"""
+from __future__ import division, print_function, absolute_import
+
+import bisect
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+
+# - runtime params -------------------------------------------------------------
+LatencyBuckets = [0.001 * 2 ** (i / 4) for i in range(80)]  # 1ms .. 17min, 19% apart
+Quantiles = (0.5, 0.95, 0.99)
+MaxHostsReported = 50  # hosts with most requests to report latencies for
+# - params end -----------------------------------------------------------------
+
+_logger = logging.getLogger(__name__)
+
+NoRequestOutcomes = (None, 'deferred')  # outcomes of urls that were not requested, whatever the probe says
+
+_probe = contextvars.ContextVar('probe', default=None)
+
+
+def mark(phase):
+    "Note the end of phase for the download in progress, if it is instrumented"
+    probe = _probe.get()
+    if probe is not None:
+        probe.mark(phase)
+
+
+def note(**fields):
+    "Set fields (status, path, length, digest, error, requested) of the download in progress, if it is instrumented"
+    probe = _probe.get()
+    if probe is not None:
+        for name, value in fields.items():
+            setattr(probe, name, value)
+
+
+class Result(str):
+    """Outcome of a download, e.g. 'downloaded', with its details as attributes:
+
+      url: the url as given
+      path: the local file, for downloaded and fresh images
+      status: the HTTP status, None without a response
+      bytes: the size of the image written
+      digest: the sha256 hex digest of the image written
+      timings: secs per phase, see the module docs, and in total
+      error: what went wrong, for failed and skipped urls, if known
+      requested: False if no request was made for the url, e.g. for a fresh local copy
+    """
+
+    def __new__(cls, outcome, url, path=None, status=None, bytes=0, timings=None, error=None, digest=None,
+                requested=True):
+        self = str.__new__(cls, outcome)
+        self.url = url
+        self.path = path
+        self.status = status
+        self.bytes = bytes
+        self.timings = timings or {}
+        self.error = error
+        self.digest = digest
+        self.requested = requested
+        return self
+
+    def __reduce__(self):
+        return Result, (str(self), self.url, self.path, self.status, self.bytes, self.timings, self.error,
+                        self.digest, self.requested)
+
+    @property
+    def outcome(self):
+        return str(self)
+
+
+class Probe(object):
+    "Measurements of one download"
+    __slots__ = ('url', 'host', 'status', 'path', 'length', 'digest', 'outcome', 'error', 'started', 'stamp',
+                 'phases', 'total', 'requested')
+
+    def __init__(self, url, host):
+        self.url = url
+        self.host = host
+        self.status = None
+        self.path = None
+        self.length = 0
+        self.digest = None
+        self.outcome = None
+        self.error = None
+        self.started = self.stamp = time.perf_counter()
+        self.phases = {}  # phase -> secs
+        self.total = None
+        self.requested = True  # unless noted otherwise
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases[phase] = self.phases.get(phase, 0) + now - self.stamp
+        self.stamp = now
+
+    def finish(self, outcome):
+        self.outcome = outcome
+        self.total = time.perf_counter() - self.started
+        if outcome in NoRequestOutcomes:
+            self.requested = False
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__ if name not in ('started', 'stamp', 'requested')}
+
+    def result(self, url):
+        "Return the :class:`Result` of the finished download of url, as given"
+        timings = dict(self.phases, total=self.total) if self.total is not None else {}
+        return Result(self.outcome, url, self.path, self.status, self.length, timings, self.error, self.digest,
+                      self.requested)
+
+
+class Histogram(object):
+    "Latency distribution in exponential buckets, for percentiles in constant memory"
+
+    def __init__(self):
+        self.counts = [0] * (len(LatencyBuckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, secs):
+        self.counts[bisect.bisect_left(LatencyBuckets, secs)] += 1
+        self.count += 1
+        self.sum += secs
+
+    def quantile(self, q):
+        "Return the upper bound of the bucket holding quantile q, or None if empty"
+        rank, seen = q * self.count, 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return LatencyBuckets[min(i, len(LatencyBuckets) - 1)]
+        return None
+
+
+class Metrics(object):
+    """Collects the probes of a run, safe to share between threads
+
+    Args:
+      hooks ([callable]): called with every finished :class:`Probe`, in the
+        thread or task that made the download
+      json_path (str): file to write the run summary to as JSON, if any
+      prom_path (str): file to write the run summary to in Prometheus text
+        format, if any
+      labels (dict): extra labels for all Prometheus samples
+      progress (float): log a progress line with the counts of outcomes every
+        this many secs; 0 for none
+    """
+
+    def __init__(self, hooks=(), json_path=None, prom_path=None, labels=None, progress=0):
+        from image_loader.loader import url_host  # loader imports this module
+        self.url_host = url_host
+        self.hooks = list(hooks)
+        self.json_path = json_path
+        self.prom_path = prom_path
+        self.labels = labels or {}
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.outcomes = Counter()
+        self.statuses = Counter()
+        self.phases = Counter()       # phase -> total secs
+        self.bytes = 0
+        self.latency = defaultdict(Histogram)  # host -> Histogram; '' for all hosts
+        self.progress = progress
+        self.next_report = self.started + progress
+
+    def start(self, url):
+        return Probe(url, self.url_host(url))
+
+    def finish(self, probe, outcome):
+        probe.finish(outcome)
+        with self.lock:
+            self.outcomes[outcome] += 1
+            self.bytes += probe.length or 0
+            if probe.requested:
+                self.statuses[probe.status or 'error'] += 1
+                self.phases.update(probe.phases)
+                self.latency[probe.host].observe(probe.total)
+                self.latency[''].observe(probe.total)
+            report = self.progress and time.time() >= self.next_report
+            if report:
+                self.next_report = time.time() + self.progress
+                elapsed = time.time() - self.started
+                finished, outcomes, mbytes = sum(self.outcomes.values()), sorted(self.outcomes.items()), self.bytes / 1e6
+        if report:
+            _logger.info("Progress: %d urls, %.1f urls/s, %.2f MB/s - %s", finished, finished / elapsed,
+                         mbytes / elapsed, ", ".join("{} {}".format(count, outcome) for outcome, count in outcomes))
+        for hook in self.hooks:
+            hook(probe)
+
+    def measure(self, func, url):
+        """Call func(url) as an instrumented download, returning its :class:`Result`.
+           Exceptions are logged, and make the outcome 'failed'."""
+        probe = self.start(url.strip())
+        token = _probe.set(probe)
+        outcome = 'failed'
+        try:
+            outcome = func(url)
+        except Exception as e:
+            self.fail(probe, e)
+        finally:
+            _probe.reset(token)
+            self.finish(probe, outcome)
+        return probe.result(url)
+
+    async def measure_async(self, func, url):
+        "Await func(url) as an instrumented download, returning its :class:`Result`; see :meth:`measure`"
+        probe = self.start(url.strip())
+        token = _probe.set(probe)
+        outcome = 'failed'
+        try:
+            outcome = await func(url)
+        except Exception as e:
+            self.fail(probe, e)
+        finally:
+            _probe.reset(token)
+            self.finish(probe, outcome)
+        return probe.result(url)
+
+    def fail(self, probe, error):
+        _logger.error("Unable to download url: %s - error: %r", probe.url, error, extra={'url': probe.url})
+        probe.error = repr(error)
+
+    def summary(self):
+        "Return the run statistics as a dict"
+        with self.lock:
+            elapsed = max(time.time() - self.started, 1e-9)
+            finished = sum(self.outcomes.values())
+            hosts = sorted((host for host in self.latency if host), key=lambda host: -self.latency[host].count)
+            return {
+                'started': self.started,
+                'elapsed_secs': elapsed,
+                'urls': finished,
+                'urls_per_sec': finished / elapsed,
+                'bytes': self.bytes,
+                'bytes_per_sec': self.bytes / elapsed,
+                'outcomes': dict(self.outcomes),
+                'statuses': {str(status): count for status, count in self.statuses.items()},
+                'phase_secs': dict(self.phases),
+                'latency': {host or '*': self.latency_summary(host) for host in [''] + hosts[:MaxHostsReported]},
+            }
+
+    def latency_summary(self, host):
+        histogram = self.latency[host]
+        result = {'count': histogram.count, 'sum': histogram.sum}
+        result.update(('p{:g}'.format(100 * q), histogram.quantile(q)) for q in Quantiles)
+        return result
+
+    def write(self):
+        "Write the run summary to the configured files"
+        summary = self.summary()
+        if self.json_path:
+            write_atomic(self.json_path, json.dumps(summary, indent=2, sort_keys=True) + '\n')
+        if self.prom_path:
+            write_atomic(self.prom_path, format_prometheus(summary, self.labels))
+        _logger.info("Throughput: {:.1f} urls/s, {:.2f} MB/s".format(
+            summary['urls_per_sec'], summary['bytes_per_sec'] / 1e6))
+
+
+class NullMetrics(Metrics):
+    """Stands in for :class:`Metrics` in runs that ask for no metrics, hooks or
+       progress: downloads still return a :class:`Result` with their timings, but
+       are not aggregated under the lock, nor by host"""
+
+    def __init__(self):
+        self.hooks = []
+
+    def start(self, url):
+        return Probe(url, None)
+
+    def finish(self, probe, outcome):
+        probe.finish(outcome)
+
+    def write(self):
+        pass
+
+
+def shard_path(path, shard=None):
+    "Return the file path for the metrics of shard (index, count), e.g. run-1of4.prom for run.prom"
+    if path is None or shard is None:
+        return path
+    root, ext = os.path.splitext(path)
+    return '{}-{}of{}{}'.format(root, shard[0], shard[1], ext)
+
+
+def write_atomic(path, text):
+    "Replace file path with text, so collectors never read a partial file"
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def format_labels(labels):
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in sorted(labels.items())) + '}' if labels else ''
+
+
+def format_prometheus(summary, labels):
+    "Render a run summary in the Prometheus text exposition format"
+    lines = []
+
+    def metric(name, kind, help, samples):
+        lines.append("# HELP image_loader_{} {}".format(name, help))
+        lines.append("# TYPE image_loader_{} {}".format(name, kind))
+        for extra, value in samples:
+            lines.append("image_loader_{}{} {}".format(name, format_labels(dict(labels, **extra)), value))
+
+    metric('run_start_time_seconds', 'gauge', "Start of the last run, in epoch seconds",
+           [({}, summary['started'])])
+    metric('run_duration_seconds', 'gauge', "Duration of the last run",
+           [({}, summary['elapsed_secs'])])
+    metric('urls', 'gauge', "Urls finished in the last run, by outcome",
+           [({'outcome': outcome}, count) for outcome, count in sorted(summary['outcomes'].items())])
+    metric('responses', 'gauge', "Responses in the last run, by HTTP status",
+           [({'status': status}, count) for status, count in sorted(summary['statuses'].items())])
+    metric('bytes', 'gauge', "Bytes written in the last run", [({}, summary['bytes'])])
+    metric('phase_seconds', 'gauge', "Time spent in each phase of the downloads, summed over all urls",
+           [({'phase': phase}, secs) for phase, secs in sorted(summary['phase_secs'].items())])
+    lines.append("# HELP image_loader_latency_seconds Duration of downloads in the last run, by host")
+    lines.append("# TYPE image_loader_latency_seconds summary")
+    for host, latency in summary['latency'].items():
+        host_labels = dict(labels, host=host)
+        for q in Quantiles:
+            value = latency['p{:g}'.format(100 * q)]
+            if value is not None:
+                lines.append("image_loader_latency_seconds{} {}".format(
+                    format_labels(dict(host_labels, quantile=q)), value))
+        lines.append("image_loader_latency_seconds_sum{} {}".format(format_labels(host_labels), latency['sum']))
+        lines.append("image_loader_latency_seconds_count{} {}".format(format_labels(host_labels), latency['count']))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+"""
+  postprocess -- CPU-bound work on downloaded images, in worker processes
+
+  Decoding an image completely, which is the only way to tell a truncated or
+  otherwise corrupt file from a good one, and rendering thumbnails or other
+  formats of it are CPU-bound; in threads, they would take turns on the GIL.
+  A :class:`PostProcessor` hands each downloaded image to a pool of worker
+  processes as soon as it is committed, while its bytes are still in the page
+  cache and while the next downloads go on. When more than a few jobs per
+  worker are pending, handing over blocks, which slows down the downloads
+  instead of letting images drop out of the page cache before they are
+  processed.
+
+  Corrupt images are moved to <outdir>/.quarantine, or deleted. Variants go
+  to <outdir>/.variants/<WxH or format>/, under the image's path relative to
+  outdir. A stamp file at the same relative path below <outdir>/.processed
+  records the content hash and the steps the image was processed with, so
+  an image downloaded again with the same content is not processed again.
+  Keeping the stamps out of the image directories spares them an extra entry
+  per image, and lets ``migrate-layout`` move stamps and variants along with
+  their images. Formats Pillow cannot read, like SVG, are left alone.
+
+  Requires the optional ``Pillow`` package (``pip install image_loader[images]``).
+"""
+from __future__ import division, print_function, absolute_import
+
+import json
+import logging
+import multiprocessing
+import os
+import threading
+from collections import Counter, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from image_loader.layout import make_dirs
+from image_loader.loader import format_summary
+from image_loader.storage import open_temp, replace_link
+from image_loader.validate import SniffBytes, sniff_image
+
+try:
+    from PIL import Image
+except ImportError:  # optional dependency, checked in PostProcessor
+    Image = None
+
+# - runtime params -------------------------------------------------------------
+QuarantineDirName = '.quarantine'
+VariantsDirName = '.variants'
+StampDirName = '.processed'
+JobsPerWorker = 4  # pending jobs per worker process before handing over images blocks
+# - params end -----------------------------------------------------------------
+
+Formats = {'webp': ('WEBP', '.webp'), 'png': ('PNG', '.png'), 'jpeg': ('JPEG', '.jpg')}  # for --convert
+
+_logger = logging.getLogger(__name__)
+
+# verify: None, 'quarantine' or 'delete'; variants: ((label, (width, height) or None, format or None), ...)
+Steps = namedtuple('Steps', 'verify variants')
+
+
+def make_steps(verify=None, resize=(), convert=None):
+    """Return the :obj:`Steps` to apply to each image: thumbnails fitting into
+       each size of resize, and the full image, in format convert if given"""
+    variants = [('{}x{}'.format(*size), tuple(size), convert) for size in resize or ()]
+    if convert:
+        variants.append((convert, None, convert))
+    return Steps(verify, tuple(variants))
+
+
+def stamp_name(path, outdir):
+    "Return the path of the stamp file recording how the image at path below outdir was processed"
+    return os.path.join(outdir, StampDirName, os.path.relpath(path, outdir))
+
+
+def read_stamp(path, outdir):
+    "Return the state recorded in the stamp file of the image at path, or None"
+    try:
+        with open(stamp_name(path, outdir)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_stamp(path, outdir, state):
+    stamp = stamp_name(path, outdir)
+    make_dirs(os.path.dirname(stamp))
+    with open(stamp, 'w') as f:
+        json.dump(state, f)
+
+
+def drop_stamp(path, outdir):
+    try:
+        os.unlink(stamp_name(path, outdir))
+    except FileNotFoundError:
+        pass
+
+
+def readable(path):
+    "Check if the image at path is in a format Pillow reads, judged by its first bytes"
+    with open(path, 'rb') as f:
+        kind = sniff_image(f.read(SniffBytes))
+    return kind is not None and kind.upper() in Image.registered_extensions().values()
+
+
+def reject(path, outdir, verify):
+    "Move the corrupt image at path to the quarantine in outdir, or delete it if verify is 'delete'"
+    drop_stamp(path, outdir)
+    if verify == 'delete':
+        os.unlink(path)
+        return
+    target = os.path.join(outdir, QuarantineDirName, os.path.relpath(path, outdir))
+    make_dirs(os.path.dirname(target))
+    if os.path.islink(path):  # --dedup symlink; a moved relative link would point nowhere
+        replace_link(os.path.realpath(path), target, True)
+        os.unlink(path)
+    else:
+        os.replace(path, target)
+
+
+def write_variant(image, target, size=None, convert=None):
+    "Write image to target, shrunk to fit into size, in format convert, if given; atomically"
+    variant = image
+    if size:
+        variant = image.copy()
+        variant.thumbnail(size)
+    image_format = Formats[convert][0] if convert else image.format
+    if image_format == 'JPEG' and variant.mode not in ('RGB', 'L'):
+        variant = variant.convert('RGB')
+    dirname = os.path.dirname(target)
+    make_dirs(dirname)
+    with open_temp(dirname) as out_file:
+        try:
+            variant.save(out_file, format=image_format)
+        except BaseException:
+            os.unlink(out_file.name)
+            raise
+    os.replace(out_file.name, target)
+
+
+def variant_path(path, outdir, label, convert=None):
+    "Return the path of variant <label> of the image at path"
+    relpath = os.path.relpath(path, outdir)
+    if convert:
+        relpath = os.path.splitext(relpath)[0] + Formats[convert][1]
+    return os.path.join(outdir, VariantsDirName, label, relpath)
+
+
+def process_image(path, outdir, digest, steps):
+    """Apply steps to the image at path, with the sha256 hex digest; run in a
+       worker process. Return (outcome, detail), where outcome is 'processed',
+       'unchanged' if the same content went through the same steps before,
+       'unsupported' for formats Pillow does not read, or 'corrupt'."""
+    state = {'digest': digest, 'steps': json.loads(json.dumps(steps))}  # as read back from a stamp
+    if digest and read_stamp(path, outdir) == state:
+        return 'unchanged', None
+    if not readable(path):
+        return 'unsupported', None
+    image = None
+    try:
+        image = Image.open(path)
+        image.load()  # decodes all of it
+    except (OSError, SyntaxError, ValueError, Image.DecompressionBombError) as e:  # Pillow's ways to say corrupt
+        if image is not None:
+            image.close()
+        if steps.verify:
+            reject(path, outdir, steps.verify)
+        return 'corrupt', str(e)
+    with image:
+        for label, size, convert in steps.variants:
+            write_variant(image, variant_path(path, outdir, label, convert), size, convert)
+    write_stamp(path, outdir, state)
+    return 'processed', None
+
+
+def move_processed(source, target, outdir):
+    """Move the stamp and the variants of an image moved from source to target
+       below outdir, e.g. by ``migrate-layout``; nothing if it was not processed"""
+    state = read_stamp(source, outdir)
+    if state is None:
+        return
+    for label, size, convert in Steps(*state['steps']).variants:
+        variant = variant_path(target, outdir, label, convert)
+        make_dirs(os.path.dirname(variant))
+        try:
+            os.replace(variant_path(source, outdir, label, convert), variant)
+        except FileNotFoundError:
+            pass  # e.g. removed by hand
+    stamp = stamp_name(target, outdir)
+    make_dirs(os.path.dirname(stamp))
+    os.replace(stamp_name(source, outdir), stamp)
+
+
+class PostProcessor(object):
+    """Post-processing of downloaded images in worker processes, safe to
+       share between threads and streams; see the module docs
+
+    Args:
+      verify (str): 'quarantine' or 'delete' images that do not decode; None
+        to keep them
+      resize ([(int, int)]): write thumbnails fitting into these (width, height)
+      convert (str): write images and thumbnails as 'webp', 'png' or 'jpeg'
+      workers (int): worker processes; default one per CPU
+    """
+
+    def __init__(self, verify=None, resize=(), convert=None, workers=None):
+        if Image is None:
+            raise RuntimeError("Post-processing requires Pillow: pip install image_loader[images]")
+        self.steps = make_steps(verify, resize, convert)
+        workers = workers or os.cpu_count() or 1
+        # workers are started on demand, while download threads run, which rules out a plain fork
+        self.pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('forkserver'))
+        self.slots = threading.BoundedSemaphore(JobsPerWorker * workers)
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.pending = set()
+        self.counts = Counter()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def submit(self, result, outdir, on_corrupt=None):
+        """Process the image of a downloaded :class:`image_loader.metrics.Result`
+           below outdir; blocks while too many jobs are pending. on_corrupt is
+           called with the url of a corrupt image after it was rejected."""
+        self.slots.acquire()
+        try:
+            future = self.pool.submit(process_image, result.path, outdir, result.digest, self.steps)
+        except BaseException:
+            self.slots.release()
+            raise
+        with self.lock:
+            self.pending.add(future)
+        future.add_done_callback(partial(self.finished, result, on_corrupt))
+
+    def finished(self, result, on_corrupt, future):
+        try:
+            outcome, detail = future.result()
+        except Exception as e:
+            _logger.error("Unable to post-process image: %s - error: %r", result.path, e,
+                          extra={'url': result.url.strip()})
+            outcome = 'failed'
+        else:
+            if outcome == 'corrupt':
+                _logger.error("Image is corrupt%s: %s - %s",
+                              {'quarantine': ", quarantined", 'delete': ", deleted"}.get(self.steps.verify, ""),
+                              result.path, detail, extra={'url': result.url.strip()})
+                if self.steps.verify and on_corrupt is not None:
+                    on_corrupt(result.url.strip())
+        with self.lock:
+            self.counts[outcome] += 1
+            self.pending.discard(future)
+            self.idle.notify_all()
+        self.slots.release()
+
+    def wait(self):
+        "Wait until the jobs submitted so far are done, including their consequences"
+        with self.idle:
+            self.idle.wait_for(lambda: not self.pending)
+
+    def close(self):
+        "Wait for the pending jobs, and stop the worker processes"
+        self.wait()
+        self.pool.shutdown()
+        if self.counts:
+            _logger.info("Post-processed images: {}".format(format_summary(self.counts)))
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+"""
+  resolve -- resolving host names ahead of time, and sizing the connection pools
+
+  urllib3 resolves the host name of a url in the download thread that opens
+  a connection to it, each time it opens one; a slow name server stalls the
+  thread before the first byte is requested. :func:`look_ahead` reads a
+  window of urls ahead of the downloads, and has the hosts that are new in
+  the window resolved by a few resolver threads meanwhile, into the cache of
+  a :class:`Resolver`, which connections take their addresses from.
+  getaddrinfo does not tell the TTL of DNS records, so addresses are kept for
+  a fixed CacheSecs, as in the DNS cache of aiohttp; failed lookups are kept
+  for NegativeCacheSecs. With prewarm, a connection to each new host is opened
+  ahead of time as well, TCP and TLS handshake included, and put into the pool
+  of the host, where a download thread picks it up.
+
+  urllib3 keeps the connections of the <pools> hosts used most recently, and
+  closes those of the least recently used host when another one comes up. No
+  single number suits both url files with a few hosts and those with many;
+  unless pools is given, :func:`look_ahead` counts the distinct hosts among the
+  urls in flight and ahead, and grows the number of pools to that, up to
+  MaxPools, so the urls of a host coming up again soon find its connections open.
+"""
+from __future__ import division, print_function, absolute_import
+
+import logging
+import socket
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import urllib3
+from urllib3.connection import port_by_scheme
+from urllib3.exceptions import LocationParseError, NewConnectionError
+from urllib3.poolmanager import pool_classes_by_scheme
+from urllib3.util.connection import allowed_gai_family
+
+# - runtime params -------------------------------------------------------------
+ResolverThreads = 8      # concurrent lookups (and connections with prewarm) ahead of the downloads
+CacheSecs = 300          # how long resolved addresses are used
+NegativeCacheSecs = 30   # how long a failed lookup is remembered
+MaxCachedHosts = 100000  # hosts in the cache; the least recently used are dropped
+MaxPools = 512           # upper bound of automatically grown pools; each keeps its idle connections open
+# - params end -----------------------------------------------------------------
+
+_logger = logging.getLogger(__name__)
+
+
+class Resolver(object):
+    """A cache of host addresses, filled ahead of time by resolver threads;
+       safe to share between threads and streams, see the module docs
+
+    Args:
+      threads (int): concurrent lookups ahead of time
+      family (int): address family to look up; default as urllib3 does
+    """
+
+    def __init__(self, threads=ResolverThreads, family=None):
+        self.family = allowed_gai_family() if family is None else family
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix='resolver')
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()  # host: (expiry, or None while pending, Future of [(family, proto, address)])
+        self.counts = Counter()
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def entry(self, host):
+        "Return the future addresses of host, and whether it is a new one to resolve; call with the lock held"
+        expires, future = self.cache.get(host, (0, None))
+        if future is None or (expires is not None and expires <= time.time()):
+            future = Future()
+            self.cache[host] = (None, future)
+            if len(self.cache) > MaxCachedHosts:
+                self.cache.popitem(last=False)
+            return future, True
+        self.cache.move_to_end(host)
+        return future, False
+
+    def resolve(self, host, future):
+        "Look up the addresses of host into future, and keep them for a while"
+        try:
+            if self.closed:
+                raise OSError("Resolver is closed")
+            infos = socket.getaddrinfo(host, None, self.family, socket.SOCK_STREAM)
+        except OSError as e:
+            future.set_exception(e)
+            outcome, ttl = 'failed', NegativeCacheSecs
+        else:
+            addresses = []
+            for family, _, proto, _, sockaddr in infos:
+                if (family, proto, sockaddr[0]) not in addresses:
+                    addresses.append((family, proto, sockaddr[0]))
+            future.set_result(addresses)
+            outcome, ttl = 'resolved', CacheSecs
+        with self.lock:
+            self.counts[outcome] += 1
+            if self.cache.get(host, (None, None))[1] is future:
+                self.cache[host] = (time.time() + ttl, future)
+
+    def lookup(self, host):
+        """Return the addresses of host as [(family, proto, address)], from the
+           cache if it has them or a lookup of them is under way; raises OSError"""
+        host = host.strip('[]')
+        with self.lock:
+            future, new = self.entry(host)
+            if not new:
+                self.counts['cached'] += 1
+        if new:
+            self.resolve(host, future)
+        return future.result()
+
+    def cached(self, host):
+        "Return the addresses of host if the cache has them already, else None"
+        with self.lock:
+            expires, future = self.cache.get(host.strip('[]'), (None, None))
+        if expires is not None and expires > time.time() and future.exception() is None:
+            return future.result()
+        return None
+
+    def prefetch(self, host):
+        "Have a resolver thread look up host, unless the cache has it"
+        host = host.strip('[]')
+        with self.lock:
+            future, new = self.entry(host)
+        if new:
+            self.executor.submit(self.resolve, host, future)
+
+    def submit(self, func, *args):
+        "Run func(*args) in a resolver thread"
+        return self.executor.submit(func, *args)
+
+    def close(self):
+        "Stop the resolver threads, failing the lookups that have not started yet"
+        self.closed = True
+        self.executor.shutdown()
+        if self.counts:
+            _logger.info("Host lookups: {}".format(
+                ", ".join("{} {}".format(count, outcome) for outcome, count in sorted(self.counts.items()))))
+
+
+class ResolvedConnection(object):
+    "Mixin of urllib3 connection classes, connecting to the addresses of their host from <resolver>"
+
+    resolver = None
+
+    def _new_conn(self):
+        host = self._dns_host
+        try:
+            addresses = self.resolver.lookup(host)
+        except OSError as e:
+            raise NewConnectionError(self, "Failed to resolve {!r}: {!r}".format(host, e))
+        error = NewConnectionError(self, "No addresses for {!r}".format(host))
+        try:
+            for _, _, address in addresses:
+                self._dns_host = address  # the host name is still used for the Host header and TLS
+                try:
+                    return super(ResolvedConnection, self)._new_conn()
+                except NewConnectionError as e:
+                    error = e
+        finally:
+            self._dns_host = host
+        raise error
+
+
+def pool_classes(resolver):
+    "Return urllib3 pool classes by scheme, whose connections take host addresses from resolver"
+    classes = {}
+    for scheme, pool_class in pool_classes_by_scheme.items():
+        connection_class = type('Resolved' + pool_class.ConnectionCls.__name__,
+                                (ResolvedConnection, pool_class.ConnectionCls), {'resolver': resolver})
+        classes[scheme] = type('Resolved' + pool_class.__name__, (pool_class,), {'ConnectionCls': connection_class})
+    return classes
+
+
+class ResolvingPoolManager(urllib3.PoolManager):
+    "A urllib3 pool manager whose connections take the addresses of their hosts from a :class:`Resolver`"
+
+    def __init__(self, resolver, **kwargs):
+        super(ResolvingPoolManager, self).__init__(**kwargs)
+        self.resolver = resolver
+        self.pool_classes_by_scheme = pool_classes(resolver)
+
+
+def grow_pools(manager, count):
+    "Let the urllib3 pool manager keep connections to <count> hosts, unless it does already"
+    if count > manager.pools._maxsize:  # its RecentlyUsedContainer has no public way to resize
+        manager.pools._maxsize = count
+
+
+def warm(manager, scheme, host, port):
+    "Open a connection to host in its pool of manager, unless that pool has opened connections already"
+    try:
+        pool = manager.connection_from_host(host, port, scheme)
+        if pool.num_connections:
+            return
+        conn = pool._get_conn()  # the pool has no public way to take a connection opened elsewhere
+        try:
+            conn.connect()
+        except Exception:
+            conn.close()
+            raise
+        finally:
+            pool._put_conn(conn)
+    except Exception as e:
+        _logger.debug("Unable to connect ahead of time: {}://{}:{} - error: {!r}".format(scheme, host, port, e))
+
+
+def url_origin(url):
+    "Return (scheme, host, port) of url, by which urllib3 tells its pools apart; None if there is no host"
+    try:
+        parsed = urllib3.util.parse_url(url.strip())
+    except LocationParseError:
+        return None
+    if not parsed.host:
+        return None
+    scheme = (parsed.scheme or 'http').lower()
+    return scheme, parsed.host.lower(), parsed.port or port_by_scheme.get(scheme, 80)
+
+
+def look_ahead(urls, window, manager=None, resolver=None, prewarm=False, max_pools=0, span=None):
+    """Yield urls as they come, reading <window> urls ahead of the caller. Hosts
+       new among the last <span> urls read, by default the window, are resolved
+       by resolver, and with prewarm connected to in manager, by resolver threads
+       meanwhile; with max_pools, manager keeps connections to as many hosts as
+       there are among those urls, up to that."""
+    span = max(span or 0, window, 1)
+    ahead = deque()
+    recent = deque()  # origins of the last <span> urls read
+    origins = Counter()  # of recent
+    for url in urls:
+        origin = url_origin(url)
+        recent.append(origin)
+        origins[origin] += 1
+        if len(recent) > span:
+            oldest = recent.popleft()
+            origins[oldest] -= 1
+            if not origins[oldest]:
+                del origins[oldest]
+        if origin is not None and origins[origin] == 1:
+            if resolver is not None:
+                if prewarm:
+                    resolver.submit(warm, manager, *origin)  # resolves the host on connecting
+                else:
+                    resolver.prefetch(origin[1])
+            if max_pools:
+                grow_pools(manager, min(len(origins), max_pools))
+        ahead.append(url)
+        if len(ahead) > window:
+            yield ahead.popleft()
+    while ahead:
+        yield ahead.popleft()
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+  scheduler -- host-aware dispatching of downloads
+
+  Groups pending urls by host and hands them out in per-host batches, so
+  keep-alive connections get reused and the connection pools of different
+  hosts do not keep evicting each other. Each host is limited to a number of
+  concurrent requests and, optionally, to a request rate (token bucket).
+"""
+from __future__ import division, print_function, absolute_import
+
+import logging
+import time
+from collections import OrderedDict, Counter, deque
+from concurrent.futures import wait, FIRST_COMPLETED
+
+from image_loader.adaptive import pending_limit
+from image_loader.loader import url_host
+
+# - runtime params -------------------------------------------------------------
+MaxPerHost = 4           # concurrent requests per host
+LookaheadFactor = 10     # urls buffered for grouping, as multiple of the pending limit
+ThrottlePauseSecs = 5    # pause for a host after it answered 429 or 503
+# - params end -----------------------------------------------------------------
+
+_logger = logging.getLogger(__name__)
+
+
+class TokenBucket(object):
+    """Rate limiter granting <rate> requests per second on average, and bursts
+       of up to <burst> requests"""
+
+    def __init__(self, rate, burst=1, clock=time.monotonic):
+        assert rate > 0 and burst >= 1, "Invalid rate limit: {}/s, burst {}".format(rate, burst)
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = burst
+        self.stamp = clock()
+
+    def refill(self):
+        now = self.clock()
+        if now > self.stamp:
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+
+    def take(self):
+        "Take a token; return 0 on success, else the seconds until one is available"
+        self.refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        else:
+            return (1 - self.tokens) / self.rate + max(0, self.stamp - self.clock())
+
+    def is_full(self):
+        self.refill()
+        return self.tokens >= self.burst
+
+
+class HostScheduler(object):
+    """Queue of urls grouped by host, handing out urls that may be requested now
+
+    Args:
+      max_per_host (int): concurrent requests per host
+      rate (float): requests per second per host; None for no rate limit
+      lookahead (int): number of urls to buffer for grouping; None to derive
+        it from the pending limit
+    """
+
+    def __init__(self, max_per_host=MaxPerHost, rate=None, lookahead=None, clock=time.monotonic):
+        assert max_per_host > 0, "Need at least one request per host: {}".format(max_per_host)
+        self.max_per_host = max_per_host
+        self.rate = rate
+        self.lookahead = lookahead
+        self.clock = clock
+        self.queues = OrderedDict()  # host -> deque of urls, in order of first appearance
+        self.active = Counter()      # host -> requests in flight
+        self.buckets = {}            # host -> TokenBucket
+        self.paused = {}             # host -> time until which the server asked us to back off
+        self.queued = 0
+
+    def __len__(self):
+        return self.queued
+
+    def put(self, url):
+        host = url_host(url)
+        self.queues.setdefault(host, deque()).append(url)
+        if self.rate and host not in self.buckets:
+            self.buckets[host] = TokenBucket(self.rate, max(1, int(self.rate)), self.clock)
+        self.queued += 1
+
+    def get(self):
+        """Return (url, None) with the next url that may be requested now,
+           (None, secs) if rate limits allow the next request in <secs> seconds,
+           or (None, None) if nothing can be requested before a request finishes"""
+        delay = None
+        for host, queue in self.queues.items():  # earlier hosts first, to batch their urls
+            if self.active[host] >= self.max_per_host:
+                continue
+            wait_secs = self.paused.get(host, 0) - self.clock()
+            if wait_secs <= 0:
+                self.paused.pop(host, None)
+                wait_secs = self.buckets[host].take() if self.rate else 0
+            if wait_secs:
+                delay = wait_secs if delay is None else min(delay, wait_secs)
+                continue
+            url = queue.popleft()
+            if not queue:
+                del self.queues[host]
+            self.active[host] += 1
+            self.queued -= 1
+            return url, None
+        return None, delay
+
+    def task_done(self, url, outcome):
+        "Account for a finished request"
+        host = url_host(url)
+        self.active[host] -= 1
+        if outcome == 'throttled':
+            _logger.info("Server asks to slow down, pausing host for {}s: {}".format(ThrottlePauseSecs, host))
+            self.paused[host] = self.clock() + ThrottlePauseSecs
+        if not self.active[host]:
+            del self.active[host]
+            if host not in self.queues and host in self.buckets and self.buckets[host].is_full():
+                del self.buckets[host]  # an idle host with a full bucket has no state worth keeping
+
+    def abandon(self, urls):
+        "Forget the queued urls, and account for the given ones as finished, when a stream is closed early"
+        for url in urls:
+            self.task_done(url, None)
+        self.queues.clear()
+        self.queued = 0
+
+    def submit(self, executor, func, items, max_pending, limiter=None):
+        """Submit func(url) to executor for the urls in items, in host batches
+           and within the host limits, with at most <max_pending> unfinished
+           futures, or fewer as limiter allows. Yields (url, future) pairs in order of completion; see
+           :func:`image_loader.loader.submit_bounded`."""
+        assert max_pending > 0, "Need at least one pending slot: {}".format(max_pending)
+        lookahead = self.lookahead or LookaheadFactor * max_pending
+        items = iter(items)
+        exhausted = False
+        pending = {}
+        try:
+            while True:
+                while not exhausted and len(self) < lookahead:
+                    item = next(items, None)
+                    if item is None:
+                        exhausted = True
+                    else:
+                        self.put(item)
+                delay = None
+                while len(pending) < pending_limit(max_pending, limiter):
+                    url, delay = self.get()
+                    if url is None:
+                        break
+                    pending[executor.submit(func, url)] = url
+                if not pending:
+                    if delay is None:
+                        return  # nothing in flight and nothing queued
+                    time.sleep(delay)
+                    continue
+                done, _ = wait(pending, timeout=delay, return_when=FIRST_COMPLETED)
+                for future in done:
+                    url = pending.pop(future)
+                    self.task_done(url, None if future.exception() else future.result())
+                    yield url, future
+        finally:
+            for future in pending:  # when closed early
+                future.cancel()
+            self.abandon(pending.values())
@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+"""
+  storage -- writing downloaded images to disk
+
+  Bodies are streamed into a temporary file next to their destination and
+  renamed into place when complete, so readers never see partial files and
+  an existing copy stays intact until it is replaced.
+
+  When a download breaks off, the partial file is kept, together with a
+  sidecar file recording how much of it is written and the validator
+  (strong ETag or Last-Modified) of the response, so a later attempt can
+  ask for just the rest with Range and If-Range.
+
+  The partial file is locked while it is written, so overlapping runs skip
+  what another run is downloading already. POSIX locks belong to the
+  process, so the partial files this process writes are claimed in a set as
+  well, which keeps its own threads from writing the same file twice.
+
+  Optionally, every distinct image body is stored once, under its SHA-256
+  digest, in a blob store inside the output directory (content-addressed
+  storage). The file names the loader exposes are then hard or symbolic
+  links to those blobs, so identical images from different urls share disk
+  space and page cache.
+"""
+from __future__ import division, print_function, absolute_import
+
+import errno
+import fcntl
+import json
+import logging
+import os
+import threading
+import uuid
+
+# - runtime params -------------------------------------------------------------
+BlobDirName = '.blobs'
+MaxPreallocate = 256 * 1024 * 1024  # bytes; longer bodies, e.g. by a bogus Content-Length, grow as written
+# - params end -----------------------------------------------------------------
+
+_logger = logging.getLogger(__name__)
+
+_claimed = set()  # absolute paths of the partial files written by this process
+_claimed_lock = threading.Lock()
+
+
+def open_temp(dirpath):
+    """Open a new, uniquely named temporary file in dirpath for binary writing.
+       Unlike tempfile, the file mode honors the umask like a plain open() would."""
+    return open(os.path.join(dirpath, '.tmp-{}'.format(uuid.uuid4().hex)), 'xb')
+
+
+def partial_name(file_name):
+    "Return the path of the partial download file for file_name"
+    dirname, basename = os.path.split(file_name)
+    return os.path.join(dirname, '.{}.part'.format(basename))
+
+
+def resume_name(file_name):
+    "Return the path of the sidecar file describing the kept partial download of file_name"
+    return partial_name(file_name) + '.resume'
+
+
+def open_partial(path):
+    "Open path for binary reading and writing, creating it if needed, but without truncating it"
+    return open(path, 'r+b', opener=lambda path, flags: os.open(path, flags | os.O_CREAT, 0o666))
+
+
+def read_resume(file_name):
+    """Return (offset, validator) to resume the kept partial download of
+       file_name from, or None if there is none"""
+    try:
+        with open(resume_name(file_name)) as f:
+            state = json.load(f)
+        offset = os.path.getsize(partial_name(file_name))
+    except (OSError, ValueError):
+        return None
+    return (offset, state['validator']) if 0 < offset == state.get('offset') else None
+
+
+def drop_resume(file_name):
+    """Forget the kept partial download of file_name, if any; the partial
+       file itself is reused by the next download"""
+    try:
+        os.unlink(resume_name(file_name))
+    except FileNotFoundError:
+        pass
+
+
+def try_lock(out_file):
+    """Try locking the out_file, to allow for overlapping runs of the script.
+       Return False if somebody else holds the lock."""
+    try:
+        fcntl.lockf(out_file, fcntl.LOCK_EX | fcntl.LOCK_NB)  # POSIX locking should be enough for Debian deployments
+    except OSError as e:
+        if e.errno in (errno.EACCES, errno.EAGAIN):
+            _logger.error("Cannot obtain lock for localfile, skipping: %s", out_file.name)
+            return False
+        else:
+            raise
+    else:
+        return True
+
+
+def claim(path):
+    "Claim the partial file at path for a thread of this process; return False if another one has it"
+    path = os.path.abspath(path)
+    with _claimed_lock:
+        if path in _claimed:
+            return False
+        _claimed.add(path)
+        return True
+
+
+def release(out_file):
+    "Give up the claim on the partial file out_file, if any"
+    with _claimed_lock:
+        _claimed.discard(os.path.abspath(out_file.name))
+
+
+def is_current(out_file):
+    "Return True if out_file is still the file at its path, rather than moved into place or removed meanwhile"
+    try:
+        st = os.stat(out_file.name)
+    except FileNotFoundError:
+        return False
+    fst = os.fstat(out_file.fileno())
+    return (st.st_dev, st.st_ino) == (fst.st_dev, fst.st_ino)
+
+
+def lock_partial(path):
+    """Open and lock the partial file at path; return None if another thread
+       or run is writing it"""
+    if not claim(path):
+        _logger.error("Localfile is being written already, skipping: %s", path)
+        return None
+    while True:
+        out_file = open_partial(path)
+        if not try_lock(out_file):
+            out_file.close()
+            release(out_file)
+            return None
+        if is_current(out_file):
+            return out_file
+        out_file.close()  # committed or discarded by another run between open and lock; open the new one
+
+
+def preallocate(out_file, length, max_size=None):
+    """Reserve <length> bytes for out_file in one go, to avoid fragmentation;
+       not for lengths beyond max_size (None for no limit) or :data:`MaxPreallocate`"""
+    if length and length <= min(MaxPreallocate, max_size or MaxPreallocate) and hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(out_file.fileno(), 0, length)
+        except OSError as e:
+            if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL):  # e.g. on some network file systems
+                raise
+
+
+def open_output(file_name, length=None, store=None, offset=0, max_size=None):
+    """Open a preallocated temporary file to stream the body for file_name into.
+       Without a content store, the temporary file is the partial file of
+       file_name, and it is locked before anything else happens, so
+       overlapping runs and threads skip what another one is downloading already.
+
+    Args:
+      length (int): expected body length, from Content-Length, if known
+      store (:obj:`ContentStore`): content store to write the body to
+      offset (int): resume the kept partial file of file_name, if it has
+        exactly this many bytes; the file is positioned at its end then,
+        else at 0
+      max_size (int): maximum image size in bytes, not to preallocate beyond
+
+    Returns:
+      file: open temporary file, or None if somebody else is writing it
+    """
+    if store is not None:
+        out_file = store.open_temp()
+    else:
+        out_file = lock_partial(partial_name(file_name))
+        if out_file is None:
+            return None
+    try:
+        if store is None:
+            size = out_file.seek(0, os.SEEK_END)
+            if size:
+                drop_resume(file_name)  # rewritten if this download breaks off too
+                if size != offset:
+                    out_file.seek(0)
+                    out_file.truncate()  # leftovers of a crashed run
+        preallocate(out_file, length, max_size)
+    except BaseException:
+        discard_output(out_file)  # e.g. out of disk space; releases the claim and the lock
+        raise
+    return out_file
+
+
+def commit_output(out_file, file_name, digest, store=None):
+    "Move a completely written temporary file into place as file_name"
+    out_file.truncate()  # drop preallocated space the body did not fill
+    try:
+        if store is not None:
+            out_file.close()
+            store.commit(out_file.name, digest, file_name)
+        else:
+            os.replace(out_file.name, file_name)  # while holding the lock
+            out_file.close()
+    finally:
+        release(out_file)
+
+
+def discard_output(out_file):
+    "Remove an incompletely written temporary file"
+    out_file.close()
+    try:
+        os.unlink(out_file.name)
+    finally:
+        release(out_file)
+
+
+def keep_output(out_file, file_name, validator):
+    """Keep the partial file of file_name after its download broke off, to be
+       resumed later with validator; see :func:`read_resume`. Without a
+       validator or any bytes written, the file is discarded."""
+    offset = out_file.tell()
+    if not validator or not offset:
+        discard_output(out_file)
+        return
+    try:
+        out_file.truncate()  # drop preallocated space
+        with open(resume_name(file_name), 'w') as f:  # while holding the lock
+            json.dump({'offset': offset, 'validator': validator}, f)
+    except BaseException:
+        discard_output(out_file)
+        raise
+    out_file.close()
+    release(out_file)
+    _logger.info("Keeping %d bytes of interrupted download to resume: %s", offset, file_name)
+
+
+def replace_link(target, file_name, symlink):
+    "Atomically make file_name a hard link (or a relative symlink) to target"
+    tmp_name = os.path.join(os.path.dirname(file_name), '.tmp-{}'.format(uuid.uuid4().hex))
+    if symlink:
+        os.symlink(os.path.relpath(target, os.path.dirname(file_name) or '.'), tmp_name)
+    else:
+        os.link(target, tmp_name)
+    try:
+        os.replace(tmp_name, file_name)
+    except OSError:
+        os.unlink(tmp_name)
+        raise
+
+
+class ContentStore(object):
+    """Blob store under <outdir>/.blobs, with blobs at ab/cd/<digest>
+
+    Args:
+      symlink (bool): expose images as symbolic instead of hard links
+    """
+
+    def __init__(self, outdir, symlink=False):
+        self.root = os.path.join(outdir, BlobDirName)
+        self.symlink = symlink
+        os.makedirs(self.root, mode=0o750, exist_ok=True)
+
+    def blob_path(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def open_temp(self):
+        "Open a temporary file to stream a body into, before its digest is known"
+        return open_temp(self.root)
+
+    def commit(self, tmp_name, digest, file_name):
+        """Move the temporary file tmp_name into the store as blob <digest>,
+           unless that blob exists already, and link file_name to the blob"""
+        blob = self.blob_path(digest)
+        if os.path.exists(blob):
+            _logger.debug("Content is known already, deduplicating: %s", file_name)
+            os.unlink(tmp_name)
+        else:
+            os.makedirs(os.path.dirname(blob), mode=0o750, exist_ok=True)
+            os.replace(tmp_name, blob)
+        try:
+            replace_link(blob, file_name, self.symlink)
+        except OSError as e:
+            if e.errno == errno.EMLINK and not self.symlink:  # too many hard links to one inode
+                replace_link(blob, file_name, True)
+            else:
+                raise
+        return blob
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+  unique -- normalization and deduplication of input urls
+
+  Url files merged from several feeds list the same image many times, often
+  with cosmetic differences. Urls are normalized, and each one is only
+  passed on the first time it is seen, so tens of millions of urls fit in
+  bounded memory:
+
+  - exact mode keeps 64 bit digests in open-addressing hash tables over
+    arrays, which are kept between a quarter and half full: one of the urls
+    (8 bytes per slot), and one mapping the digests of local file names to
+    those of their urls (16 bytes per slot). That is 48 to 96 bytes per
+    url, and half as much again for a moment while a table doubles.
+    Different urls that map to the same local file name are detected, too;
+    only the first of them is passed on.
+  - bloom mode sets bits in a Bloom filter of fixed size: 24 MB for
+    :data:`BloomCapacity` and :data:`BloomErrorRate`, about 2.4 bytes per
+    url, however many urls there are; beyond its capacity, the rate of
+    urls wrongly dropped as duplicates grows.
+"""
+from __future__ import division, print_function, absolute_import
+
+import hashlib
+import logging
+import math
+import os
+from array import array
+from collections import Counter
+from urllib.parse import urlsplit, urlunsplit
+
+from image_loader.ingest import UrlLine, url_hints
+
+# - runtime params -------------------------------------------------------------
+BloomCapacity = 10 * 1000 * 1000  # urls a Bloom filter is sized for
+BloomErrorRate = 1e-4             # probability of dropping a url that is not a duplicate
+# - params end -----------------------------------------------------------------
+
+_logger = logging.getLogger(__name__)
+
+DefaultPorts = {'http': 80, 'https': 443}
+
+
+def normalize_url(url):
+    """Normalize url: strip whitespace, lower-case scheme and host, drop
+       default ports, the fragment and empty userinfo; path and query stay as they are"""
+    url = url.strip()
+    try:
+        parts = urlsplit(url)
+        port = parts.port
+    except ValueError:  # e.g. an invalid IPv6 host, or a port that is not a number; fails on download
+        return url
+    if not parts.scheme or not parts.netloc:
+        return url
+    scheme = parts.scheme.lower()
+    host = parts.hostname or ''
+    if ':' in host:
+        host = '[{}]'.format(host)  # IPv6
+    netloc = host if port in (None, DefaultPorts.get(scheme)) else '{}:{}'.format(host, port)
+    if parts.username:
+        netloc = '{}@{}'.format(
+            parts.username + (':' + parts.password if parts.password is not None else ''), netloc)
+    return urlunsplit((scheme, netloc, parts.path or '/', parts.query, ''))
+
+
+def digest(s):
+    "Return a 128 bit digest of string s, as two non-zero 64 bit ints"
+    value = hashlib.blake2b(s.encode('utf-8'), digest_size=16).digest()
+    return (int.from_bytes(value[:8], 'little') or 1), (int.from_bytes(value[8:], 'little') or 1)
+
+
+class DigestTable(object):
+    """Hash table of non-zero 64 bit keys, with optional 64 bit values, in
+       arrays with linear probing; 0 marks empty slots"""
+
+    def __init__(self, size=1 << 16, with_values=False):
+        self.size = size
+        self.count = 0
+        self.keys = array('Q', bytes(8 * size))
+        self.values = array('Q', bytes(8 * size)) if with_values else None
+
+    def __len__(self):
+        return self.count
+
+    def slot(self, key):
+        mask = self.size - 1
+        i = key & mask
+        while self.keys[i] and self.keys[i] != key:
+            i = (i + 1) & mask
+        return i
+
+    def get(self, key):
+        "Return the value of key (True without values), or None"
+        i = self.slot(key)
+        if not self.keys[i]:
+            return None
+        return self.values[i] if self.values is not None else True
+
+    def add(self, key, value=0):
+        "Add key, unless present; return True if it has been added"
+        i = self.slot(key)
+        if self.keys[i]:
+            return False
+        self.keys[i] = key
+        if self.values is not None:
+            self.values[i] = value
+        self.count += 1
+        if 2 * self.count > self.size:
+            self.grow()
+        return True
+
+    def grow(self):
+        keys, values = self.keys, self.values
+        self.__init__(2 * self.size, values is not None)
+        for i, key in enumerate(keys):
+            if key:
+                self.add(key, values[i] if values is not None else 0)
+
+
+class BloomFilter(object):
+    "Set of digests with false positives at <error_rate>, in constant memory"
+
+    def __init__(self, capacity=BloomCapacity, error_rate=BloomErrorRate):
+        self.bits = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.bits / capacity * math.log(2)))
+        self.array = bytearray((self.bits + 7) // 8)
+
+    def add(self, key):
+        "Add the (h1, h2) digest key; return True if it has not been present"
+        h1, h2 = key
+        added = False
+        for i in range(self.hashes):
+            bit = (h1 + i * h2) % self.bits
+            byte, mask = bit >> 3, 1 << (bit & 7)
+            if not self.array[byte] & mask:
+                self.array[byte] |= mask
+                added = True
+        return added
+
+
+class UniqueUrls(object):
+    """Filter for url lines, passing each normalized url on only once
+
+    Args:
+      mode (str): 'exact' for a hash table of digests, which also detects
+        output file name collisions, or 'bloom' for a fixed size Bloom filter
+    """
+
+    def __init__(self, mode='exact'):
+        assert mode in ('exact', 'bloom'), "Unknown mode: {}".format(mode)
+        self.seen = DigestTable() if mode == 'exact' else BloomFilter()
+        self.names = DigestTable(with_values=True) if mode == 'exact' else None
+        self.counts = Counter()
+
+    def is_new(self, url, name=None):
+        key = digest(url)
+        if not self.seen.add(key[0] if self.names is not None else key):
+            self.counts['duplicate'] += 1
+            _logger.debug("Skipping duplicate url: {}".format(url))
+            return False
+        if self.names is not None:
+            name_key = digest(name or os.path.basename(url))[0]
+            if not self.names.add(name_key, key[0]) and self.names.get(name_key) != key[0]:
+                self.counts['collision'] += 1
+                _logger.error("Url maps to the same local file as an earlier one, skipping: {}".format(url))
+                return False
+        return True
+
+    def filter(self, urls):
+        "Yield the urls not seen before, normalized; url lines keep their offsets and hints"
+        for url in urls:
+            normalized = normalize_url(url)
+            if self.is_new(normalized, url_hints(url)[0]):
+                yield url.relabel(normalized) if isinstance(url, UrlLine) else normalized
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+  validate -- early content checks for downloads
+
+  A Content-Type of image/* is not proof of an image: misconfigured servers
+  label HTML error pages as image/jpeg. The first bytes of a body are
+  compared against the signatures of common image formats, before anything
+  is written to disk.
+"""
+from __future__ import division, print_function, absolute_import
+
+import logging
+
+# - runtime params -------------------------------------------------------------
+SniffBytes = 256  # body prefix needed to recognize an image format, incl. an XML declaration before <svg
+# - params end -----------------------------------------------------------------
+
+_logger = logging.getLogger(__name__)
+
+# (format, offset, signature); all have to match
+Signatures = [
+    ('png',  [(0, b'\x89PNG\r\n\x1a\n')]),
+    ('jpeg', [(0, b'\xff\xd8\xff')]),
+    ('gif',  [(0, b'GIF87a')]),
+    ('gif',  [(0, b'GIF89a')]),
+    ('webp', [(0, b'RIFF'), (8, b'WEBP')]),
+    ('avif', [(4, b'ftypavif')]),
+    ('avif', [(4, b'ftypavis')]),
+    ('bmp',  [(0, b'BM')]),
+    ('tiff', [(0, b'II*\0')]),
+    ('tiff', [(0, b'MM\0*')]),
+    ('ico',  [(0, b'\0\0\1\0')]),
+]
+
+
+class ValidationError(Exception):
+    "Raised when a body turns out not to be an acceptable image"
+
+
+def sniff_image(head):
+    """Return the image format the bytes head start with, e.g. 'png', or None
+
+    Args:
+      head (bytes): first bytes of the body, at least :data:`SniffBytes` unless
+        the body is shorter
+    """
+    head = bytes(head)
+    for name, parts in Signatures:
+        if all(head[offset:offset + len(sig)] == sig for offset, sig in parts):
+            return name
+    text = head.lstrip(b'\xef\xbb\xbf \t\r\n')  # SVG is text, possibly behind a BOM
+    if text.startswith(b'<svg') or (text.startswith(b'<?xml') and b'<svg' in text):
+        return 'svg'
+    return None
+
+
+def check_head(head, url):
+    "Raise :class:`ValidationError` unless head is the start of an image"
+    if sniff_image(head) is None:
+        raise ValidationError("Content is not a known image format: {} - starts with {!r}".format(
+            url, bytes(head[:16])))
+
+
+def check_size(length, max_size, url):
+    "Raise :class:`ValidationError` if length exceeds max_size (None for no limit)"
+    if max_size is not None and length is not None and length > max_size:
+        raise ValidationError("Image exceeds the size limit of {} bytes: {}".format(max_size, url))
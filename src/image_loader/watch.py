@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+  watch -- keep running, and download urls as they are appended to the url file
+
+  Instead of a cron job starting a new loader every few minutes, each run
+  paying for interpreter startup, cold connections and a rescan of the whole
+  url file, ``loader --watch`` keeps running. It downloads all urls once,
+  then polls the url file for appended lines and downloads just those, over
+  a connection pool that stays warm between batches. Lines are taken once
+  they end in a newline, so a writer appending to the file is never read
+  half-way through a url. A url file that is replaced (e.g. by an atomic
+  rename) or truncated is read from the start.
+
+  Every <revalidate> secs, and on SIGHUP, all urls are requested again, so
+  changed images are picked up; with the validators of the local copies,
+  most of those requests are answered with 304. SIGHUP also reloads the
+  options, including those of @FILE arguments. SIGTERM and SIGINT stop the
+  loader once the urls in flight are done.
+"""
+from __future__ import division, print_function, absolute_import
+
+import itertools
+import logging
+import os
+import signal
+import threading
+import time
+from collections import Counter
+
+from image_loader.ingest import detect_format, iter_url_lines, parse_records
+from image_loader.loader import (close_pool, format_summary, make_pool, open_postprocessor, open_unique, select_urls,
+                                 stream, stream_options)
+
+# - runtime params -------------------------------------------------------------
+PollSecs = 2.0              # how often to look for new lines in the url file
+RevalidateSecs = 24 * 3600  # how often to request all urls again; 0 for only on SIGHUP
+# - params end -----------------------------------------------------------------
+
+_logger = logging.getLogger(__name__)
+
+
+class UrlFileTail(object):
+    "The lines appended to a url file since they were last read"
+
+    def __init__(self, path):
+        self.path = path
+        self.inode = None
+        self.offset = 0  # end of the last complete line read
+
+    def rewind(self):
+        "Read the file from the start again"
+        self.offset = 0
+
+    def lines(self):
+        """Yield the complete lines appended since the last call, as
+           :class:`image_loader.ingest.UrlLine`, lazily"""
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            _logger.warning("Url file is missing, waiting for it: {}".format(self.path))
+            return
+        if (st.st_dev, st.st_ino) != self.inode or st.st_size < self.offset:
+            if self.inode is not None:
+                _logger.info("Url file was replaced or truncated, reading it from the start: {}".format(self.path))
+            self.inode, self.offset = (st.st_dev, st.st_ino), 0
+        if st.st_size == self.offset:
+            return
+        with open(self.path, 'rb') as url_file:
+            for line in iter_url_lines(url_file, self.offset):
+                if not line.endswith('\n'):
+                    break  # still being written
+                self.offset = line.end
+                yield line
+
+
+class Watcher(object):
+    """Runs the loader on a url file until stopped; see the module docs
+
+    Args:
+      configure (callable): returns the parsed command line; called at start
+        and on SIGHUP
+    """
+
+    def __init__(self, configure):
+        self.configure = configure
+        self.wakeup = threading.Event()
+        self.stopping = False
+        self.reloading = True
+        self.pool = None
+        self.processor = None
+
+    def on_hangup(self, signum, frame):
+        self.reloading = True
+        self.wakeup.set()
+
+    def on_stop(self, signum, frame):
+        _logger.info("Stopping after the urls in flight")
+        self.stopping = True
+        self.wakeup.set()
+
+    def reload(self):
+        """Apply the current command line, with a new connection pool and post-processor.
+           Once running, a command line that fails to apply keeps the previous one in use."""
+        try:
+            args = self.configure()  # parser errors raise SystemExit
+            input_format = detect_format(args.fpath, args.input_format)
+            options = stream_options(args)
+        except (SystemExit, Exception) as e:
+            if self.pool is None:
+                raise  # nothing to keep at start
+            _logger.error("Cannot reload the options, keeping the current ones: %r", e)
+            return
+        logging.getLogger().setLevel(args.loglevel or logging.WARNING)
+        self.args = args
+        self.tail = UrlFileTail(args.fpath)
+        self.input_format = input_format
+        self.options = options
+        close_pool(self.pool)
+        self.pool = make_pool(args.threads, args.connections, args.pools, args.resolve_ahead)
+        if self.processor is not None:
+            self.processor.close()
+        self.processor = open_postprocessor(args.verify, args.resize, args.convert, args.post_workers)
+        _logger.info("Watching url file: {}".format(args.fpath))
+
+    def batch(self, lines, unique=None):
+        "Download the url lines, and return the number of urls per outcome"
+        first = next(lines, None)
+        if first is None:
+            return Counter()  # not worth setting up a stream
+        lines = (line for line in itertools.chain([first], lines) if not self.stopping)
+        if self.input_format != 'lines':
+            lines = parse_records(lines, self.input_format)
+        lines = select_urls(lines, self.args.shard)
+        if unique is not None:
+            lines = unique.filter(lines)
+        results = stream(lines, self.args.outdir, self.args.force, self.args.max_pending or 4 * self.args.threads,
+                         connection_pool=self.pool, postprocessor=self.processor, **self.options)
+        return Counter(result.outcome for result in results)
+
+    def run(self):
+        "Download new urls as they come, until SIGTERM or SIGINT"
+        handlers = {signum: signal.signal(signum, handler) for signum, handler in
+                    ((signal.SIGHUP, self.on_hangup), (signal.SIGTERM, self.on_stop), (signal.SIGINT, self.on_stop))}
+        last_pass = unique = None
+        try:
+            while not self.stopping:
+                full = self.reloading or (self.args.revalidate and time.time() - last_pass >= self.args.revalidate)
+                if self.reloading:
+                    self.reloading = False
+                    self.reload()
+                if full:
+                    self.tail.rewind()
+                    unique = open_unique(self.args.unique_urls)  # duplicates within a pass
+                    last_pass = time.time()
+                summary = self.batch(self.tail.lines(), unique)
+                if summary or full:
+                    _logger.info("{}: {}".format("Full pass" if full else "New urls", format_summary(summary)))
+                self.wakeup.wait(self.args.poll)
+                self.wakeup.clear()
+        finally:
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+            close_pool(self.pool)
+            if self.processor is not None:
+                self.processor.close()
@@ -1,12 +1,148 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 """
-    Dummy conftest.py for image_loader.
+    Shared fixtures for the image_loader tests.
 
-    If you don't know what this is for, just leave it empty.
     Read more about conftest.py under:
     https://pytest.org/latest/plugins.html
 """
 from __future__ import print_function, absolute_import, division
 
-# import pytest
+import struct
+import threading
+import gzip
+import time
+import zlib
+from collections import Counter
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+PNG_BODY = b'\x89PNG\r\n\x1a\n' + b'\0' * 1024
+BIG_BODY = b'\x89PNG\r\n\x1a\n' + bytes(range(256)) * 1024
+
+
+def make_png(width, height):
+    "Return a valid, gray RGB PNG image"
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+    rows = (b'\0' + b'\x80' * 3 * width) * height
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)) +
+            chunk(b'IDAT', zlib.compress(rows)) + chunk(b'IEND', b''))
+
+
+REAL_PNG = make_png(64, 32)
+LAST_MODIFIED = 1536150095
+ETAG = '"v1"'
+
+
+class ImageHandler(BaseHTTPRequestHandler):
+    """Serve fake images under /img/ and a real one under /png/, html under /html/, html labelled as image
+       under /fake/, 503 under /busy/ and 404 elsewhere. Images honor If-None-Match and If-Modified-Since against a
+       fixed ETag and Last-Modified. Under /flaky/, the first request for a path gets 503 with Retry-After: 0,
+       later ones an image. Under /cut/, the first request for a path gets only half of a larger image before the
+       connection drops; Range requests are answered with 206 if If-Range matches the ETag. Images under /cached/
+       are like those under /img/, but fresh for an hour by Cache-Control, and count their hits. Images under /slow/
+       take 50ms, and record when they were requested in server.started and the most of them in flight at once in
+       server.peak. Images under /gzip/ come gzip encoded, whatever the request accepts. Request headers are recorded per path in server.requests."""
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.requests[self.path] = dict(self.headers)
+        if self.path.startswith(('/img/', '/cached/', '/png/')):
+            cache = {'Cache-Control': 'public, max-age=3600'} if self.path.startswith('/cached/') else None
+            self.server.hits[self.path] += 1
+            mod_since = self.headers.get('If-Modified-Since')
+            if self.headers.get('If-None-Match') == ETAG:
+                self.reply(304, headers=cache)
+            elif mod_since and parsedate_to_datetime(mod_since).timestamp() >= LAST_MODIFIED:
+                self.reply(304, headers=cache)
+            else:
+                self.reply(200, REAL_PNG if self.path.startswith('/png/') else PNG_BODY, 'image/png', cache)
+        elif self.path.startswith('/html/'):
+            self.reply(200, b'<html></html>', 'text/html')
+        elif self.path.startswith('/fake/'):
+            self.reply(200, b'<html>Not Found</html>', 'image/jpeg')
+        elif self.path.startswith('/slow/'):
+            with self.server.lock:
+                self.server.started.append(time.monotonic())
+                self.server.inflight += 1
+                self.server.peak = max(self.server.peak, self.server.inflight)
+            time.sleep(0.05)
+            with self.server.lock:
+                self.server.inflight -= 1
+            self.reply(200, PNG_BODY, 'image/png')
+        elif self.path.startswith('/gzip/'):
+            self.reply(200, gzip.compress(PNG_BODY), 'image/png', {'Content-Encoding': 'gzip'})
+        elif self.path.startswith('/busy/'):
+            self.reply(503)
+        elif self.path.startswith('/flaky/'):
+            self.server.hits[self.path] += 1
+            if self.server.hits[self.path] == 1:
+                self.reply(503, headers={'Retry-After': '0'})
+            else:
+                self.reply(200, PNG_BODY, 'image/png')
+        elif self.path.startswith('/cut/'):
+            self.server.hits[self.path] += 1
+            self.reply_ranged(BIG_BODY, cut=self.server.hits[self.path] == 1)
+        else:
+            self.reply(404)
+
+    def reply_ranged(self, body, cut=False):
+        "Reply with body, or the requested part of it, dropping the connection halfway if cut is set"
+        start = int(self.headers.get('Range', 'bytes=0-')[len('bytes='):].rstrip('-'))
+        if start and self.headers.get('If-Range') == ETAG:
+            if start >= len(body):
+                return self.reply(416, headers={'Content-Range': 'bytes */{}'.format(len(body))})
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, len(body) - 1, len(body)))
+            body = body[start:]
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('ETag', ETAG)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if cut:
+            self.wfile.write(body[:len(body) // 2])
+            self.close_connection = True
+        else:
+            self.wfile.write(body)
+
+    def reply(self, status, body=b'', content_type=None, headers=None):
+        self.send_response(status)
+        if content_type:
+            self.send_header('Content-Type', content_type)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Last-Modified', formatdate(LAST_MODIFIED, usegmt=True))
+        self.send_header('ETag', ETAG)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ServerUrl(str):
+    "Base url of a test server, with the server itself as .server"
+
+
+@pytest.fixture
+def image_server():
+    "Yield the base url of a local HTTP server serving fake images"
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ImageHandler)
+    server.hits = Counter()
+    server.requests = {}
+    server.lock = threading.Lock()
+    server.started = []
+    server.inflight = server.peak = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = ServerUrl("http://127.0.0.1:{}".format(server.server_address[1]))
+    url.server = server
+    yield url
+    server.shutdown()
+    server.server_close()
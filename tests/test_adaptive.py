@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import pytest
+import image_loader.adaptive as aut
+import image_loader.loader as loader
+
+
+def observe_window(limiter, secs, outcome='downloaded'):
+    for _ in range(max(aut.MinWindow, limiter.limit)):
+        limiter.observe(secs, outcome)
+
+
+def test_adaptive_limit_grows_while_healthy():
+    limiter = aut.AdaptiveLimit(2, 4)
+    assert 2 == limiter.limit
+    for expected in (3, 4, 4):
+        observe_window(limiter, 0.1)
+        assert expected == limiter.limit
+
+
+def test_adaptive_limit_backs_off():
+    limiter = aut.AdaptiveLimit(2, 40, initial=20)
+    observe_window(limiter, 0.1)
+    assert 21 == limiter.limit
+    observe_window(limiter, 0.1, 'failed')
+    assert 15 == limiter.limit
+    observe_window(limiter, 1.0)
+    assert 11 == limiter.limit
+    for _ in range(10):
+        observe_window(limiter, 0.1, 'throttled')
+    assert 2 == limiter.limit
+
+
+def test_adaptive_limit_ignores_deferred():
+    limiter = aut.AdaptiveLimit(2, 4)
+    observe_window(limiter, 10, 'deferred')
+    observe_window(limiter, 10, None)
+    assert 0 == limiter.samples
+    assert 2 == limiter.limit
+
+
+def test_adaptive_limit_ignores_fresh_skips():
+    from image_loader.metrics import Metrics
+    limiter = aut.AdaptiveLimit(2, 40, initial=20)
+    observe_window(limiter, 0.1)
+    metrics = Metrics()
+    skip = loader.instrument(metrics, lambda url: loader.skip_fresh(url, "/out"), limiter)
+    results = [skip("http://a/{}.png".format(i)) for i in range(200)]  # no request, next to no latency
+    assert 'fresh' == results[0] and not results[0].requested
+    assert 0 == limiter.samples
+    observe_window(limiter, 0.1)
+    assert 22 == limiter.limit  # the baseline is that of real requests still
+    assert {'fresh': 200} == metrics.summary()['outcomes']
+    assert {} == metrics.summary()['statuses'] and 0 == metrics.summary()['latency']['*']['count']
+
+
+def test_pending_limit():
+    assert 5 == aut.pending_limit(5)
+    assert 2 == aut.pending_limit(5, aut.AdaptiveLimit(2, 8))
+    assert 5 == aut.pending_limit(5, aut.AdaptiveLimit(8, 8))
+
+
+def test_load_adaptive(tmpdir, image_server):
+    urlfile = os.path.join(tmpdir, "urls.txt")
+    with open(urlfile, "w") as f:
+        f.write("".join("{}/img/{}.png\n".format(image_server, i) for i in range(30)))
+    summary = loader.load(urlfile, str(tmpdir), False, 8, threads=4, adaptive=True, min_concurrency=1)
+    assert {'downloaded': 30} == summary
+
+
+def test_parse_args_from_file(tmpdir):
+    config = os.path.join(tmpdir, "loader.conf")
+    with open(config, "w") as f:
+        f.write("--threads\n20\n--adaptive\n")
+    args = loader.parse_args(["@" + config, "urls.txt", str(tmpdir)])
+    assert 20 == args.threads
+    assert args.adaptive
+    assert args.connections is None
+
+
+def test_parse_args_concurrency():
+    args = loader.parse_args(["--threads", "4", "--max-pending", "8", "urls.txt", "out"])
+    assert (4, 8) == (args.threads, args.max_pending)
+    for argv in (["--threads", "0"], ["--threads", "-2"], ["--max-pending", "0"], ["--connections", "0"],
+                 ["--min-concurrency", "-1"]):
+        with pytest.raises(SystemExit):
+            loader.parse_args(argv + ["urls.txt", "out"])
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import pytest
+
+pytest.importorskip("aiohttp")
+import image_loader.aioloader as aut  # noqa: E402
+
+
+def write_urls(tmpdir, urls):
+    urlfile = os.path.join(tmpdir, "urls.txt")
+    with open(urlfile, "w") as f:
+        f.write("\n".join(urls) + "\n")
+    return urlfile
+
+
+def test_load(tmpdir, image_server):
+    urlfile = write_urls(tmpdir, [image_server + "/img/foo.png", "",
+                                  image_server + "/html/bar.png",
+                                  image_server + "/nothing/baz.png"])
+    outdir = os.path.join(tmpdir, "out")
+    summary = aut.load(urlfile, outdir, False, max_pending=2)
+    assert {'downloaded': 1, 'skipped': 1, 'failed': 1} == summary
+    assert os.path.exists(os.path.join(outdir, "foo.png"))
+    assert not os.path.exists(os.path.join(outdir, "bar.png"))
+    summary = aut.load(urlfile, outdir, False)
+    assert 1 == summary['fresh']
+    summary = aut.load(urlfile, outdir, True)
+    assert 1 == summary['downloaded']
+
+
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+def test_load_gzip_encoded(tmpdir, image_server, engine):
+    from image_loader import loader
+    from conftest import PNG_BODY
+    urlfile = write_urls(tmpdir, [image_server + "/gzip/a.png"])
+    load = aut.load if engine == "asyncio" else loader.load
+    assert {'downloaded': 1} == load(urlfile, str(tmpdir), True)
+    assert 'identity' == image_server.server.requests['/gzip/a.png']['Accept-Encoding']
+    with open(os.path.join(tmpdir, "a.png"), 'rb') as f:
+        assert PNG_BODY == f.read()
+
+
+def test_load_unreachable(tmpdir):
+    urlfile = write_urls(tmpdir, ["http://127.0.0.1:9/img/foo.png"])
+    summary = aut.load(urlfile, str(tmpdir), False, retries=0)
+    assert {'failed': 1} == summary
+
+
+def test_load_scheduled(tmpdir, image_server):
+    from image_loader.scheduler import HostScheduler
+    urlfile = write_urls(tmpdir, ["{}/slow/{}.png".format(image_server, i) for i in range(20)])
+    summary = aut.load(urlfile, str(tmpdir), False, 8, scheduler=HostScheduler(2, rate=10), retries=0)
+    assert {'downloaded': 20} == summary
+    assert 2 == image_server.server.peak
+    started = image_server.server.started
+    assert started[-1] - started[0] >= 0.9  # a burst of 10, then 10 more at 10/s
+
+
+def test_load_dedup(tmpdir, image_server):
+    urlfile = write_urls(tmpdir, ["{}/img/{}.png".format(image_server, i) for i in range(3)])
+    assert {'downloaded': 3} == aut.load(urlfile, str(tmpdir), True, dedup='symlink')
+    assert os.path.islink(os.path.join(tmpdir, "1.png"))
+
+
+def test_load_validated(tmpdir, image_server):
+    urlfile = write_urls(tmpdir, [image_server + "/img/a.png", image_server + "/fake/b.png"])
+    assert {'downloaded': 1, 'skipped': 1} == aut.load(urlfile, str(tmpdir), True)
+    assert {'skipped': 2} == aut.load(urlfile, str(tmpdir), True, max_size=100)
+    assert ['a.png', 'urls.txt'] == sorted(os.listdir(tmpdir))
+
+
+def test_load_retried(tmpdir, image_server, monkeypatch):
+    monkeypatch.setattr('image_loader.health.BackoffBaseSecs', 0.01)
+    urlfile = write_urls(tmpdir, [image_server + "/flaky/a.png"] + ["http://127.0.0.1:9/{}.png".format(i)
+                                                                   for i in range(4)])
+    assert {'downloaded': 1, 'failed': 4} == aut.load(urlfile, str(tmpdir), False, 2, retries=1, breaker=2)
+
+
+def test_load_with_metrics(tmpdir, image_server):
+    urlfile = write_urls(tmpdir, ["{}/img/{}.png".format(image_server, i) for i in range(3)])
+    probes = []
+    assert {'downloaded': 3} == aut.load(urlfile, str(tmpdir), False, hooks=[probes.append])
+    assert [200] * 3 == [probe.status for probe in probes]
+    assert all({'request', 'transfer', 'commit'} == set(probe.phases) for probe in probes)
+
+
+def test_load_resumed(tmpdir, image_server):
+    from conftest import BIG_BODY
+    urlfile = write_urls(tmpdir, [image_server + "/cut/big.png"])
+    assert {'failed': 1} == aut.load(urlfile, str(tmpdir), False, retries=0)
+    assert {'downloaded': 1} == aut.load(urlfile, str(tmpdir), False, retries=0)
+    assert 'bytes={}-'.format(len(BIG_BODY) // 2) == image_server.server.requests['/cut/big.png']['Range']
+    with open(os.path.join(tmpdir, "big.png"), 'rb') as f:
+        assert BIG_BODY == f.read()
+
+
+def test_stream(tmpdir, image_server):
+    import asyncio
+
+    async def urls():
+        for i in range(5):
+            yield "{}/img/{}.png".format(image_server, i)
+
+    async def run():
+        return [result async for result in aut.stream(urls(), str(tmpdir), max_pending=2)]
+    results = asyncio.run(run())
+    assert ['downloaded'] * 5 == results
+    assert all(os.path.getsize(result.path) == result.bytes for result in results)
+
+
+def test_stream_cancelled(tmpdir, image_server):
+    import asyncio
+
+    async def run():
+        results = aut.stream(("{}/img/{}.png".format(image_server, i) for i in range(100)), str(tmpdir),
+                             max_pending=4)
+        first = await results.__anext__()
+        await results.aclose()
+        return first
+    assert 'downloaded' == asyncio.run(run())
+    assert 10 > len([name for name in os.listdir(tmpdir) if name.endswith('.png')])
+    assert not [name for name in os.listdir(tmpdir) if name.startswith('.')]
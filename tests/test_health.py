@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import image_loader.health as aut
+import image_loader.loader as loader
+
+
+def test_retry_after_secs():
+    assert aut.retry_after_secs(None) is None
+    assert 120 == aut.retry_after_secs(" 120")
+    assert 30 == aut.retry_after_secs("Wed, 21 Oct 2015 07:28:30 GMT", now=1445412480)
+    assert 0 == aut.retry_after_secs("Wed, 21 Oct 2015 07:28:00 GMT", now=1445412490)
+    assert aut.retry_after_secs("soon") is None
+
+
+def test_backoff_delay():
+    assert 0.5 <= aut.backoff_delay(0) <= 1
+    assert 2 <= aut.backoff_delay(2) <= 4
+    assert aut.BackoffMaxSecs / 2 <= aut.backoff_delay(20) <= aut.BackoffMaxSecs
+    assert 7 == aut.backoff_delay(0, retry_after=7)
+    assert aut.backoff_delay(0, retry_after=aut.BackoffMaxSecs + 1) is None
+
+
+def test_host_health():
+    now = [0]
+    health = aut.HostHealth(threshold=2, open_secs=10, clock=lambda: now[0])
+    health.failure('a')
+    assert health.allow('a')
+    health.failure('a')
+    assert not health.allow('a') and health.allow('b')
+    assert 'deferred' == health.blocked_outcome('http://a/x.png')
+    now[0] = 10
+    assert health.allow('a')      # probe
+    assert not health.allow('a')  # until the probe is back
+    health.success('a')
+    assert health.allow('a')
+    health.failure('a')
+    health.failure('a')
+    health.final_pass()
+    assert health.allow('a')
+    health.failure('a')
+    assert not health.allow('a')
+    assert 'failed' == health.blocked_outcome('http://a/x.png')
+
+
+def test_load_retried(tmpdir, image_server, monkeypatch):
+    monkeypatch.setattr(aut, 'BackoffBaseSecs', 0.01)
+    urlfile = os.path.join(tmpdir, "urls.txt")
+    with open(urlfile, "w") as f:
+        f.write(image_server + "/flaky/a.png\n")
+        f.write("".join("http://127.0.0.1:9/{}.png\n".format(i) for i in range(6)))
+    summary = loader.load(urlfile, str(tmpdir), False, 2, retries=1, breaker=2)
+    assert {'downloaded': 1, 'failed': 6} == summary
+    assert os.path.exists(os.path.join(tmpdir, "a.png"))
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import image_loader.index as aut
+import image_loader.loader as loader
+
+
+def test_metadata_index(tmpdir):
+    path = aut.index_path(str(tmpdir))
+    entry = aut.Entry('"abc"', 'Wed, 05 Sep 2018 12:21:35 GMT', 42, 'ff00')
+    with aut.MetadataIndex(path, flush_every=2) as index:
+        assert index.get('http://a/1.png') is None
+        index.put('http://a/1.png', entry)
+        assert entry == index.get('http://a/1.png')  # served from the write buffer
+        index.put('http://a/2.png', entry._replace(length=7))
+        assert not index.buffer
+        assert 7 == index.get('http://a/2.png').length
+        index.put('http://a/3.png', entry)
+    with aut.MetadataIndex(path) as index:
+        assert entry == index.get('http://a/3.png')
+
+
+def test_make_entry():
+    entry = aut.make_entry({'ETag': '"x"', 'Last-Modified': 'lm', 'Date': 'date'}, 3, 'aa')
+    assert ('"x"', 'lm', 3, 'aa', None, False) == entry
+    assert 'date' == aut.make_entry({'Date': 'date'}, 3, 'aa').last_modified
+    assert aut.make_entry({}, 3, 'aa').etag is None
+
+
+def test_freshness_lifetime():
+    date = 'Wed, 05 Sep 2018 12:00:00 GMT'
+    assert aut.freshness_lifetime({}) is None
+    assert 600 == aut.freshness_lifetime({'Cache-Control': 'public, max-age=600'})
+    assert 540 == aut.freshness_lifetime({'Cache-Control': 'max-age="600"', 'Age': '60'})
+    assert 0 == aut.freshness_lifetime({'Cache-Control': 'no-cache, max-age=600'})
+    assert 3600 == aut.freshness_lifetime({'Expires': 'Wed, 05 Sep 2018 13:00:00 GMT', 'Date': date})
+    assert 600 == aut.freshness_lifetime({'Expires': 'Wed, 05 Sep 2018 13:00:00 GMT', 'Date': date,
+                                          'Cache-Control': 'max-age=600'})
+    assert 0 == aut.freshness_lifetime({'Expires': '0'})
+    assert 0 == aut.freshness_lifetime({'Expires': date, 'Date': 'Wed, 05 Sep 2018 13:00:00 GMT'})
+
+
+def test_expiry():
+    assert aut.expiry({}, now=1000) is None
+    assert 1600 == aut.expiry({'Cache-Control': 'max-age=600'}, now=1000)
+    assert 1600 == aut.expiry({'Cache-Control': 'max-age=60'}, 600, now=1000)
+    assert 1600 == aut.expiry({'Cache-Control': 'no-store'}, 600, now=1000)
+    entry = aut.Entry(None, None, 1, 'aa', 1600)
+    assert aut.is_fresh(entry, now=1599)
+    assert not aut.is_fresh(entry, now=1600)
+    assert not aut.is_fresh(entry._replace(expires=None))
+
+
+def test_conditional_headers():
+    assert {'If-None-Match': '"x"', 'If-Modified-Since': 'lm'} == \
+        aut.conditional_headers(aut.Entry('"x"', 'lm', 1, 'aa'))
+    assert {} == aut.conditional_headers(aut.Entry(None, None, 1, 'aa'))
+
+
+def test_load_with_index(tmpdir, image_server, monkeypatch):
+    urlfile = os.path.join(tmpdir, "urls.txt")
+    with open(urlfile, "w") as f:
+        f.write("".join("{}/img/{}.png\n".format(image_server, i) for i in range(3)))
+    outdir = os.path.join(tmpdir, "out")
+    assert {'downloaded': 3} == loader.load(urlfile, outdir, False, use_index=True)
+    with aut.MetadataIndex(aut.index_path(outdir)) as index:
+        entry = index.get(image_server + "/img/1.png")
+    assert 1032 == entry.length and 64 == len(entry.digest)
+    with monkeypatch.context() as m:
+        m.setattr(loader, "file_mtime", None)  # no stat calls for indexed urls
+        assert {'fresh': 3} == loader.load(urlfile, outdir, False, use_index=True)
+
+
+def test_load_resumed_with_index(tmpdir, image_server, monkeypatch):
+    from conftest import BIG_BODY
+    urlfile = os.path.join(tmpdir, "urls.txt")
+    with open(urlfile, "w") as f:
+        f.write(image_server + "/cut/big.png\n" + image_server + "/img/1.png\n")
+    outdir = os.path.join(tmpdir, "out")
+    looked_up = []
+    read_resume = loader.read_resume
+    monkeypatch.setattr(loader, "read_resume", lambda file_name: looked_up.append(file_name) or read_resume(file_name))
+    assert {'failed': 1, 'downloaded': 1} == loader.load(urlfile, outdir, False, retries=0, use_index=True)
+    with aut.MetadataIndex(aut.index_path(outdir)) as index:
+        assert index.get(image_server + "/cut/big.png").partial
+    del looked_up[:]
+    assert {'downloaded': 1, 'fresh': 1} == loader.load(urlfile, outdir, False, retries=0, use_index=True)
+    assert [os.path.join(outdir, "big.png")] == looked_up  # only for the url the index has a partial file of
+    assert 'bytes={}-'.format(len(BIG_BODY) // 2) == image_server.server.requests['/cut/big.png']['Range']
+    with aut.MetadataIndex(aut.index_path(outdir)) as index:
+        assert not index.get(image_server + "/cut/big.png").partial
+    with open(os.path.join(outdir, "big.png"), 'rb') as f:
+        assert BIG_BODY == f.read()
+
+
+def test_load_fresh_for_a_while(tmpdir, image_server):
+    urlfile = os.path.join(tmpdir, "urls.txt")
+    with open(urlfile, "w") as f:
+        f.write(image_server + "/cached/1.png\n" + image_server + "/img/2.png\n")
+    outdir = os.path.join(tmpdir, "out")
+    hits = image_server.server.hits
+    assert {'downloaded': 2} == loader.load(urlfile, outdir, False, use_index=True)
+    assert {'fresh': 2} == loader.load(urlfile, outdir, False, use_index=True)
+    assert (1, 2) == (hits['/cached/1.png'], hits['/img/2.png'])  # within max-age, no request at all
+    assert {'fresh': 2} == loader.load(urlfile, outdir, False, use_index=True, min_ttl=60)
+    assert {'fresh': 2} == loader.load(urlfile, outdir, False, use_index=True, min_ttl=60)
+    assert (1, 3) == (hits['/cached/1.png'], hits['/img/2.png'])  # the 304 started the min_ttl
+    assert {'downloaded': 2} == loader.load(urlfile, outdir, True, use_index=True)
+    assert (2, 4) == (hits['/cached/1.png'], hits['/img/2.png'])
+
+
+def test_index_upgrade(tmpdir):
+    path = aut.index_path(str(tmpdir))
+    import sqlite3
+    with sqlite3.connect(path) as db:
+        db.execute("CREATE TABLE entries (url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, length INTEGER, "
+                   "digest TEXT)")
+        db.execute("INSERT INTO entries VALUES ('http://a/1.png', '\"x\"', 'lm', 1, 'aa')")
+    db.close()
+    with aut.MetadataIndex(path) as index:
+        assert aut.Entry('"x"', 'lm', 1, 'aa') == index.get('http://a/1.png')
+        index.put('http://a/2.png', aut.Entry(None, None, 2, 'bb', 1600.0))
+    with aut.MetadataIndex(path) as index:
+        assert 1600.0 == index.get('http://a/2.png').expires
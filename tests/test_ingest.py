@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import gzip
+import io
+import os
+import sys
+import pytest
+import image_loader.ingest as aut
+import image_loader.loader as loader
+from image_loader.index import MetadataIndex, index_path
+
+URLS = b"http://a/1.png\n\nhttp://a/2.png\nhttp://a/3.png"
+
+
+def test_iter_url_lines_mapped(tmpdir):
+    path = os.path.join(tmpdir, "urls.txt")
+    with open(path, "wb") as f:
+        f.write(URLS)
+    with open(path, "rb") as url_file:
+        assert aut.map_file(url_file) is not None
+        lines = list(aut.iter_url_lines(url_file, 15))
+        assert list(aut.read_lines(url_file)) == list(aut.read_lines(io.BytesIO(URLS)))
+    assert [(15, 16), (16, 31), (31, 45)] == [(line.offset, line.end) for line in lines]
+    assert ["\n", "http://a/2.png\n", "http://a/3.png"] == lines
+    open(path, "w").close()
+    with open(path, "rb") as url_file:
+        assert [] == list(aut.iter_url_lines(url_file))  # empty files cannot be mapped
+
+
+def test_open_url_file(tmpdir, monkeypatch):
+    path = os.path.join(tmpdir, "urls.txt.gz")
+    with gzip.open(path, "wb") as f:
+        f.write(URLS)
+    with aut.open_url_file(path) as url_file:
+        assert aut.map_file(url_file) is None
+        assert 4 == len(list(aut.read_lines(url_file)))
+    zstandard = pytest.importorskip("zstandard")
+    path = os.path.join(tmpdir, "urls.txt.zst")
+    with open(path, "wb") as f:
+        f.write(zstandard.ZstdCompressor().compress(URLS))
+    with aut.open_url_file(path) as url_file:
+        assert [31] == [line.offset for line in aut.iter_url_lines(url_file)][3:]
+    with open(os.path.join(tmpdir, "urls.txt"), "wb") as f:
+        f.write(URLS)
+    with open(os.path.join(tmpdir, "urls.txt"), "rb") as stdin:
+        monkeypatch.setattr(sys, "stdin", stdin)
+        with aut.open_url_file("-") as url_file:
+            assert 4 == len(list(aut.read_lines(url_file)))
+        assert not stdin.closed
+
+
+def test_detect_format():
+    assert 'lines' == aut.detect_format("urls.txt")
+    assert 'jsonl' == aut.detect_format("urls.JSONL.gz")
+    assert 'csv' == aut.detect_format("-", 'csv')
+    assert 'csv' == aut.detect_format("urls.csv.zst")
+
+
+def test_parse_records():
+    lines = ['{"url": "http://a/1.png?x", "name": "one.png", "etag": "\\"e\\""}\n', '\n', '["http://a/2.png"]\n',
+             '{"url": "http://a/3.png", "name": "../3.png"}\n', aut.UrlLine('{"url": "http://a/4.png"}\n', 7, 9)]
+    records = list(aut.parse_records(lines, 'jsonl'))
+    assert ["http://a/1.png?x", "http://a/4.png"] == records
+    assert [("one.png", '"e"'), (None, None)] == [aut.url_hints(record) for record in records]
+    assert (7, 9) == (records[1].offset, records[1].end)
+    lines = ['url,name,etag\n', 'http://a/1.png?x,one.png,"""e"""\n', 'http://a/2.png\n']
+    records = list(aut.parse_records(lines, 'csv'))
+    assert [("one.png", '"e"'), (None, None)] == [aut.url_hints(record) for record in records]
+    assert (None, None) == aut.url_hints("http://a/1.png")
+
+
+def test_load_records(tmpdir, image_server):
+    urlfile = os.path.join(tmpdir, "urls.jsonl.gz")
+    with gzip.open(urlfile, "wt") as f:
+        f.write('{{"url": "{}/img/1.png?size=big", "name": "big.png"}}\n'.format(image_server))
+        f.write('{{"url": "{}/img/2.png", "etag": "\\"v1\\""}}\n'.format(image_server))
+    outdir = os.path.join(tmpdir, "out")
+    assert {'downloaded': 2} == loader.load(urlfile, outdir, False, use_index=True)
+    assert ['.image_loader.db', '2.png', 'big.png'] == sorted(os.listdir(outdir))
+    hits = image_server.server.hits
+    assert {'fresh': 2} == loader.load(urlfile, outdir, False, use_index=True)
+    assert (2, 1) == (hits['/img/1.png?size=big'], hits['/img/2.png'])  # the etag is known already
+    with MetadataIndex(index_path(outdir)) as index:
+        assert '"v1"' == index.get(image_server + "/img/2.png").etag
+
+
+def test_parse_args_inputs():
+    args = loader.parse_args(["--input-format", "csv", "-", "out"])
+    assert ('-', 'csv') == (args.fpath, args.input_format)
+    for argv in (["--resume", "-", "out"], ["--workers", "2", "-", "out"], ["--resume", "urls.zst", "out"],
+                 ["--watch", "urls.gz", "out"]):
+        with pytest.raises(SystemExit):
+            loader.parse_args(argv)
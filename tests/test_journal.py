@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import image_loader.journal as aut
+import image_loader.loader as loader
+
+URLS = b"http://a/1.png\n\nhttp://a/2.png\nhttp://a/3.png\nhttp://a/4.png"
+
+
+def test_iter_url_lines():
+    lines = list(aut.iter_url_lines(io.BytesIO(URLS)))
+    assert ["http://a/1.png\n", "\n", "http://a/2.png\n", "http://a/3.png\n", "http://a/4.png"] == lines
+    assert [(0, 15), (15, 16), (16, 31)] == [(line.offset, line.end) for line in lines[:3]]
+    assert [31, 46] == [line.offset for line in aut.iter_url_lines(io.BytesIO(URLS), 31)]
+
+
+def test_journal_path():
+    assert aut.journal_path('/out', 'urls.txt') == aut.journal_path('/out', os.path.abspath('urls.txt'))
+    assert aut.journal_path('/out', 'urls.txt').startswith('/out/.image_loader.journal-')
+    assert aut.journal_path('/out', 'urls.txt', (1, 4)).endswith('-1of4')
+
+
+def test_read_journal(tmpdir):
+    path = os.path.join(tmpdir, "journal")
+    assert (0, set(), set()) == aut.read_journal(path)
+    with open(path, "w") as f:
+        f.write("R 16 31 failed 1\nR 0 15 downloaded 1\nC 31\nR 46 60 fresh 1\nC 3")
+    assert (31, {46}, {16}) == aut.read_journal(path)
+
+
+def test_journal_resume(tmpdir):
+    path = os.path.join(tmpdir, "journal")
+    journal = aut.Journal(path, flush_every=1)
+    lines = journal.track(loader.select_urls(journal.resume_lines(io.BytesIO(URLS))))
+    first, second, third = next(lines), next(lines), next(lines)
+    journal.record(first, 'downloaded')
+    journal.record(third, 'fresh')   # finished out of order
+    journal.record(second, 'failed')
+    journal.close()  # interrupted, not complete
+    with aut.Journal(path) as journal:
+        assert ["http://a/4.png"] == list(journal.resume_lines(io.BytesIO(URLS)))
+        assert ["http://a/2.png\n", "http://a/4.png"] == list(journal.resume_lines(io.BytesIO(URLS), True))
+    assert not os.path.exists(path)  # complete runs leave no journal
+
+
+def test_load_resume(tmpdir, image_server):
+    urlfile = os.path.join(tmpdir, "urls.txt")
+    with open(urlfile, "w") as f:
+        f.write("".join("{}/img/{}.png\n".format(image_server, i) for i in range(4)))
+    line_length = len("{}/img/0.png\n".format(image_server))
+    outdir = os.path.join(tmpdir, "out")
+    os.makedirs(outdir)
+    with open(aut.journal_path(outdir, urlfile), "w") as f:
+        f.write("R 0 {0} downloaded 1\nC {0}\nR {1} {2} downloaded 1\n".format(
+            line_length, 2 * line_length, 3 * line_length))
+    assert {'downloaded': 2} == loader.load(urlfile, outdir, False, resume=True)
+    assert ['1.png', '3.png'] == sorted(os.listdir(outdir))
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import hashlib
+import os
+import image_loader.layout as aut
+
+
+def test_fanout_path():
+    digest = hashlib.md5(b"foo.png").hexdigest()
+    assert "{}/{}".format(digest[:2], digest[2:4]) == aut.fanout_dir("foo.png", 2)
+    assert "/out/{}/foo.png".format(digest[:2]) == aut.fanout_path("/out", "foo.png", 1)
+    assert "/out/foo.png" == aut.fanout_path("/out", "foo.png")
+
+
+def test_migrate(tmpdir):
+    outdir = str(tmpdir)
+    os.makedirs(os.path.join(outdir, ".blobs"))
+    for name in ("a.png", "b.png", ".image_loader.db", ".blobs/blob"):
+        with open(os.path.join(outdir, name), "w") as f:
+            f.write(name)
+    os.symlink(".blobs/blob", os.path.join(outdir, "c.png"))
+    os.makedirs(os.path.dirname(aut.fanout_path(outdir, "b.png", 2)))
+    os.link(os.path.join(outdir, "b.png"), aut.fanout_path(outdir, "b.png", 2))
+
+    summary = aut.migrate(outdir, 2, threads=2)
+    assert {'moved': 2, 'skipped': 1} == summary
+    with open(aut.fanout_path(outdir, "a.png", 2)) as f:
+        assert "a.png" == f.read()
+    with open(aut.fanout_path(outdir, "c.png", 2)) as f:
+        assert ".blobs/blob" == f.read()
+    assert os.path.exists(os.path.join(outdir, "b.png"))
+    assert os.path.exists(os.path.join(outdir, ".image_loader.db"))
+    assert not os.path.lexists(os.path.join(outdir, "a.png"))
+
+
+def test_migrate_processed(tmpdir):
+    from image_loader import postprocess
+    outdir = str(tmpdir)
+    path = os.path.join(outdir, "a.png")
+    steps = postprocess.make_steps('quarantine', [(8, 8)], 'jpeg')
+    variants = [postprocess.variant_path(path, outdir, label, convert) for label, size, convert in steps.variants]
+    for name in [path] + variants:
+        os.makedirs(os.path.dirname(name), exist_ok=True)
+        with open(name, "w") as f:
+            f.write(name)
+    state = {'digest': 'aa', 'steps': steps}
+    postprocess.write_stamp(path, outdir, state)
+    assert ['.processed', '.variants', 'a.png'] == sorted(os.listdir(outdir))  # no stamp next to the image
+
+    assert {'moved': 1} == aut.migrate(outdir, 2, threads=2)
+    target = aut.fanout_path(outdir, "a.png", 2)
+    assert postprocess.read_stamp(target, outdir) is not None  # not processed again
+    assert postprocess.read_stamp(path, outdir) is None
+    for variant, (label, size, convert) in zip(variants, steps.variants):
+        with open(postprocess.variant_path(target, outdir, label, convert)) as f:
+            assert variant == f.read()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import multiprocessing
+import os
+import time
+import pytest
+import image_loader.ledger as aut
+import image_loader.loader as loader
+from image_loader.journal import journal_path
+
+
+def write_urls(tmpdir, count):
+    urlfile = os.path.join(tmpdir, "urls.txt")
+    with open(urlfile, "w") as f:
+        f.write("".join("http://a/{:02d}.png\n".format(i) for i in range(count)))  # 16 bytes each
+    return urlfile
+
+
+def test_ledger_alone(tmpdir):
+    urlfile = write_urls(tmpdir, 10)
+    with aut.open_ledger(str(tmpdir), urlfile, chunk_bytes=40) as ledger:
+        assert 4 == ledger.count
+        with open(urlfile, "rb") as url_file:
+            lines = list(ledger.track(ledger.resume_lines(url_file)))
+        assert ["http://a/{:02d}.png\n".format(i) for i in range(10)] == lines  # each line once, at its start
+        assert set() == ledger.read - ledger.held
+        for line in lines:
+            ledger.record(line, 'downloaded')
+        assert b"DDDD" == ledger.states()
+    assert not os.path.exists(journal_path(str(tmpdir), urlfile, kind='ledger'))
+    assert os.path.exists(journal_path(str(tmpdir), urlfile, kind='lease'))
+
+
+def test_lease(tmpdir):
+    urlfile = write_urls(tmpdir, 10)
+    with aut.open_ledger(str(tmpdir), urlfile, chunk_bytes=40):
+        with pytest.raises(aut.RunActive, match="pid {}".format(os.getpid())):
+            aut.open_ledger(str(tmpdir), urlfile, overlap='exit')
+        with open(urlfile, "a") as f:
+            f.write("http://a/10.png\n")
+        with pytest.raises(aut.RunActive, match="older version"):
+            aut.open_ledger(str(tmpdir), urlfile, overlap='share')
+    with aut.open_ledger(str(tmpdir), urlfile, overlap='exit') as ledger:  # nobody else active now
+        assert 1 == ledger.count
+
+
+def test_lease_downgrade(tmpdir, monkeypatch):
+    import fcntl
+    import threading
+    urlfile = write_urls(tmpdir, 10)
+    path = journal_path(str(tmpdir), urlfile, kind='ledger')
+    joined = []
+    flock = fcntl.flock
+
+    def slow_downgrade(f, operation):
+        "Drop the exclusive lock and take the shared one in two steps, with another run starting in between"
+        if operation == fcntl.LOCK_SH and not joined:
+            flock(f, fcntl.LOCK_UN)
+            other = threading.Thread(target=lambda: joined.append(aut.open_ledger(str(tmpdir), urlfile)))
+            other.start()
+            other.join(0.5)
+        flock(f, operation)
+    monkeypatch.setattr(aut.fcntl, "flock", slow_downgrade)
+    with aut.open_ledger(str(tmpdir), urlfile, chunk_bytes=40) as ledger:
+        inode = os.fstat(ledger.ledger.fileno()).st_ino
+        deadline = time.time() + 10
+        while not joined and time.time() < deadline:
+            time.sleep(0.01)
+        joined[0].close()
+        assert inode == os.stat(path).st_ino  # not written anew by the other run
+        assert 4 == ledger.count
+
+
+def share(outdir, urlfile, queue):
+    "Run as the second of two overlapping runs, in another process, as chunk locks are per process"
+    with aut.open_ledger(outdir, urlfile) as ledger, open(urlfile, "rb") as url_file:
+        lines = list(ledger.track(ledger.resume_lines(url_file)))
+        for line in lines:
+            ledger.record(line, 'downloaded')
+    queue.put([str(line) for line in lines])
+
+
+def test_share_chunks(tmpdir):
+    urlfile = write_urls(tmpdir, 10)
+    context = multiprocessing.get_context('fork')
+    queue = context.Queue()
+    with aut.open_ledger(str(tmpdir), urlfile, chunk_bytes=40) as ledger, open(urlfile, "rb") as url_file:
+        lines = ledger.track(ledger.resume_lines(url_file))
+        first = [next(lines), next(lines)]  # the first chunk is held
+        other = context.Process(target=share, args=(str(tmpdir), urlfile, queue))
+        other.start()
+        theirs = queue.get(timeout=30)
+        other.join()
+        ours = first + list(lines)
+        for line in ours:
+            ledger.record(line, 'downloaded')
+        assert ["http://a/00.png\n", "http://a/01.png\n", "http://a/02.png\n"] == ours  # the first chunk
+        assert 7 == len(theirs)  # the other run took all of the rest
+        assert ["http://a/{:02d}.png\n".format(i) for i in range(10)] == sorted(ours + theirs)
+    assert not os.path.exists(journal_path(str(tmpdir), urlfile, kind='ledger'))
+
+
+def test_load_overlap(tmpdir, image_server):
+    urlfile = os.path.join(tmpdir, "urls.txt")
+    with open(urlfile, "w") as f:
+        f.write("".join("{}/img/{}.png\n".format(image_server, i) for i in range(5)))
+    outdir = os.path.join(tmpdir, "out")
+    os.mkdir(outdir)
+    with aut.open_ledger(outdir, urlfile):
+        assert {} == loader.load(urlfile, outdir, False, overlap='exit')
+        assert [] == [path for path in image_server.server.hits if path.startswith('/img/')]
+    assert {'downloaded': 5} == loader.load(urlfile, outdir, False, overlap='exit')
+    with pytest.raises(SystemExit):
+        loader.parse_args(["--overlap", "share", "--resume", urlfile, outdir])
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import argparse
 import pytest
 import numbers
 import io
@@ -73,10 +74,14 @@ def test_assert_destdir(tmpdir):
     os.rmdir(tmppath)
 
 
+PNG_BODY = b'\x89PNG\r\n\x1a\n' + b'\0' * 1024
+
+
 def fake_request(*args, **kwargs):
     mod_since = maybe(kwargs)['headers']['If-Modified-Since']
     if mod_since.is_none() or mod_since.get() == 'Thu, 01 Jan 1970 00:00:00 GMT':
-        response = urllib3.response.HTTPResponse(body=open("README.rst", "rb"), request_method=args[1], request_url=args[2])
+        response = urllib3.response.HTTPResponse(body=io.BytesIO(PNG_BODY), request_method=args[1], request_url=args[2],
+                                                 preload_content=kwargs["preload_content"])
         response.status = 200
     else:
         response = urllib3.response.HTTPResponse(request_method=args[1], request_url=args[2])
@@ -105,3 +110,192 @@ def test_download_url(tmpdir, monkeypatch):
         aut.download_url(pool, url, outdir, True)
         t2 = get_mtime(localpath)
         assert t2 > t1
+
+
+def test_download_url_fanout(tmpdir, monkeypatch):
+    pool = urllib3.PoolManager()
+    with monkeypatch.context() as m:
+        m.setattr(urllib3.PoolManager, "request", fake_request)
+        assert 'downloaded' == aut.download_url(pool, "foo.jpg", tmpdir, False, fanout=2)
+    assert os.path.isfile(aut.get_out_file("foo.jpg", tmpdir, 2))
+    assert not os.path.exists(os.path.join(tmpdir, "foo.jpg"))
+
+
+def test_submit_bounded():
+    from concurrent.futures import ThreadPoolExecutor
+    consumed = []
+    def items():
+        for i in range(20):
+            consumed.append(i)
+            yield i
+    with ThreadPoolExecutor(4) as executor:
+        results = aut.submit_bounded(executor, lambda x: x * 2, items(), 3)
+        next(results)
+        assert len(consumed) <= 4  # items are consumed lazily
+        rest = list(results)
+    assert 19 == len(rest)
+    assert all(future.result() == item * 2 for item, future in rest)
+    with pytest.raises(AssertionError):
+        list(aut.submit_bounded(None, None, [1], 0))
+
+
+def test_load(tmpdir, monkeypatch):
+    urlfile = os.path.join(tmpdir, "urls.txt")
+    with open(urlfile, "w") as f:
+        f.write("foo.jpg\n\n  \nbar.jpg\n")
+    outdir = os.path.join(tmpdir, "out")
+    with monkeypatch.context() as m:
+        m.setattr(urllib3.PoolManager, "request", fake_request)
+        summary = aut.load(urlfile, outdir, False, max_pending=1)
+        assert {'downloaded': 2} == summary
+        assert os.path.exists(os.path.join(outdir, "bar.jpg"))
+        summary = aut.load(urlfile, outdir, False)
+        assert {'fresh': 2} == summary
+
+
+def test_url_host():
+    assert 'some.server.net' == aut.url_host(' http://Some.Server.NET:8080/imgs/foo.png\n')
+    assert '' == aut.url_host('http://[::1/foo.jpg')
+
+
+def test_shard_of():
+    urls = ['http://host{}.net/{}.png'.format(i % 7, i) for i in range(100)]
+    shards = [aut.shard_of(url, 3) for url in urls]
+    assert set(shards) <= {0, 1, 2}
+    assert shards == [aut.shard_of(url, 3) for url in urls]
+    assert aut.shard_of('http://host1.net/a.png', 3) == aut.shard_of('http://HOST1.net/b.png', 3)
+
+
+def test_select_urls():
+    urls = ['http://host{}.net/{}.png\n'.format(i % 7, i) for i in range(100)] + ['\n', '  ']
+    assert 100 == len(list(aut.select_urls(urls)))
+    parts = [list(aut.select_urls(urls, (i, 4))) for i in range(4)]
+    assert sorted(urls[:100]) == sorted(sum(parts, []))
+
+
+def test_shard_spec():
+    assert (2, 8) == aut.shard_spec('2/8')
+    for spec in ('8/8', '-1/2', '1', 'a/b'):
+        with pytest.raises(argparse.ArgumentTypeError):
+            aut.shard_spec(spec)
+
+
+def test_supervise(tmpdir, image_server):
+    urlfile = os.path.join(tmpdir, "urls.txt")
+    with open(urlfile, "w") as f:
+        f.write("".join("{}/img/{}.png\n".format(image_server, i) for i in range(10)))
+    outdir = os.path.join(tmpdir, "out")
+    summary = aut.supervise(aut.load, 3, urlfile, outdir, False, 2)
+    assert {'downloaded': 10} == summary
+    assert 10 == len(os.listdir(outdir))
+
+
+def test_get_buffer():
+    from concurrent.futures import ThreadPoolExecutor
+    buf = aut.get_buffer(16)
+    assert 16 == len(buf) and buf is aut.get_buffer(16)
+    assert 32 == len(aut.get_buffer(32))
+    with ThreadPoolExecutor(1) as executor:
+        assert executor.submit(aut.get_buffer, 32).result() is not aut.get_buffer(32)
+
+
+def test_parse_args_chunk_size():
+    assert 4096 == aut.parse_args(["--chunk-size", "4096", "urls.txt", "out"]).chunk_size
+    for size in ("0", "-1"):
+        with pytest.raises(SystemExit):
+            aut.parse_args(["--chunk-size", size, "urls.txt", "out"])
+
+
+def test_copy_hashed():
+    import hashlib
+    body = bytes(range(256)) * 100
+    response = urllib3.response.HTTPResponse(body=io.BytesIO(body), preload_content=False)
+    assert response._fp.readinto == aut.body_reader(response)
+    out_file = io.BytesIO()
+    assert (len(body), hashlib.sha256(body).hexdigest()) == aut.copy_hashed(response, out_file, 1000)
+    assert body == out_file.getvalue()
+    response = urllib3.response.HTTPResponse(body=io.BytesIO(body), headers={'Content-Encoding': 'gzip'},
+                                             preload_content=False)
+    assert response.readinto == aut.body_reader(response)
+
+
+def test_content_range():
+    assert (100, 1000) == aut.content_range("bytes 100-999/1000")
+    assert (100, None) == aut.content_range("bytes 100-999/*")
+    assert aut.content_range("bytes */1000") is None
+    assert aut.content_range(None) is None
+    assert (0, 10) == aut.body_span(200, {'Content-Length': '10'}, 'x')
+    with pytest.raises(aut.ValidationError):
+        aut.body_span(206, {'Content-Range': 'bytes 5-9/10', 'Content-Encoding': 'gzip'}, 'x')
+
+
+def test_resume_validator():
+    assert '"v1"' == aut.resume_validator({'ETag': '"v1"', 'Last-Modified': 'then'})
+    assert 'then' == aut.resume_validator({'ETag': 'W/"v1"', 'Last-Modified': 'then'})
+    assert aut.resume_validator({'ETag': '"v1"', 'Content-Encoding': 'gzip'}) is None
+
+
+def test_load_resumed(tmpdir, image_server):
+    from conftest import BIG_BODY
+    urlfile = os.path.join(tmpdir, "urls.txt")
+    with open(urlfile, "w") as f:
+        f.write(image_server + "/cut/big.png\n")
+    outdir = os.path.join(tmpdir, "out")
+    assert {'failed': 1} == aut.load(urlfile, outdir, False, retries=0)
+    assert ['.big.png.part', '.big.png.part.resume'] == sorted(os.listdir(outdir))
+    assert {'downloaded': 1} == aut.load(urlfile, outdir, False, retries=0)
+    assert 'bytes={}-'.format(len(BIG_BODY) // 2) == image_server.server.requests['/cut/big.png']['Range']
+    with open(os.path.join(outdir, "big.png"), 'rb') as f:
+        assert BIG_BODY == f.read()
+    assert ['big.png'] == os.listdir(outdir)
+
+
+def test_load_scheduled(tmpdir, image_server):
+    from image_loader.scheduler import HostScheduler
+    urlfile = os.path.join(tmpdir, "urls.txt")
+    with open(urlfile, "w") as f:
+        f.write("".join("{}/slow/{}.png\n".format(image_server, i) for i in range(20)))
+    scheduler = HostScheduler(2, rate=10)
+    summary = aut.load(urlfile, str(tmpdir), False, 8, scheduler=scheduler, retries=0, threads=8)
+    assert {'downloaded': 20} == summary
+    assert 2 == image_server.server.peak
+    started = image_server.server.started
+    assert started[-1] - started[0] >= 0.9  # a burst of 10, then 10 more at 10/s
+    results = aut.stream(("{}/slow/x{}.png".format(image_server, i) for i in range(20)), str(tmpdir),
+                         scheduler=scheduler, threads=8)
+    next(results)
+    results.close()  # cancels the queued urls
+    assert len(started) < 20 + 5
+    assert 0 == len(scheduler) and not scheduler.active
+
+
+def test_stream(tmpdir, image_server):
+    pulled = []
+
+    def urls():
+        for i in range(20):
+            pulled.append(i)
+            yield "{}/img/{}.png".format(image_server, i)
+    probes = []
+    results = aut.stream(urls(), str(tmpdir), max_pending=2, threads=2, hooks=[probes.append])
+    result = next(results)
+    assert 'downloaded' == result and 200 == result.status and result.error is None
+    assert os.path.join(str(tmpdir), os.path.basename(result.url)) == result.path
+    assert os.path.getsize(result.path) == result.bytes
+    assert {'request', 'transfer', 'commit', 'total'} == set(result.timings)
+    assert len(pulled) <= 3  # bounded by max_pending
+    results.close()
+    assert len(pulled) <= 3
+    results = list(aut.stream([image_server + "/html/a.png", image_server + "/nope/b.png", ""], str(tmpdir)))
+    assert [('failed', '404 Not Found'), ('skipped', 'Not an image: Content-Type text/html')] == \
+        sorted((result.outcome, result.error) for result in results)
+    assert all('total' in result.timings for result in results)  # timed without metrics too
+
+
+def test_stream_without_metrics(tmpdir, image_server, monkeypatch):
+    import image_loader.metrics as metrics
+    monkeypatch.setattr(metrics.Metrics, "__init__", None)  # not instrumented at all
+    results = list(aut.stream([image_server + "/img/1.png"], str(tmpdir)))
+    assert ['downloaded'] == results and os.path.join(str(tmpdir), "1.png") == results[0].path
+    assert (200, 1032) == (results[0].status, results[0].bytes)
+    assert {'request', 'transfer', 'commit', 'total'} == set(results[0].timings)
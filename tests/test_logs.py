@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import image_loader.logs as aut
+import image_loader.metrics as metrics
+
+
+def make_record(msg, *args, level=logging.INFO, url=None):
+    record = logging.LogRecord("image_loader.loader", level, __file__, 1, msg, args, None)
+    if url is not None:
+        record.url = url
+    return record
+
+
+def test_json_formatter():
+    entry = json.loads(aut.JsonFormatter().format(make_record("Downloading image: %s", "http://a/1.png",
+                                                              url="http://a/1.png")))
+    assert "Downloading image: http://a/1.png" == entry['message']
+    assert "http://a/1.png" == entry['url']
+    assert ("INFO", "image_loader.loader") == (entry['level'], entry['logger'])
+    assert entry['time'].endswith('Z')
+    assert 'url' not in json.loads(aut.JsonFormatter().format(make_record("Finished")))
+
+
+def test_url_log_filter():
+    sampled = aut.UrlLogFilter(sample=0)
+    assert not sampled.filter(make_record("fresh: %s", "u", url="u"))
+    assert sampled.filter(make_record("fresh: %s", "u", level=logging.ERROR, url="u"))
+    assert sampled.filter(make_record("Finished"))
+    limited = aut.UrlLogFilter(rate=3)
+    assert [True] * 3 + [False] * 7 == [limited.filter(make_record("fresh", url="u")) for _ in range(10)]
+    assert limited.filter(make_record("Finished"))
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super(ListHandler, self).__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+def test_queue_handler():
+    target = ListHandler()
+    handler = aut.LogQueueHandler([target])
+    logger = logging.getLogger("test_logs")
+    logger.addHandler(handler)
+    try:
+        for i in range(100):
+            logger.warning("line %d", i)
+    finally:
+        logger.removeHandler(handler)
+    handler.stop()  # waits for the lines queued
+    assert ["line {}".format(i) for i in range(100)] == [record.getMessage() for record in target.records]
+    assert handler.listener is None
+
+
+def test_progress(caplog):
+    caplog.set_level(logging.INFO, logger=metrics.__name__)
+    run = metrics.Metrics(progress=0.01)
+    run.next_report = 0  # report on the first finished url
+    run.measure(lambda url: 'downloaded', "http://a/1.png")
+    run.measure(lambda url: 'fresh', "http://a/2.png")  # within the interval
+    lines = [record.getMessage() for record in caplog.records if record.getMessage().startswith("Progress")]
+    assert 1 == len(lines)
+    assert lines[0].startswith("Progress: 1 urls,") and lines[0].endswith("- 1 downloaded")
+
+
+def test_per_url_errors(tmpdir, image_server, caplog):
+    from image_loader import loader
+    caplog.set_level(logging.ERROR, logger=loader.__name__)
+    url = image_server + "/fake/a.png"  # an image by Content-Type, html by content
+    assert ['skipped'] == list(loader.stream([url], str(tmpdir)))
+    [record] = [record for record in caplog.records if record.getMessage().endswith(", skipping")]
+    assert url == record.url and "%s, skipping" == record.msg  # formatted only when written
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import image_loader.metrics as aut
+import image_loader.loader as loader
+
+
+def test_histogram():
+    histogram = aut.Histogram()
+    assert histogram.quantile(0.5) is None
+    for i in range(100):
+        histogram.observe(0.01 if i < 90 else 1.0)
+    assert 0.01 <= histogram.quantile(0.5) < 0.012
+    assert 1.0 <= histogram.quantile(0.95) < 1.2
+    histogram.observe(1e6)
+    assert aut.LatencyBuckets[-1] == histogram.quantile(1)
+
+
+def test_measure():
+    probes = []
+    metrics = aut.Metrics(hooks=[probes.append])
+
+    def fetch(url):
+        aut.mark('request')
+        aut.note(status=200, length=10)
+        return 'downloaded'
+    assert 'downloaded' == metrics.measure(fetch, "http://a/1.png\n")
+    aut.mark('request')  # outside of a measured download
+    assert 1 == len(probes) and 'downloaded' == probes[0].outcome
+    assert {'url', 'host', 'status', 'path', 'length', 'digest', 'outcome', 'error', 'phases', 'total'} == \
+        set(probes[0].as_dict())
+    assert ('a', 200, 10) == (probes[0].host, probes[0].status, probes[0].length)
+    summary = metrics.summary()
+    assert {'downloaded': 1} == summary['outcomes'] and {'200': 1} == summary['statuses']
+    assert {'*', 'a'} == set(summary['latency'])
+
+
+def test_measure_result():
+    import pickle
+    metrics = aut.Metrics()
+
+    def fetch(url):
+        aut.note(status=200, length=10, path='/out/1.png', digest='ff00')
+        aut.mark('transfer')
+        return 'downloaded'
+
+    def fail(url):
+        raise OSError("disk full")
+    result = metrics.measure(fetch, "http://a/1.png\n")
+    assert 'downloaded' == result and 'downloaded' == result.outcome
+    assert ("http://a/1.png\n", '/out/1.png', 200, 10, None) == \
+        (result.url, result.path, result.status, result.bytes, result.error)
+    assert {'transfer', 'total'} == set(result.timings)
+    copy = pickle.loads(pickle.dumps(result))
+    assert (result, result.path, result.timings, 'ff00') == (copy, copy.path, copy.timings, copy.digest)
+    result = metrics.measure(fail, "http://a/2.png")
+    assert 'failed' == result and "OSError('disk full')" == result.error
+
+
+def test_shard_path():
+    assert "run.prom" == aut.shard_path("run.prom")
+    assert "/m/run-1of4.prom" == aut.shard_path("/m/run.prom", (1, 4))
+    assert aut.shard_path(None, (1, 4)) is None
+
+
+def test_load_with_metrics(tmpdir, image_server):
+    urlfile = os.path.join(tmpdir, "urls.txt")
+    with open(urlfile, "w") as f:
+        f.write("".join("{}/img/{}.png\n".format(image_server, i) for i in range(3)))
+        f.write(image_server + "/missing.png\n")
+    json_path, prom_path = os.path.join(tmpdir, "run.json"), os.path.join(tmpdir, "run.prom")
+    probes = []
+    loader.load(urlfile, str(tmpdir), False, metrics_json=json_path, metrics_prom=prom_path, hooks=[probes.append])
+    with open(json_path) as f:
+        summary = json.load(f)
+    assert {'downloaded': 3, 'failed': 1} == summary['outcomes']
+    assert {'200': 3, '404': 1} == summary['statuses']
+    assert 3 * 1032 == summary['bytes']
+    assert {'request', 'transfer', 'commit'} == set(summary['phase_secs'])
+    assert 4 == summary['latency']['127.0.0.1']['count']
+    with open(prom_path) as f:
+        text = f.read()
+    assert 'image_loader_urls{outcome="downloaded"} 3' in text
+    assert 'image_loader_latency_seconds_count{host="127.0.0.1"} 4' in text
+    assert 4 == len(probes)
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import pytest
+
+pytest.importorskip("PIL")
+from PIL import Image  # noqa: E402
+import image_loader.postprocess as aut  # noqa: E402
+import image_loader.loader as loader  # noqa: E402
+from image_loader.index import MetadataIndex, index_path  # noqa: E402
+
+
+def test_make_steps():
+    assert (None, ()) == aut.make_steps()
+    steps = aut.make_steps('delete', [(200, 100)], 'webp')
+    assert ('delete', (('200x100', (200, 100), 'webp'), ('webp', None, 'webp'))) == steps
+
+
+def test_process_image(tmpdir):
+    outdir = str(tmpdir)
+    os.makedirs(os.path.join(outdir, "ab"))
+    path = os.path.join(outdir, "ab", "1.png")
+    Image.new('RGBA', (64, 32), (255, 0, 0, 128)).save(path)
+    steps = aut.make_steps('quarantine', [(16, 16)], 'jpeg')
+    assert ('processed', None) == aut.process_image(path, outdir, 'aa', steps)
+    with Image.open(os.path.join(outdir, ".variants", "16x16", "ab", "1.jpg")) as thumbnail:
+        assert ('JPEG', (16, 8)) == (thumbnail.format, thumbnail.size)
+    with Image.open(os.path.join(outdir, ".variants", "jpeg", "ab", "1.jpg")) as converted:
+        assert (64, 32) == converted.size
+    assert ('unchanged', None) == aut.process_image(path, outdir, 'aa', steps)
+    assert 'processed' == aut.process_image(path, outdir, 'aa', aut.make_steps('quarantine'))[0]
+    with open(path, 'rb') as f:
+        body = f.read()
+    with open(path, 'wb') as f:
+        f.write(body[:len(body) // 2])
+    assert 'corrupt' == aut.process_image(path, outdir, 'bb', steps)[0]
+    assert not os.path.exists(path) and not os.path.exists(aut.stamp_name(path, outdir))
+    assert os.path.exists(os.path.join(outdir, ".quarantine", "ab", "1.png"))
+    svg = os.path.join(outdir, "2.svg")
+    with open(svg, 'w') as f:
+        f.write('<svg xmlns="http://www.w3.org/2000/svg"></svg>')
+    assert ('unsupported', None) == aut.process_image(svg, outdir, 'cc', steps)
+
+
+def test_load_postprocess(tmpdir, image_server):
+    urlfile = os.path.join(tmpdir, "urls.txt")
+    with open(urlfile, "w") as f:
+        f.write(image_server + "/png/1.png\n" + image_server + "/img/2.png\n")  # the latter is no real image
+    outdir = os.path.join(tmpdir, "out")
+    options = dict(use_index=True, verify='quarantine', resize=[(8, 8)], post_workers=2)
+    assert {'downloaded': 2} == loader.load(urlfile, outdir, False, **options)
+    assert os.path.exists(os.path.join(outdir, ".variants", "8x8", "1.png"))
+    assert os.path.exists(os.path.join(outdir, ".quarantine", "2.png"))
+    assert ['1.png'] == [name for name in os.listdir(outdir) if not name.startswith('.')]
+    with MetadataIndex(index_path(outdir)) as index:
+        assert index.get(image_server + "/img/2.png") is None  # so it is downloaded again
+    assert {'downloaded': 1, 'fresh': 1} == loader.load(urlfile, outdir, False, **options)
+
+
+def test_parse_args_postprocess():
+    args = loader.parse_args(["--verify", "delete", "--resize", "200x100", "--resize", "50X50", "urls.txt", "out"])
+    assert ('delete', [(200, 100), (50, 50)], None) == (args.verify, args.resize, args.convert)
+    with pytest.raises(SystemExit):
+        loader.parse_args(["--resize", "200", "urls.txt", "out"])
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import socket
+import pytest
+import urllib3
+import image_loader.resolve as aut
+import image_loader.loader as loader
+
+
+@pytest.fixture
+def lookups(monkeypatch):
+    "Count the calls of getaddrinfo per host; hosts ending in .invalid do not resolve"
+    calls = []
+    getaddrinfo = socket.getaddrinfo
+
+    def counting(host, *args, **kwargs):
+        calls.append(host)
+        if host.endswith(".invalid"):
+            raise socket.gaierror(socket.EAI_NONAME, "Name or service not known")
+        return getaddrinfo(host, *args, **kwargs)
+    monkeypatch.setattr(socket, "getaddrinfo", counting)
+    return calls
+
+
+def test_resolver_cache(lookups, monkeypatch):
+    with aut.Resolver() as resolver:
+        addresses = resolver.lookup("localhost")
+        assert "127.0.0.1" in [address for _, _, address in addresses]
+        assert addresses == resolver.lookup("localhost")
+        assert addresses == resolver.cached("localhost")
+        for _ in range(2):
+            with pytest.raises(socket.gaierror):
+                resolver.lookup("nowhere.invalid")
+        assert resolver.cached("nowhere.invalid") is None
+        resolver.prefetch("127.0.0.1")
+        assert [(socket.AF_INET, socket.IPPROTO_TCP, "127.0.0.1")] == resolver.lookup("127.0.0.1")
+        assert ["localhost", "nowhere.invalid", "127.0.0.1"] == lookups
+        monkeypatch.setattr(aut, "CacheSecs", -1)  # expires at once
+        resolver.lookup("127.0.0.2")
+        resolver.lookup("127.0.0.2")
+        assert 2 == lookups.count("127.0.0.2")
+        assert {'resolved': 4, 'failed': 1, 'cached': 3} == resolver.counts
+
+
+def test_look_ahead(lookups):
+    urls = ["http://a.invalid/1.png", "http://b.invalid/2.png", "http://a.invalid/3.png", "http://c.invalid/4.png",
+            "https://b.invalid/5.png", "/no/host.png"]
+    manager = urllib3.PoolManager(num_pools=1)
+    with aut.Resolver() as resolver:
+        looking = aut.look_ahead(urls, 3, manager, resolver, max_pools=100)
+        assert urls[0] == next(looking)
+        assert 3 == manager.pools._maxsize  # a, b and c in the window
+        assert urls[1:] == list(looking)
+    assert ["a.invalid", "b.invalid", "c.invalid"] == sorted(set(lookups))
+    assert urls == list(aut.look_ahead(urls, 0))
+
+
+def test_load_resolve_ahead(tmpdir, image_server, lookups):
+    base = image_server.replace("127.0.0.1", "localhost")  # may resolve to ::1 first, where nobody listens
+    urlfile = os.path.join(tmpdir, "urls.txt")
+    with open(urlfile, "w") as f:
+        f.write("".join("{}/img/{}.png\n".format(base, i) for i in range(20)))
+        f.write("http://nowhere.invalid/img/x.png\n")
+    outdir = os.path.join(tmpdir, "out")
+    os.mkdir(outdir)
+    summary = loader.load(urlfile, outdir, False, threads=4, resolve_ahead=10, prewarm=True, retries=0)
+    assert {'downloaded': 20, 'failed': 1} == summary
+    assert 1 == lookups.count("localhost")
+    assert 1 == lookups.count("nowhere.invalid")
+
+
+def test_aio_resolve_ahead(tmpdir, image_server, lookups):
+    pytest.importorskip("aiohttp")
+    from image_loader import aioloader
+    base = image_server.replace("127.0.0.1", "localhost")
+    urlfile = os.path.join(tmpdir, "urls.txt")
+    with open(urlfile, "w") as f:
+        f.write("".join("{}/img/{}.png\n".format(base, i) for i in range(20)))
+    outdir = os.path.join(tmpdir, "out")
+    os.mkdir(outdir)
+    assert {'downloaded': 20} == aioloader.load(urlfile, outdir, False, resolve_ahead=10)
+    assert 1 == lookups.count("localhost")
+
+
+def test_parse_args_prewarm(capsys):
+    with pytest.raises(SystemExit):
+        loader.parse_args(["--prewarm", "urls.txt", "out"])
+    assert "--prewarm needs --resolve-ahead" in capsys.readouterr().err
+    args = loader.parse_args(["--resolve-ahead", "100", "--prewarm", "urls.txt", "out"])
+    assert (100, True, None) == (args.resolve_ahead, args.prewarm, args.pools)
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+import image_loader.scheduler as aut
+import image_loader.loader as loader
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_token_bucket():
+    clock = FakeClock()
+    bucket = aut.TokenBucket(2, 2, clock)
+    assert 0 == bucket.take()
+    assert 0 == bucket.take()
+    assert 0.5 == pytest.approx(bucket.take())
+    clock.now += 0.5
+    assert 0 == bucket.take()
+    assert not bucket.is_full()
+    clock.now += 10
+    assert bucket.is_full()
+    with pytest.raises(AssertionError):
+        aut.TokenBucket(0)
+
+
+def test_host_scheduler_limits():
+    scheduler = aut.HostScheduler(max_per_host=2)
+    for url in ['http://a/1', 'http://b/1', 'http://a/2', 'http://a/3', 'http://b/2']:
+        scheduler.put(url)
+    assert 5 == len(scheduler)
+    # urls of a host are handed out in a batch, up to the host limit
+    assert ['http://a/1', 'http://a/2', 'http://b/1', 'http://b/2'] == [scheduler.get()[0] for _ in range(4)]
+    assert (None, None) == scheduler.get()
+    scheduler.task_done('http://a/1', 'downloaded')
+    assert ('http://a/3', None) == scheduler.get()
+    assert 0 == len(scheduler)
+
+
+def test_host_scheduler_rate():
+    clock = FakeClock()
+    scheduler = aut.HostScheduler(max_per_host=10, rate=1, clock=clock)
+    for url in ['http://a/1', 'http://a/2']:
+        scheduler.put(url)
+    assert ('http://a/1', None) == scheduler.get()
+    assert (None, pytest.approx(1)) == scheduler.get()
+    clock.now += 1
+    assert ('http://a/2', None) == scheduler.get()
+
+
+def test_host_scheduler_throttled():
+    clock = FakeClock()
+    scheduler = aut.HostScheduler(clock=clock)
+    for url in ['http://a/1', 'http://a/2', 'http://b/1']:
+        scheduler.put(url)
+    assert ('http://a/1', None) == scheduler.get()
+    scheduler.task_done('http://a/1', 'throttled')
+    assert ('http://b/1', None) == scheduler.get()
+    assert (None, pytest.approx(aut.ThrottlePauseSecs)) == scheduler.get()
+    clock.now += aut.ThrottlePauseSecs
+    assert ('http://a/2', None) == scheduler.get()
+
+
+def test_submit():
+    active, peak = {}, {}
+    def fetch(url):
+        host = loader.url_host(url)
+        active[host] = active.get(host, 0) + 1
+        peak[host] = max(peak.get(host, 0), active[host])
+        active[host] -= 1
+        return 'downloaded'
+    urls = ['http://host{}/{}.png'.format(i % 3, i) for i in range(60)]
+    scheduler = aut.HostScheduler(max_per_host=2, lookahead=10)
+    with ThreadPoolExecutor(8) as executor:
+        results = list(scheduler.submit(executor, fetch, urls, 5))
+    assert sorted(urls) == sorted(url for url, _ in results)
+    assert all(count <= 2 for count in peak.values())
+    assert 0 == len(scheduler) and not scheduler.active
+
+
+def test_load_scheduled(tmpdir, image_server):
+    urlfile = os.path.join(tmpdir, "urls.txt")
+    with open(urlfile, "w") as f:
+        f.write("".join("{}/img/{}.png\n".format(image_server, i) for i in range(6)))
+        f.write(image_server + "/busy/x.png\n")
+    summary = loader.load(urlfile, str(tmpdir), False, 4, scheduler=aut.HostScheduler(2, rate=100), retries=0)
+    assert {'downloaded': 6, 'throttled': 1} == summary
+
+
+def test_stream_options_host_rate(caplog):
+    caplog.set_level(logging.INFO, logger=loader.__name__)
+    scheduler = loader.stream_options(loader.parse_args(["--host-rate", "5", "urls.txt", "out"]))['scheduler']
+    assert (aut.MaxPerHost, 5) == (scheduler.max_per_host, scheduler.rate)
+    assert any("--per-host" in record.getMessage() for record in caplog.records)  # the default is told
+    scheduler = loader.stream_options(loader.parse_args(["--per-host", "2", "urls.txt", "out"]))['scheduler']
+    assert (2, None) == (scheduler.max_per_host, scheduler.rate)
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import errno
+import os
+import pytest
+import stat
+import image_loader.storage as aut
+import image_loader.loader as loader
+
+
+def make_temp(store, data):
+    with store.open_temp() as tmp_file:
+        tmp_file.write(data)
+    return tmp_file.name
+
+
+def test_open_temp(tmpdir):
+    umask = os.umask(0o027)
+    try:
+        with aut.open_temp(str(tmpdir)) as tmp_file:
+            tmp_file.write(b'x')
+    finally:
+        os.umask(umask)
+    assert 0o640 == stat.S_IMODE(os.stat(tmp_file.name).st_mode)
+    assert os.path.basename(tmp_file.name).startswith('.tmp-')
+
+
+def test_content_store_hardlink(tmpdir):
+    outdir = str(tmpdir)
+    store = aut.ContentStore(outdir)
+    blob = store.commit(make_temp(store, b'abc'), 'ab12ff', os.path.join(outdir, 'a.png'))
+    assert blob == os.path.join(outdir, '.blobs', 'ab', '12', 'ab12ff')
+    store.commit(make_temp(store, b'abc'), 'ab12ff', os.path.join(outdir, 'b.png'))
+    assert 3 == os.stat(blob).st_nlink
+    assert ['ab12ff'] == os.listdir(os.path.dirname(blob))
+    assert not [name for name in os.listdir(store.root) if name.startswith('.tmp-')]
+    # relinking replaces the old file
+    store.commit(make_temp(store, b'def'), 'cd34ff', os.path.join(outdir, 'a.png'))
+    assert b'def' == open(os.path.join(outdir, 'a.png'), 'rb').read()
+    assert 2 == os.stat(blob).st_nlink
+
+
+def test_content_store_symlink(tmpdir, monkeypatch):
+    outdir = str(tmpdir)
+    store = aut.ContentStore(outdir, symlink=True)
+    store.commit(make_temp(store, b'abc'), 'ab12ff', os.path.join(outdir, 'a.png'))
+    assert os.readlink(os.path.join(outdir, 'a.png')) == os.path.join('.blobs', 'ab', '12', 'ab12ff')
+    assert b'abc' == open(os.path.join(outdir, 'a.png'), 'rb').read()
+
+    def too_many_links(*args):
+        raise OSError(errno.EMLINK, "Too many links")
+    monkeypatch.setattr(os, "link", too_many_links)
+    store = aut.ContentStore(outdir)
+    store.commit(make_temp(store, b'abc'), 'ab12ff', os.path.join(outdir, 'b.png'))
+    assert os.path.islink(os.path.join(outdir, 'b.png'))
+
+
+def test_load_dedup(tmpdir, image_server):
+    urlfile = os.path.join(tmpdir, "urls.txt")
+    with open(urlfile, "w") as f:
+        f.write("".join("{}/img/{}.png\n".format(image_server, i) for i in range(5)))
+    outdir = os.path.join(tmpdir, "out")
+    assert {'downloaded': 5} == loader.load(urlfile, outdir, True, dedup='hardlink')
+    assert 6 == os.stat(os.path.join(outdir, "3.png")).st_nlink  # five names plus the blob
+
+
+def test_partial_name():
+    assert '/out/.foo.png.part' == aut.partial_name('/out/foo.png')
+    assert '.foo.png.part' == aut.partial_name('foo.png')
+
+
+def test_output_commit(tmpdir):
+    file_name = os.path.join(tmpdir, 'foo.png')
+    with open(file_name, 'wb') as f:
+        f.write(b'old')
+    out_file = aut.open_output(file_name, 1000)
+    assert b'old' == open(file_name, 'rb').read()  # untouched while downloading
+    out_file.write(b'new')
+    aut.commit_output(out_file, file_name, None)
+    assert b'new' == open(file_name, 'rb').read()  # preallocation truncated
+    assert ['foo.png'] == os.listdir(tmpdir)
+
+
+def test_output_discard(tmpdir):
+    file_name = os.path.join(tmpdir, 'foo.png')
+    out_file = aut.open_output(file_name)
+    out_file.write(b'partial')
+    aut.discard_output(out_file)
+    assert [] == os.listdir(tmpdir)
+
+
+def test_output_locked(tmpdir, monkeypatch):
+    file_name = os.path.join(tmpdir, 'foo.png')
+    with open(file_name, 'wb') as f:
+        f.write(b'old')
+
+    def locked(*args):
+        raise OSError(errno.EACCES, "Permission denied")
+    monkeypatch.setattr(aut.fcntl, "lockf", locked)
+    assert aut.open_output(file_name, 10) is None
+    assert b'old' == open(file_name, 'rb').read()
+
+
+def test_output_resume(tmpdir):
+    file_name = os.path.join(tmpdir, 'foo.png')
+    assert aut.read_resume(file_name) is None
+    out_file = aut.open_output(file_name, 1000)
+    out_file.write(b'first half')
+    aut.keep_output(out_file, file_name, '"v1"')
+    assert (10, '"v1"') == aut.read_resume(file_name)
+    out_file = aut.open_output(file_name, 20, offset=10)
+    assert 10 == out_file.tell()
+    assert aut.read_resume(file_name) is None  # until it breaks off again
+    out_file.write(b'+more')
+    aut.keep_output(out_file, file_name, '"v1"')
+    assert (15, '"v1"') == aut.read_resume(file_name)
+    out_file = aut.open_output(file_name, offset=10)  # the partial file changed meanwhile
+    assert 0 == out_file.tell()
+    aut.keep_output(out_file, file_name, '"v1"')  # nothing written
+    assert [] == os.listdir(tmpdir)
+
+
+def test_output_claimed(tmpdir):
+    file_name = os.path.join(tmpdir, 'foo.png')
+    out_file = aut.open_output(file_name, 10)
+    out_file.write(b'first')
+    assert aut.open_output(file_name, 10) is None  # another thread of this process, e.g. for a duplicate url
+    aut.commit_output(out_file, file_name, None)
+    assert b'first' == open(file_name, 'rb').read()
+    out_file = aut.open_output(file_name, 10)  # claimable again
+    assert out_file is not None
+    aut.discard_output(out_file)
+
+
+def test_output_replaced_before_lock(tmpdir, monkeypatch):
+    file_name = os.path.join(tmpdir, 'foo.png')
+    with open(aut.partial_name(file_name), 'wb') as f:
+        f.write(b'complete image')
+    open_partial = aut.open_partial
+    opened = []
+
+    def open_then_committed(path):
+        "Open the partial file just before another run moves it into place"
+        out_file = open_partial(path)
+        if not opened:
+            os.replace(path, file_name)
+        opened.append(out_file)
+        return out_file
+    monkeypatch.setattr(aut, "open_partial", open_then_committed)
+    out_file = aut.open_output(file_name, 10)
+    assert 2 == len(opened) and out_file is opened[1]
+    assert b'complete image' == open(file_name, 'rb').read()  # not truncated
+    aut.discard_output(out_file)
+    assert ['foo.png'] == os.listdir(tmpdir)
+
+
+def test_output_preallocate_failed(tmpdir, monkeypatch):
+    file_name = os.path.join(tmpdir, 'foo.png')
+    allocated = []
+
+    def no_space(fd, offset, length):
+        allocated.append(length)
+        if len(allocated) == 1:
+            raise OSError(errno.ENOSPC, "No space left on device")
+    monkeypatch.setattr(aut.os, "posix_fallocate", no_space, raising=False)
+    with pytest.raises(OSError):
+        aut.open_output(file_name, 10)
+    assert [] == os.listdir(tmpdir)  # no stale partial file
+    out_file = aut.open_output(file_name, 10)  # neither claimed nor locked any more
+    assert out_file is not None
+    aut.discard_output(out_file)
+    for length, max_size in ((aut.MaxPreallocate + 1, None), (20, 10)):
+        aut.discard_output(aut.open_output(file_name, length, max_size=max_size))
+    assert [10, 10] == allocated  # not beyond the limits
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import io
+import image_loader.unique as aut
+import image_loader.loader as loader
+from image_loader.journal import UrlLine
+
+
+def test_normalize_url():
+    assert "http://example.com/a/B.png" == aut.normalize_url(" HTTP://Example.COM:80/a/B.png\n")
+    assert "https://example.com/x.png?s=1" == aut.normalize_url("https://example.com:443/x.png?s=1#top")
+    assert "http://example.com:8080/x.png" == aut.normalize_url("http://example.com:8080/x.png")
+    assert "http://u:p@[::1]/" == aut.normalize_url("http://u:p@[::1]")
+    assert "foo.jpg" == aut.normalize_url("foo.jpg \n")
+    assert "http://[::1/foo.jpg" == aut.normalize_url("http://[::1/foo.jpg\n")  # invalid IPv6 host
+    assert "http://a:x/foo.jpg" == aut.normalize_url("http://a:x/foo.jpg")
+
+
+def test_unique_urls_invalid():
+    unique = aut.UniqueUrls()
+    assert ["http://[::1/foo.jpg", "http://a/1.png"] == list(unique.filter(
+        ["http://[::1/foo.jpg\n", "http://[::1/foo.jpg", "http://a/1.png"]))
+    assert {'duplicate': 1} == unique.counts
+
+
+def test_digest_table_grows():
+    table = aut.DigestTable(size=4, with_values=True)
+    for key in range(1, 100):
+        assert table.add(key, key * 2)
+    assert not table.add(7, 0)
+    assert 99 == len(table)
+    assert 14 == table.get(7)
+    assert table.get(100) is None
+
+
+def test_bloom_filter():
+    bloom = aut.BloomFilter(capacity=1000, error_rate=0.01)
+    keys = [aut.digest("http://h/{}.png".format(i)) for i in range(1000)]
+    assert all(bloom.add(key) for key in keys[:500])
+    assert not any(bloom.add(key) for key in keys[:500])
+
+
+def test_unique_urls():
+    unique = aut.UniqueUrls()
+    lines = [UrlLine("http://a/1.png\n", 0, 15), UrlLine("HTTP://A:80/1.png \n", 15, 35),
+             UrlLine("http://b/1.png\n", 35, 50), UrlLine("http://a/2.png\n", 50, 65)]
+    urls = list(unique.filter(lines))
+    assert ["http://a/1.png", "http://a/2.png"] == urls
+    assert [0, 50] == [url.offset for url in urls]
+    assert {'duplicate': 1, 'collision': 1} == unique.counts
+
+
+def test_unique_urls_bloom():
+    unique = aut.UniqueUrls('bloom')
+    assert ["http://a/1.png", "http://b/1.png"] == list(unique.filter(
+        ["http://a/1.png", "http://A/1.png", "http://b/1.png"]))
+    assert {'duplicate': 1} == unique.counts
+
+
+def test_url_lines_unique():
+    url_file = io.BytesIO(b"http://a/1.png\n\nhttp://a/1.png\nhttp://a/2.png\n")
+    urls = loader.url_lines(url_file, unique=aut.UniqueUrls())
+    assert ["http://a/1.png", "http://a/2.png"] == list(urls)
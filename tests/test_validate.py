@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import pytest
+import urllib3
+import image_loader.validate as aut
+import image_loader.loader as loader
+
+
+def test_sniff_image():
+    assert 'png' == aut.sniff_image(b'\x89PNG\r\n\x1a\n\0\0\0\rIHDR')
+    assert 'jpeg' == aut.sniff_image(b'\xff\xd8\xff\xe0\0\x10JFIF')
+    assert 'gif' == aut.sniff_image(b'GIF89a\x01\0')
+    assert 'webp' == aut.sniff_image(b'RIFF\x24\0\0\0WEBPVP8 ')
+    assert 'avif' == aut.sniff_image(b'\0\0\0\x1cftypavif\0\0\0\0')
+    assert 'svg' == aut.sniff_image(b'\xef\xbb\xbf<?xml version="1.0"?>\n<svg xmlns="...">')
+    assert 'svg' == aut.sniff_image(memoryview(b'  <svg width="1"/>'))
+    assert aut.sniff_image(b'<!DOCTYPE html><html>') is None
+    assert aut.sniff_image(b'RIFF\x24\0\0\0WAVEfmt ') is None
+    assert aut.sniff_image(b'') is None
+
+
+def test_checks():
+    aut.check_head(b'GIF87a', 'u')
+    with pytest.raises(aut.ValidationError):
+        aut.check_head(b'<html>', 'u')
+    aut.check_size(100, None, 'u')
+    aut.check_size(None, 10, 'u')
+    aut.check_size(10, 10, 'u')
+    with pytest.raises(aut.ValidationError):
+        aut.check_size(11, 10, 'u')
+
+
+def test_copy_hashed_max_size():
+    response = urllib3.response.HTTPResponse(body=io.BytesIO(b'\0' * 1000), preload_content=False)
+    with pytest.raises(aut.ValidationError):
+        loader.copy_hashed(response, io.BytesIO(), 100, max_size=500)
+
+
+def test_load_validated(tmpdir, image_server):
+    urlfile = os.path.join(tmpdir, "urls.txt")
+    with open(urlfile, "w") as f:
+        f.write("{0}/img/a.png\n{0}/fake/b.png\n".format(image_server))
+    assert {'downloaded': 1, 'skipped': 1} == loader.load(urlfile, str(tmpdir), True)
+    assert not os.path.exists(os.path.join(tmpdir, "b.png"))
+    assert {'skipped': 2} == loader.load(urlfile, str(tmpdir), True, max_size=100)
+    assert ['a.png', 'urls.txt'] == sorted(os.listdir(tmpdir))
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+import time
+import image_loader.watch as aut
+import image_loader.loader as loader
+
+
+def test_url_file_tail(tmpdir):
+    path = os.path.join(tmpdir, "urls.txt")
+    tail = aut.UrlFileTail(path)
+    assert [] == list(tail.lines())  # not there yet
+    with open(path, "w") as f:
+        f.write("a\nb\nc")
+    assert ["a\n", "b\n"] == list(tail.lines())  # c is still being written
+    with open(path, "a") as f:
+        f.write("\nd\n")
+    assert ["c\n", "d\n"] == list(tail.lines())
+    assert [] == list(tail.lines())
+    tail.rewind()
+    assert ["a\n", "b\n", "c\n", "d\n"] == list(tail.lines())
+    with open(path + ".new", "w") as f:
+        f.write("e\n")
+    os.replace(path + ".new", path)
+    assert ["e\n"] == list(tail.lines())
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_watcher(tmpdir, image_server):
+    urlfile = os.path.join(tmpdir, "urls.txt")
+    outdir = os.path.join(tmpdir, "out")
+    with open(urlfile, "w") as f:
+        f.write(image_server + "/img/1.png\n")
+    configs = []
+
+    def configure():
+        configs.append(loader.parse_args(["--watch", "--poll", "0.01", urlfile, outdir]))
+        return configs[-1]
+    watcher = aut.Watcher(configure)
+    errors = []
+
+    def feed():
+        try:
+            wait_for(lambda: os.path.exists(os.path.join(outdir, "1.png")))
+            with open(urlfile, "a") as f:
+                f.write(image_server + "/img/2.png\n")
+            wait_for(lambda: os.path.exists(os.path.join(outdir, "2.png")))
+            pool = watcher.pool
+            watcher.on_hangup(None, None)
+            wait_for(lambda: watcher.pool is not pool)  # reloaded
+            assert 2 == len(configs)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            watcher.on_stop(None, None)
+    thread = threading.Thread(target=feed)
+    thread.start()
+    watcher.run()
+    thread.join()
+    assert [] == errors
+    assert ['1.png', '2.png'] == sorted(os.listdir(outdir))
+
+
+def test_watcher_reload(tmpdir, image_server):
+    urlfile = os.path.join(tmpdir, "urls.txt")
+    argv = ["--watch", urlfile, str(tmpdir)]
+    watcher = aut.Watcher(lambda: loader.parse_args(argv))
+    watcher.reload()
+    pool, args = watcher.pool, watcher.args
+    pool.connection_from_url(image_server)
+    argv.insert(0, "--threads=0")  # e.g. a bad edit of an @FILE
+    watcher.reload()  # logs, rather than ending the watcher
+    assert (pool, args) == (watcher.pool, watcher.args)
+    argv.pop(0)
+    watcher.reload()
+    assert watcher.pool is not pool and 0 == len(pool.pools)  # connections of the old pool closed
+    loader.close_pool(watcher.pool)